@@ -0,0 +1,134 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+
+from emulator import create_emulator
+from opcodes import load_opcode_table
+
+
+# rom - key into the rom table handed to the pool, patches - (address, bytes) written after loading the rom,
+# limits - keyword arguments for OpCodeParser.run, outputs - (start, end) memory ranges to send back, tag - anything,
+# seed - power up state seed for create_emulator, None picks one (JobResult.seed says which, to rerun it)
+Job = collections.namedtuple('Job', ['rom', 'patches', 'limits', 'outputs', 'tag', 'seed'])
+Job.__new__.__defaults__ = ((), None, (), None, None)
+
+JobResult = collections.namedtuple('JobResult', [
+    'tag', 'reason', 'instructions', 'cycles', 'registers', 'memory_digest', 'outputs', 'error', 'seed'])
+JobResult.__new__.__defaults__ = (None,)
+
+_worker_roms = None  # rom key -> bytes, set once per worker process
+
+
+def _init_worker(roms):
+    global _worker_roms
+    _worker_roms = roms
+    load_opcode_table()  # parsed here once, every emulator the worker builds after this reuses it
+
+
+def run_job(job, roms=None):
+    """
+        run a single job in this process
+        roms - rom key -> bytes, defaults to what the worker was started with
+    """
+    roms = roms if roms is not None else _worker_roms
+    try:
+        parser = create_emulator(roms[job.rom], job.patches, job.seed)
+        result = parser.run(**(job.limits or {}))
+        registers = parser.registers
+        memory = parser.memory
+        return JobResult(
+            tag=job.tag,
+            reason=result.reason,
+            instructions=result.instructions,
+            cycles=result.cycles,
+            registers={'a': registers.a, 'x': registers.x, 'pc': registers.pc, 'sp': registers.sp,
+                       'flags': registers.flags},
+            memory_digest=hashlib.sha256(memory.view()).hexdigest(),
+            outputs=[bytes(memory.view(start, end)) for start, end in job.outputs],
+            error=None,
+            seed=registers.seed,
+        )
+    except Exception as error:  # one broken scenario shouldnt take the whole batch down
+        return JobResult(job.tag, None, 0, 0, None, None, [], "{0}: {1}".format(type(error).__name__, error), job.seed)
+
+
+def run_batch(jobs, roms, max_workers=None):
+    """
+        spread jobs over a process pool and yield their JobResults in job order, so the same jobs always give
+        the same output. the pool keeps going while an earlier job holds the next result back
+        jobs - iterable of Job
+        roms - rom key -> bytes, shipped to every worker once when it starts instead of with every job
+        max_workers - defaults to the number of cpus
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                                initargs=(roms,)) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        for future in futures:
+            yield future.result()
+
+
+def load_jobs(jobs_file):
+    """
+        read jobs from a json lines file, one object per line:
+        {"rom": "path", "patches": [[address, "hex bytes"]], "max_instructions": n, "max_cycles": n,
+         "until_pc": address, "outputs": [[start, end]], "tag": anything, "seed": n}
+        :return: (list of Job, rom path -> bytes)
+    """
+    jobs = []
+    roms = {}
+    for line in jobs_file:
+        line = line.strip()
+        if not line:
+            continue
+        description = json.loads(line)
+        rom_path = description['rom']
+        if rom_path not in roms:
+            with open(rom_path, 'rb') as rom_file:
+                roms[rom_path] = rom_file.read()
+        limits = {name: description[name] for name in ('max_instructions', 'max_cycles', 'until_pc')
+                  if description.get(name) is not None}
+        patches = tuple((address, bytes.fromhex(data)) for address, data in description.get('patches', ()))
+        outputs = tuple(tuple(output) for output in description.get('outputs', ()))
+        jobs.append(Job(rom_path, patches, limits, outputs, description.get('tag', len(jobs)), description.get('seed')))
+    return jobs, roms
+
+
+def _result_to_json(result):
+    result = result._asdict()
+    result['outputs'] = [output.hex() for output in result['outputs']]
+    return json.dumps(result)
+
+
+def test_seeded_jobs_are_deterministic_and_ordered():
+    roms = {'rom': bytes([0x81])}  # RTS off the empty stack, pc comes from the garbage it powered up with
+    jobs = [Job('rom', limits={'max_instructions': 1}, outputs=((0x00, 0x02),), tag=tag, seed=seed)
+            for tag, seed in (('second', 2), ('first', 1), ('unseeded', None))]
+    results = list(run_batch(jobs, roms, max_workers=2))
+    assert [result.tag for result in results] == ['second', 'first', 'unseeded']
+    assert [result.seed for result in results[:2]] == [2, 1] and results[2].seed is not None
+    assert all(result.error is None and result.instructions == 1 for result in results)
+    assert results[0].registers['pc'] != results[1].registers['pc']  # the seeds power up differently
+
+    again = list(run_batch(jobs[:2] + [jobs[2]._replace(seed=results[2].seed)], roms, max_workers=2))
+    assert again == results  # the seed a result reports reruns it exactly
+    assert run_job(jobs[1], roms) == results[1]
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="run many emulator jobs over a process pool")
+    argument_parser.add_argument("jobs", help="json lines job file, - for stdin")
+    argument_parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+    options = argument_parser.parse_args()
+
+    if options.jobs == "-":
+        jobs, roms = load_jobs(sys.stdin)
+    else:
+        with open(options.jobs) as input_file:
+            jobs, roms = load_jobs(input_file)
+
+    for job_result in run_batch(jobs, roms, options.workers):
+        print(_result_to_json(job_result), flush=True)
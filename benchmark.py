@@ -0,0 +1,292 @@
+import argparse
+import collections
+import json
+import os
+import platform
+import struct
+import sys
+import time
+import tracemalloc
+
+from emulator import create_emulator
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DEFAULT_THRESHOLD = 0.25  # a mode is a regression when it gets this much slower than its baseline
+CALIBRATION_LOOPS = 1000000  # table lookups timed to rate the host, see calibrate()
+
+# rom - loaded at 0x0000 where execution starts, patches - (address, bytes) written before the run
+Workload = collections.namedtuple('Workload', ['name', 'rom', 'patches', 'description'])
+
+WORKLOADS = (
+    Workload('straight_line', bytes([
+        0x4F,              # 0000 CLRA
+        0xAB, 0x01,        # 0001 ADD #1
+        0x97,              # 0003 TAX
+        0x9F,              # 0004 TXA
+        0x98,              # 0005 CLC
+        0x99,              # 0006 SEC
+        0x9D,              # 0007 NOP
+        0xCC, 0x00, 0x00,  # 0008 JMP $0000
+    ]), (), "inherent and immediate instructions, one jump"),
+    Workload('delay_loop', bytes([
+        0xAE, 0xFF,        # 0000 LDX #$FF
+        0x5A,              # 0002 DECX
+        0x26, 0xFD,        # 0003 BNE $0002
+        0x20, 0xF9,        # 0005 BRA $0000
+    ]), (), "DECX/BNE software delay"),
+    Workload('memcpy', bytes([
+        0x5F,              # 0000 CLRX
+        0xD6, 0x02, 0x00,  # 0001 LDA $0200,X
+        0xD7, 0x03, 0x00,  # 0004 STA $0300,X
+        0x5C,              # 0007 INCX
+        0xA3, 0x40,        # 0008 CPX #$40
+        0x26, 0xF5,        # 000A BNE $0001
+        0x20, 0xF2,        # 000C BRA $0000
+    ]), ((0x0200, bytes(range(0x40))),), "64 byte copy through 16 bit indexed addressing"),
+    Workload('arithmetic', bytes([
+        0x4F,              # 0000 CLRA
+        0xAB, 0x07,        # 0001 ADD #7
+        0xA9, 0x03,        # 0003 ADC #3
+        0xA0, 0x02,        # 0005 SUB #2
+        0xBB, 0x80,        # 0007 ADD $80
+        0xC9, 0x02, 0x00,  # 0009 ADC $0200
+        0xB0, 0x81,        # 000C SUB $81
+        0x20, 0xF1,        # 000E BRA $0001
+    ]), ((0x0080, b"\x11\x05"), (0x0200, b"\x2a")), "ADD/ADC/SUB over immediate, direct and extended operands"),
+    Workload('call_chain', bytes([
+        0xAD, 0x05,        # 0000 BSR $0007
+        0xCD, 0x00, 0x0B,  # 0002 JSR $000B
+        0x20, 0xF9,        # 0005 BRA $0000
+        0xCD, 0x00, 0x0B,  # 0007 JSR $000B
+        0x81,              # 000A RTS
+        0x4C,              # 000B INCA
+        0x81,              # 000C RTS
+    ]), (), "nested JSR/BSR and RTS"),
+    Workload('bit_polling', bytes([
+        0x10, 0x80,        # 0000 BSET 0,$80
+        0x00, 0x80, 0x02,  # 0002 BRSET 0,$80,$0007
+        0x20, 0xF9,        # 0005 BRA $0000
+        0x11, 0x80,        # 0007 BCLR 0,$80
+        0x01, 0x80, 0xF4,  # 0009 BRCLR 0,$80,$0000
+        0x20, 0xF2,        # 000C BRA $0000
+    ]), (), "BSET/BCLR on a flag byte polled with BRSET/BRCLR"),
+)
+
+# LOOP_ROM is what the dispatch table comparison has always run
+LOOP_ROM = WORKLOADS[0].rom
+
+
+def build_parser(rom=LOOP_ROM, patches=()):
+    return create_emulator(rom, patches)
+
+
+def legacy_step(parser):
+    """
+        the string based step the parser used before the dispatch table, kept here as the "before" number
+    """
+    pc = parser._state.pc
+    opcode = parser._memory.read(pc)
+    parser._state.cycles += parser._cycle_table[opcode]
+    opcode = '{0:#04x}'.format(opcode)
+    pc += 1
+    mnemon = parser._opcode_map.get(opcode, None).get('mnemon')
+    argument_sizes = parser._opcode_map.get(opcode, None).get('argument_sizes')
+    arguments = []
+    for argument_size in argument_sizes:
+        argument = b''
+        for byte_address in range(pc, pc + argument_size):
+            argument += struct.pack('B', parser._memory.read(byte_address))
+        arguments.append(parser._unpack_argument(argument))
+        pc += argument_size
+    parser._commands.execute_command(opcode, mnemon, *arguments)
+    if parser._state.are_there_any_hardware_interruprs():
+        parser._state.dequeue_hardware_interrupt()()
+
+
+def _run_legacy(parser, instructions):
+    for _ in range(instructions):
+        legacy_step(parser)
+    return instructions
+
+
+def _run_step(parser, instructions):
+    step = parser.step
+    for _ in range(instructions):
+        step()
+    return instructions
+
+
+def _run_block(parser, instructions):
+    executed = 0
+    step_block = parser.step_block
+    while executed < instructions:
+        executed += step_block()[0]
+    return executed
+
+
+def _run_loop(parser, instructions):
+    return parser.run(max_instructions=instructions).instructions
+
+
+# engine mode -> runner(parser, instructions) -> instructions actually executed
+ENGINE_MODES = collections.OrderedDict([
+    ('string', _run_legacy),
+    ('step', _run_step),
+    ('block', _run_block),
+    ('run', _run_loop),
+])
+
+
+def measure(workload, mode, instructions, repeat=3):
+    """
+        run workload for about instructions instructions in the given engine mode, best of repeat runs
+        :return: dict with instructions_per_second, cycles_per_second and peak_memory (bytes allocated while running)
+    """
+    runner = ENGINE_MODES[mode]
+
+    best = None  # (elapsed, instructions, cycles) of the fastest run
+    for _ in range(repeat):
+        parser = build_parser(workload.rom, workload.patches)
+        start_cycles = parser._state.cycles
+        start = time.perf_counter()
+        executed = runner(parser, instructions)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, executed, parser._state.cycles - start_cycles)
+    elapsed, executed, cycles = best
+
+    # tracemalloc slows everything down a lot, so memory gets its own shorter pass
+    parser = build_parser(workload.rom, workload.patches)
+    tracemalloc.start()
+    try:
+        runner(parser, max(instructions // 10, 1000))
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'instructions_per_second': executed / elapsed,
+        'cycles_per_second': cycles / elapsed,
+        'peak_memory': peak_memory,
+    }
+
+
+def calibrate(repeat=3):
+    """
+        dict lookups per second of plain python on this host, best of repeat. instruction rates divided by it
+        (relative_rate) can be compared between machines, absolute ones only on the machine that measured them
+    """
+    table = {value: (value + 1) & 0xFF for value in range(0x100)}
+    best = None
+    for _ in range(repeat):
+        value = 0
+        start = time.perf_counter()
+        for _ in range(CALIBRATION_LOOPS):
+            value = table[value]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return CALIBRATION_LOOPS / best
+
+
+def run_suite(instructions=100000, modes=None, workloads=None, repeat=3):
+    """
+        :return: {workload name: {engine mode: measurement}}, measurements get a relative_rate, see calibrate()
+    """
+    modes = modes or list(ENGINE_MODES)
+    calibration = calibrate(repeat)
+    results = collections.OrderedDict()
+    for workload in WORKLOADS:
+        if workloads and workload.name not in workloads:
+            continue
+        results[workload.name] = collections.OrderedDict((mode, measure(workload, mode, instructions, repeat)) for mode in modes)
+        for measurement in results[workload.name].values():
+            measurement['relative_rate'] = measurement['instructions_per_second'] / calibration
+    return results
+
+
+def _rates(measurement, reference):
+    """
+        :return: (reference rate, current rate), host independent ones when both sides have them
+    """
+    key = 'relative_rate' if 'relative_rate' in measurement and 'relative_rate' in reference else 'instructions_per_second'
+    return reference[key], measurement[key]
+
+
+def find_regressions(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+        compare instruction rates against a saved baseline, relative to the host's calibration when the baseline
+        has one, so a baseline saved on another machine still means something
+        :return: list of (workload, mode, baseline rate, current rate) that got more than threshold slower
+    """
+    regressions = []
+    for workload_name, modes in results.items():
+        for mode, measurement in modes.items():
+            reference = baseline.get('results', {}).get(workload_name, {}).get(mode)
+            if reference is None:
+                continue
+            reference_rate, current_rate = _rates(measurement, reference)
+            if current_rate < reference_rate * (1 - threshold):
+                regressions.append((workload_name, mode, reference_rate, current_rate))
+    return regressions
+
+
+def _host_description():
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'machine': platform.machine(), 'system': platform.system()}
+
+
+def save_baseline(results, path=BASELINE_FILE):
+    with open(path, 'w') as baseline_file:
+        json.dump({'host': _host_description(), 'results': results}, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write("\n")
+
+
+def load_baseline(path=BASELINE_FILE):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def print_results(results, baseline=None):
+    print("{0:<14} {1:<7} {2:>14} {3:>14} {4:>12} {5:>9}".format(
+        "workload", "mode", "instr/sec", "cycles/sec", "peak mem", "vs base"))
+    for workload_name, modes in results.items():
+        for mode, measurement in modes.items():
+            versus = ""
+            if baseline is not None:
+                reference = baseline.get('results', {}).get(workload_name, {}).get(mode)
+                if reference is not None:
+                    reference_rate, current_rate = _rates(measurement, reference)
+                    versus = "{0:.2f}x".format(current_rate / reference_rate)
+            print("{0:<14} {1:<7} {2:>14,.0f} {3:>14,.0f} {4:>12,} {5:>9}".format(
+                workload_name, mode, measurement['instructions_per_second'], measurement['cycles_per_second'],
+                measurement['peak_memory'], versus))
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="measure interpreter throughput on synthetic 6805 workloads")
+    argument_parser.add_argument("-n", "--instructions", type=int, default=100000, help="instructions per measurement")
+    argument_parser.add_argument("-m", "--mode", action="append", choices=list(ENGINE_MODES), help="engine modes to run")
+    argument_parser.add_argument("-w", "--workload", action="append", choices=[workload.name for workload in WORKLOADS])
+    argument_parser.add_argument("-r", "--repeat", type=int, default=3, help="keep the best of this many runs")
+    argument_parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline json file")
+    argument_parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    argument_parser.add_argument("--check", action="store_true", help="exit with 1 when a mode regressed")
+    argument_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    options = argument_parser.parse_args()
+
+    results = run_suite(options.instructions, options.mode, options.workload, options.repeat)
+    baseline = load_baseline(options.baseline) if os.path.exists(options.baseline) else None
+    print_results(results, baseline)
+
+    if options.save:
+        save_baseline(results, options.baseline)
+    if options.check:
+        if baseline is None:
+            sys.exit("no baseline at {}".format(options.baseline))
+        regressions = find_regressions(results, baseline, options.threshold)
+        for workload_name, mode, reference_rate, current_rate in regressions:
+            print("REGRESSION {0} {1}: {2:.4g} -> {3:.4g}, {4:.0%} slower".format(
+                workload_name, mode, reference_rate, current_rate, 1 - current_rate / reference_rate))
+        if regressions:
+            sys.exit(1)
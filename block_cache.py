@@ -0,0 +1,141 @@
+# mnemonics that end a basic block, anything that can move pc somewhere other than the next instruction
+BLOCK_TERMINATORS = frozenset([
+    'BRA', 'BRN', 'BHI', 'BLS', 'BCC', 'BCS', 'BHS', 'BLO', 'BNE', 'BEQ', 'BHCC', 'BHCS',
+    'BPL', 'BMI', 'BMC', 'BMS', 'BIL', 'BIH', 'BSR', 'BRSET', 'BRCLR',
+    'JMP', 'JSR', 'RTS', 'RTI', 'SWI', 'WAIT', 'STOP',
+])
+
+# mnemonics that write memory, the only ones that can overwrite code further on in their own block
+MEMORY_WRITERS = frozenset([
+    'STA', 'STX', 'CLR', 'COM', 'NEG', 'INC', 'DEC', 'LSL', 'LSR', 'ASR', 'ROL', 'ROR', 'BSET', 'BCLR',
+])
+
+
+class BasicBlock(object):
+
+    def __init__(self, start, end, run, instructions, cycles):
+        """
+            start - address of the first opcode
+            end - address right after the last byte of the block
+            run - compiled callable, returns (instructions executed, cycles spent)
+        """
+        self.start = start
+        self.end = end
+        self.run = run
+        self.instructions = instructions
+        self.cycles = cycles
+
+    def covers(self, address):
+        return self.start <= address < self.end
+
+
+class BlockCache(object):
+
+    def __init__(self, parser, max_block_size=64):
+        """
+            translates straight line 6805 code into python callables and caches them by entry pc.
+            every instruction in a block still runs through its Commands method, the operands are just
+            decoded once and baked into the generated code.
+            max_block_size - upper bound on instructions per block
+        """
+        self._parser = parser
+        self._state = parser._state
+        self._memory = parser._memory
+        self._max_block_size = max_block_size
+        self._blocks = {}
+        self.generation = 0  # goes up whenever compiled code gets overwritten, running blocks check it after stores
+        self._memory.set_code_watcher(self)
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def lookup(self, pc):
+        block = self._blocks.get(pc)
+        if block is None:
+            block = self._translate(pc)
+            self._blocks[pc] = block
+            self._memory.watch_code(block.start, block.end)
+        return block
+
+    def invalidate(self, address):
+        """
+            drop every block that covers address, called by Memory.write when code gets overwritten
+        """
+        self.generation += 1
+        stale = [block for block in self._blocks.values() if block.covers(address)]
+        for block in stale:
+            del self._blocks[block.start]
+            self._memory.unwatch_code(block.start, block.end)
+        for block in self._blocks.values():  # blocks may overlap, give the survivors their bytes back
+            if any(block.start < stale_block.end and stale_block.start < block.end for stale_block in stale):
+                self._memory.watch_code(block.start, block.end)
+
+    def flush(self):
+        self.generation += 1
+        for block in self._blocks.values():
+            self._memory.unwatch_code(block.start, block.end)
+        self._blocks.clear()
+
+    def _translate(self, start):
+        parser = self._parser
+        namespace = {'state': self._state, 'cache': self}
+        lines = ["def block():", "    generation = cache.generation"]
+        pc = start
+        instructions = 0
+        cycles = 0
+
+        while instructions < self._max_block_size and pc <= self._memory.address_size:
+            opcode, info, arguments, size = parser.decode(pc)
+            if info is None:
+                if instructions == 0:  # let the dispatch table raise for us
+                    namespace['illegal'] = parser._dispatch_table[opcode]
+                    lines.append("    illegal({0})".format(pc))
+                break
+            mnemon = info.mnemon
+            command_name = "c{0}".format(instructions)
+            namespace[command_name] = self._parser._commands.get_handler(opcode, mnemon)
+            lines.append("    {0}({1})".format(command_name, ", ".join(hex(argument) for argument in arguments)))
+            pc += size
+            instructions += 1
+            cycles += info.cycles
+            if mnemon.upper() in BLOCK_TERMINATORS:
+                break
+            # side exit, in case the instruction did not leave pc where straight line decoding expects it,
+            # or a store overwrote code, maybe the rest of this very block
+            if mnemon in MEMORY_WRITERS:
+                lines.append("    if state._pc != {0} or cache.generation != generation: return {1}, {2}".format(
+                    pc, instructions, cycles))
+            else:
+                lines.append("    if state._pc != {0}: return {1}, {2}".format(pc, instructions, cycles))
+
+        lines.append("    return {0}, {1}".format(instructions, cycles))
+        source = "\n".join(lines)
+        exec(compile(source, "<block {0:#06x}>".format(start), "exec"), namespace)
+        end = min(max(pc, start + 1), self._memory.address_size + 1)
+        return BasicBlock(start, end, namespace['block'], instructions, cycles)
+
+
+def test_self_modifying_block():
+    from emulator import create_emulator
+    rom = bytes([
+        0xB7, 0x06,  # 0000 STA $06, overwrites the operand of the LDA below
+        0x9D,        # 0002 NOP
+        0x9D,        # 0003 NOP
+        0x9D,        # 0004 NOP
+        0xA6, 0x00,  # 0005 LDA #$00
+        0x20, 0xFE,  # 0007 BRA *
+    ])
+    stepped = create_emulator(rom)
+    blocked = create_emulator(rom)
+    for parser in (stepped, blocked):
+        parser.registers.a = 0x01
+    for _ in range(5):
+        stepped.step()
+    blocked.step_block()
+    blocked.step_block()
+    assert(stepped.registers.a == blocked.registers.a == 0x01)
+
+
+if __name__ == "__main__":
+
+    test_self_modifying_block()
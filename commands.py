@@ -1,9 +1,18 @@
+import functools
+
+from flag_tables import ADD_FLAGS, ADD_TABLE, SUB_FLAGS, SUB_TABLE
 from memory import Memory
-from registers import Registers
+from registers import CCR_C, CCR_H, CCR_I, CCR_N, CCR_Z, HALT_IDLE, HALT_STOP, HALT_WAIT, Registers
+from scheduler import SWI_VECTOR
 
 
 class Commands(object):
 
+    # commands that need the raw opcode byte to figure out their addressing mode / bit number
+    _opcode_aware_commands = ('bset', 'bclr', 'brset', 'brclr', 'jsr', 'jmp', 'adc', 'add', 'sub', 'sbc', 'neg',
+                              'lda', 'ldx', 'sta', 'stx', 'cmp', 'cpx', 'and', 'ora', 'eor', 'bit',
+                              'clr', 'inc', 'dec', 'tst', 'com', 'asl', 'asr', 'lsl', 'lsr', 'rol', 'ror')
+
     def __init__(self, state: Registers, memory: Memory):
         self._state = state
         self._memory = memory
@@ -14,177 +23,124 @@ class Commands(object):
     def execute_command(self, opcode, command, *args):
         command = command.lower()
         if command == 'and':
-            self.logical_and(*args)
-        elif command in ['bset', 'bclr', 'brset', 'brclear', 'jsr', 'jmp', 'adc', 'add']:
+            self.logical_and(int(opcode, 16), *args)
+        elif command in self._opcode_aware_commands:
             method = getattr(self, command)
             method(int(opcode, 16), *args)
         else:
             method = getattr(self, command)
             method(*args)
 
-    def nop(self):
-        self._state.pc += 1
+    def get_handler(self, opcode, command):
+        """
+            resolve a mnemonic into a bound method once, so callers can cache it instead of going
+            through execute_command on every instruction
+            :param opcode: int opcode byte
+            :param command: mnemonic as it appears in the opcode map
+            :return: callable that only takes the decoded operands
+        """
+        name, opcode_aware = self.handler_spec(command)
+        method = getattr(self, name)
+        if opcode_aware:
+            return functools.partial(method, opcode)
+        return method
 
-    def __update_flags_for_add_op(self, target, value):
-        if self.__valid_register_size(target) and self.__valid_register_size(value):
-            result = (target + value) % (0xFF+1)
-            half_result = result & 0x0F
-            half_target = target & 0x0F
+    @classmethod
+    def handler_spec(cls, command):
+        """
+            the instance independent half of get_handler
+            :return: (method name, True if the method takes the opcode first)
+        """
+        command = command.lower()
+        return 'logical_and' if command == 'and' else command, command in cls._opcode_aware_commands
 
-            c = 1 if result < target else 0
-            h = 1 if half_result < half_target else 0
-            n = (result & 0x80) >> 7
-            z = 0 if result else 1
+    def _effective_address(self, opcode, operand=0):
+        """
+            work out where a memory operand lives and how long the instruction is,
+            on the 6805 the addressing mode is the high nibble of the opcode
+            :return: (address, instruction size in bytes)
+        """
+        mode = opcode >> 4
+        if mode == 0x3 or mode == 0xB:  # DIR dd
+            return operand, 2
+        if mode == 0xC:  # EXT hh ll
+            return operand, 3
+        if mode == 0xD:  # IX2 ee ff - x plus a 16 bit offset
+            return (operand + self._state.x) & self._address_size, 3
+        if mode == 0x6 or mode == 0xE:  # IX1 ff - x plus an 8 bit offset, reaches up to 0x01fe
+            return operand + self._state.x, 2
+        if mode == 0x7 or mode == 0xF:  # IX - just x
+            return self._state.x, 1
+        raise ValueError("opcode {0:#04x} has no memory operand".format(opcode))
 
-            self._state.update_flags({'C': c, 'H': h, 'N': n, 'Z': z})
+    def _read_operand(self, opcode, operand=0):
+        """
+            value of a source operand, immediate operands are the value itself
+            :return: (value, instruction size in bytes)
+        """
+        if opcode >> 4 == 0xA:  # IMM ii
+            return operand, 2
+        address, size = self._effective_address(opcode, operand)
+        return self._memory.read(address), size
 
-    def __valid_register_size(self, value):
-        return self._state.is_valid_general_register_value(value)
+    def nop(self):
+        self._state.pc += 1
 
     def _get_flag_change(self, before, after, wrap_type):
-        bits_in_general_reg = len(bin(self._state.general_register_size)) - 2
-        negative = 1 if after >> (bits_in_general_reg - 1) else 0
-        zero = 0 if after else 1
+        """
+            N, Z and C for an 8 bit result, packed the way update_flags takes them
+        """
+        flags = ((after & 0x80) >> 5) | (0 if after else CCR_Z)
         if wrap_type == "underflow":
-            carry = 1 if after > before else 0
+            carry = after > before
         else:
-            carry = 1 if after < before else 0
-        return {'N': negative, 'Z': zero, 'C': carry}
+            carry = after < before
+        return flags | CCR_C if carry else flags
 
-    def _add(self, value):
+    def _add(self, value, carry=0):
         """
-            add to accumulator
+            add to accumulator, flags and result come from the shared ADD_TABLE
         """
-        self.__update_flags_for_add_op(self._state.a, value)
-        self._state.a = (self._state.a + value) % (self._state.general_register_size+1)
-
-    def add(self, opcode, value):
-
-        if opcode == 0xAB:  # IMM ii
-            self._state.pc += 2
-        if opcode == 0xBB:  # DIR dd
-            value = self._memory.read(value)
-            self._state.pc += 2
-        if opcode == 0xCB:  # EXT hh kk
-            value = self._memory.read(value)
-            self._state.pc += 3
-        if opcode == 0xDB:  # IX2 ee ff
-            effective_address = value + self._state.x
-            value = self._memory.read(effective_address)
-            self._state.pc += 3
-        if opcode == 0xEB:  # IX1 ff
-            effective_address = value + self._state.x
-            value = self._memory.read(effective_address)
-            self._state.pc += 2
-        if opcode == 0xFB:  # IX
-            value = self._memory.read(self._state.x)
-            self._state.pc += 1
+        entry = ADD_TABLE[(carry << 16) | (self._state.a << 8) | value]
+        self._state.update_flags(ADD_FLAGS, entry >> 8)
+        self._state.a = entry & 0xFF
 
+    def add(self, opcode, operand=0):
+        """
+            add to accumulator
+        """
+        value, size = self._read_operand(opcode, operand)
         self._add(value)
+        self._state.pc += size
 
-    def adc(self, opcode, value=None):
+    def adc(self, opcode, operand=0):
         """
             add to the accumulator with carry
         """
-        carry = self._state.ccr.get('C')
-        self._add(carry)
-
-        if opcode == 0xA9:  # IMM ii
-            self._state.pc += 2
-
-        if opcode == 0xB9:  #DIR dd - direct addressing
-            value = self._memory.read(value)
-            self._state.pc += 2
+        value, size = self._read_operand(opcode, operand)
+        self._add(value, self._state.ccr & CCR_C)
+        self._state.pc += size
 
-        if opcode == 0xC9:  # EXT hh ll - extended direct addressing
-            value = self._memory.read(value)
-            self._state.pc += 3 # one more because we have an extra byte in ext
-
-        if opcode == 0xD9:  # IX2 ee ff - indexed 16 bit
-            effective_address = self._state.x + value
-            value = self._memory.read(effective_address)
-            self._state.pc += 3
-
-        if opcode == 0xE9:  # IX1 ff - indexed 8 bit
-            effective_address = self._state.x + value
-            value = self._memory.read(effective_address)
-            self._state.pc += 2
-
-        if opcode == 0xF9:  # IX - indexed no offset
-            effective_address = self._state.x
-            value = self._memory.read(effective_address)
-            self._state.pc += 1  # just opcode baby
-
-        self._add(value)
-
-    def _sub(self, value):
-        bits_in_general_reg = len(bin(self._state.general_register_size)) - 2
-        result = (self._state.a - value) % (self._state.general_register_size+1)
-        flags = self._get_flag_change(value, result, "underflow")
-        negative, zero, carry = flags['N'], flags['Z'], flags['C']
-        self._state.update_flags({'N': negative, 'Z': zero, 'C': carry})
-        self._state.a = result
+    def _sub(self, value, carry=0):
+        entry = SUB_TABLE[(carry << 16) | (self._state.a << 8) | value]
+        self._state.update_flags(SUB_FLAGS, entry >> 8)
+        self._state.a = entry & 0xFF
 
-    def sub(self, opcode, value):
+    def sub(self, opcode, operand=0):
         """
             subtract from accumulator
         """
-        if opcode == 0xA0:  # IMM ii
-            self._state.pc += 2
-        if opcode == 0xB0:  # DIR dd
-            value = self._memory.read(value)
-            self._state.pc += 2
-        if opcode == 0xC0:  # EXT hh kk
-            value = self._memory.read(value)
-            self._state.pc += 3
-        if opcode == 0xD0:  # IX2 ee ff
-            effective_address = value + self._state.x
-            value = self._memory.read(effective_address)
-            self._state.pc += 3
-        if opcode == 0xE0:  # IX1 ff
-            effective_address = value + self._state.x
-            value = self._memory.read(effective_address)
-            self._state.pc += 2
-        if opcode == 0xF0:  # IX
-            value = self._memory.read(self._state.x)
-            self._state.pc += 1
-
+        value, size = self._read_operand(opcode, operand)
         self._sub(value)
+        self._state.pc += size
 
-    def sbc(self, opcode, value):
+    def sbc(self, opcode, operand=0):
         """
             suntract from accumulator with borrow
         """
-
-        if opcode == 0xA2:  # IMM ii
-            self._state.pc += 2
-
-        if opcode == 0xB2:  #DIR dd - direct addressing
-            value = self._memory.read(value)
-            self._state.pc += 2
-
-        if opcode == 0xC2:  # EXT hh ll - extended direct addressing
-            value = self._memory.read(value)
-            self._state.pc += 3 # one more because we have an extra byte in ext
-
-        if opcode == 0xD2:  # IX2 ee ff - indexed 16 bit
-            effective_address = self._state.x + value
-            value = self._memory.read(effective_address)
-            self._state.pc += 3
-
-        if opcode == 0xE2:  # IX1 ff - indexed 8 bit
-            effective_address = self._state.x + value
-            value = self._memory.read(effective_address)
-            self._state.pc += 2
-
-        if opcode == 0xF2:  # IX - indexed no offset
-            effective_address = self._state.x
-            value = self._memory.read(effective_address)
-            self._state.pc += 1  # just opcode baby
-
-        current_carry = self._state.ccr.get('C')
-        self._sub(value)
-        self._sub(current_carry)
+        value, size = self._read_operand(opcode, operand)
+        self._sub(value, self._state.ccr & CCR_C)
+        self._state.pc += size
 
     def mul(self):
         """
@@ -196,37 +152,18 @@ class Commands(object):
 
     def _neg(self, value):
         result = value ^ 0xFF % (self._state.general_register_size+1)
-        bits_in_general_reg = len(bin(self._state.general_register_size)) - 2
-        # negative = 1 if result >> (bits_in_general_reg - 1) else 0
-        # zero = 0 if result else 1
-        # carry = 1 if result > value else 0
         flags = self._get_flag_change(value, result, "overflow")
-        negative, zero, carry = flags['N'], flags['Z'], flags['C']
-        self._state.update_flags({'N': negative, 'Z': zero, 'C': carry})
+        self._state.update_flags(CCR_N | CCR_Z | CCR_C, flags)
         return result
 
-    def neg(self, opcode, operand):
+    def neg(self, opcode, operand=0):
         """
             negate a memory location
         """
-        value = None
-        address = operand
-        if opcode == 0xB2:  #DIR dd - direct addressing
-            value = self._memory.read(operand)
-            self._state.pc += 2
-
-        if opcode == 0xE2:  # IX1 ff - indexed 8 bit
-            address = self._state.x + operand
-            value = self._memory.read(address)
-            self._state.pc += 2
-
-        if opcode == 0xF2:  # IX - indexed no offset
-            address = self._state.x
-            value = self._memory.read(address)
-            self._state.pc += 1  # just opcode baby
-
-        value = self._neg(value)
+        address, size = self._effective_address(opcode, operand)
+        value = self._neg(self._memory.read(address))
         self._memory.write(address, value)
+        self._state.pc += size
 
 
     def nega(self):
@@ -246,50 +183,43 @@ class Commands(object):
         self._state.x = value
         self._state.pc += 1
 
-    def lda(self, address):
+    def lda(self, opcode, operand=0):
         """
             load the accumulator
         """
-        bits_in_general_reg = len(bin(self._state.general_register_size)) - 2
-        self._state.a = self._memory.read(address)
-        result = self._state.a
-        flags = self._get_flag_change(result, result, "overflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
-        self._state.pc += 2
+        value, size = self._read_operand(opcode, operand)
+        self._state.a = value
+        self._state.set_nz(value)
+        self._state.pc += size
 
-    def ldx(self, address):
+    def ldx(self, opcode, operand=0):
         """
             load the index register
         """
-        self._memory.write(address, self._state.x)
-        result = self._state.x
-        flags = self._get_flag_change(result, result, "overflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
-        self._state.pc += 2
+        value, size = self._read_operand(opcode, operand)
+        self._state.x = value
+        self._state.set_nz(value)
+        self._state.pc += size
 
-    def sta(self, address):
+    def sta(self, opcode, operand=0):
         """
             store the accumulator
         """
+        address, size = self._effective_address(opcode, operand)
         self._memory.write(address, self._state.a)
         result = self._state.a
-        flags = self._get_flag_change(result, result, "overflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
-        self._state.a += 2
+        self._state.set_nz(result)
+        self._state.pc += size
 
-    def stx(self, address):
+    def stx(self, opcode, operand=0):
         """
             store the index register
         """
+        address, size = self._effective_address(opcode, operand)
         self._memory.write(address, self._state.x)
         result = self._state.x
-        flags = self._get_flag_change(result, result, "overflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
-        self._state.pc += 2
+        self._state.set_nz(result)
+        self._state.pc += size
 
     def tax(self):
         """
@@ -305,20 +235,21 @@ class Commands(object):
         self._state.a = self._state.x
         self._state.pc += 1
 
-    def clr(self, address):
+    def clr(self, opcode, operand=0):
         """
             clear a memory location
         """
+        address, size = self._effective_address(opcode, operand)
         self._memory.write(address, 0x0)
-        self._state.update_flags({'N': 0, 'Z': 1})
-        self._state.pc += 2
+        self._state.update_flags(CCR_N | CCR_Z, CCR_Z)
+        self._state.pc += size
 
     def clra(self):
         """
             clear the accumulator
         """
         self._state.a = 0x0
-        self._state.update_flags({'N': 0, 'Z': 1})
+        self._state.update_flags(CCR_N | CCR_Z, CCR_Z)
         self._state.pc += 1
 
     def clrx(self):
@@ -326,29 +257,26 @@ class Commands(object):
             clear the index register
         """
         self._state.x = 0x0
-        self._state.update_flags({'N': 0, 'Z': 1})
+        self._state.update_flags(CCR_N | CCR_Z, CCR_Z)
         self._state.pc += 1
 
-    def inc(self, address):
+    def inc(self, opcode, operand=0):
         """
             increment a memory location by one
         """
+        address, size = self._effective_address(opcode, operand)
         value = self._memory.read(address)
         result = (value + 1) & 0xFF
-        flags = self._get_flag_change(result, result, "overflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
+        self._state.set_nz(result)
         self._memory.write(address, result)
-        self._state.pc += 2
+        self._state.pc += size
 
     def inca(self):
         """
             increment the acuumulator by one
         """
-        result = self._state.a + 1
-        flags = self._get_flag_change(result, result, "overflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
+        result = (self._state.a + 1) & 0xFF
+        self._state.set_nz(result)
         self._state.a = result
         self._state.pc += 1
 
@@ -356,33 +284,28 @@ class Commands(object):
         """
             increment the index register by one
         """
-        result = self._state.x + 1
-        flags = self._get_flag_change(result, result, "overflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
+        result = (self._state.x + 1) & 0xFF
+        self._state.set_nz(result)
         self._state.x = result
         self._state.pc += 1
 
-    def dec(self, address):
+    def dec(self, opcode, operand=0):
         """
             decrement a memory location by one
         """
+        address, size = self._effective_address(opcode, operand)
         value = self._memory.read(address)
         result = (value - 1) & 0xFF
-        flags = self._get_flag_change(result, result, "underflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
+        self._state.set_nz(result)
         self._memory.write(address, result)
-        self._state.pc += 2
+        self._state.pc += size
 
     def deca(self):
         """
             decrement accumulator by one
         """
-        result = self._state.a - 1
-        flags = self._get_flag_change(result, result, "underflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
+        result = (self._state.a - 1) & 0xFF
+        self._state.set_nz(result)
         self._state.a = result
         self._state.pc += 1
 
@@ -390,65 +313,59 @@ class Commands(object):
         """
             decrement index register by one
         """
-        result = self._state.x - 1
-        flags = self._get_flag_change(result, result, "underflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
+        result = (self._state.x - 1) & 0xFF
+        self._state.set_nz(result)
         self._state.x = result
         self._state.pc += 1
 
-    def logical_and(self, value):
+    def logical_and(self, opcode, operand=0):
         """
             logical and of the accumulator and operand
         """
+        value, size = self._read_operand(opcode, operand)
         self._state.a &= value
-        flags = self._get_flag_change(self._state.a, self._state.a, "underflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
-        self._state.pc += 2
+        self._state.set_nz(self._state.a)
+        self._state.pc += size
 
-    def ora(self, value):
+    def ora(self, opcode, operand=0):
         """
             logical or of the accumulator and operand
         """
+        value, size = self._read_operand(opcode, operand)
         self._state.a |= value
-        flags = self._get_flag_change(self._state.a, self._state.a, "underflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
-        self._state.pc += 2
+        self._state.set_nz(self._state.a)
+        self._state.pc += size
 
-    def eor(self, value):
+    def eor(self, opcode, operand=0):
         """
             exclusivve or of the accumulator and an operand
         """
+        value, size = self._read_operand(opcode, operand)
         self._state.a ^= value
-        flags = self._get_flag_change(self._state.a, self._state.a, "underflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'N': negative, 'Z': zero})
-        self._state.pc += 2
+        self._state.set_nz(self._state.a)
+        self._state.pc += size
 
     def _com(self, target, size):
         target = (~target) % size  # artifacts of 2's compliment and dynamic sizes(meh)
-        carry = 1  # according to the doc its always turned into 1 , makes sense i guess...
-        flags = self._get_flag_change(self._state.a, self._state.a, "underflow")
-        negative, zero = flags['N'], flags['Z']
-        self._state.update_flags({'C': carry, 'N': negative, 'Z': zero})
+        self._state.set_nz(self._state.a)
+        self._state.set_flag(CCR_C)  # according to the doc its always turned into 1 , makes sense i guess...
         return target
 
-    def com(self, address):
+    def com(self, opcode, operand=0):
         """
             get one's complement of a memory location (the 'not' bitwise operation)
         """
+        address, size = self._effective_address(opcode, operand)
         value = self._memory.read(address)
-        value = self._com(value, self._address_size)
+        value = self._com(value, self._register_size+1)
         self._memory.write(address, value)
-        self._state.pc += 2
+        self._state.pc += size
 
     def coma(self):
         """
             get ones complement of the accumulator
         """
-        value = self._com(self._state.a, self._register_size)
+        value = self._com(self._state.a, self._register_size+1)
         self._state.a = value
         self._state.pc += 1
 
@@ -456,19 +373,19 @@ class Commands(object):
         """
             get ones complement of the index register
         """
-        value = self._com(self._state.a, self._register_size)
+        value = self._com(self._state.a, self._register_size+1)
         self._state.x = value
         self._state.pc += 1
 
-    def asl(self, address):
+    def asl(self, opcode, operand=0):
         """
             arithmetically shift a memory location left by one bit
         """
-        if self._state._is_valid_address(address):
-            value = self._memory.read(address)
-            value = self._arithmetical_left_shift(value)
-            self._memory.write(address, value)
-            self._state.pc += 2
+        address, size = self._effective_address(opcode, operand)
+        value = self._memory.read(address)
+        value = self._arithmetical_left_shift(value)
+        self._memory.write(address, value)
+        self._state.pc += size
 
     def asla(self):
         """
@@ -486,15 +403,15 @@ class Commands(object):
         self._state.x = self._arithmetical_left_shift(value)
         self._state.pc += 1
 
-    def asr(self, address):
+    def asr(self, opcode, operand=0):
         """
             arithmetically shift a memory location right by one bit
         """
-        if self._state._is_valid_address(address):
-            value = self._memory.read(address)
-            value = self._arithmetic_right_shift(value)
-            self._memory.write(address, value)
-            self._state.pc += 2
+        address, size = self._effective_address(opcode, operand)
+        value = self._memory.read(address)
+        value = self._arithmetic_right_shift(value)
+        self._memory.write(address, value)
+        self._state.pc += size
 
     def asra(self):
         """
@@ -512,15 +429,15 @@ class Commands(object):
         self._state.x = self._arithmetic_right_shift(value)
         self._state.pc += 1
 
-    def lsl(self, address):
+    def lsl(self, opcode, operand=0):
         """
             logically shift a memory location left by one bit
         """
-        if self._state._is_valid_address(address):
-            value = self._memory.read(address)
-            value = self._logical_left_shift(value)
-            self._memory.write(address, value)
-            self._state.pc += 2
+        address, size = self._effective_address(opcode, operand)
+        value = self._memory.read(address)
+        value = self._logical_left_shift(value)
+        self._memory.write(address, value)
+        self._state.pc += size
 
     def lsla(self):
         """
@@ -538,15 +455,15 @@ class Commands(object):
         self._state.x = self._logical_left_shift(value)
         self._state.pc += 1
 
-    def lsr(self, address):
+    def lsr(self, opcode, operand=0):
         """
             LSR logically shift a memory location right by one bit
         """
-        if self._state._is_valid_address(address):
-            value = self._memory.read(address)
-            value = self._logical_right_shift(value)
-            self._memory.write(address, value)
-            self._state.pc += 2
+        address, size = self._effective_address(opcode, operand)
+        value = self._memory.read(address)
+        value = self._logical_right_shift(value)
+        self._memory.write(address, value)
+        self._state.pc += size
 
     def lsra(self):
         """
@@ -564,14 +481,15 @@ class Commands(object):
         self._state.x = self._logical_right_shift(value)
         self._state.pc += 1
 
-    def rol(self, address):
+    def rol(self, opcode, operand=0):
         """
             ROL rotate a memory location left by one bit
         """
+        address, size = self._effective_address(opcode, operand)
         value = self._memory.read(address)
         value = self._rol(value, 1)
         self._memory.write(address, value)
-        self._state.pc += 2
+        self._state.pc += size
 
     def rola(self):
         """
@@ -587,14 +505,15 @@ class Commands(object):
         self._state.x = self._rol(self._state.x, 1)
         self._state.pc += 1
 
-    def ror(self, address):
+    def ror(self, opcode, operand=0):
         """
             ROR rotate a memory location right by one bit
         """
+        address, size = self._effective_address(opcode, operand)
         value = self._memory.read(address)
         value = self._ror(value, 1)
         self._memory.write(address, value)
-        self._state.pc += 2
+        self._state.pc += size
 
     def rora(self):
         """
@@ -610,34 +529,38 @@ class Commands(object):
         self._state.x = self._ror(self._state.x, 1)
         self._state.pc += 1
 
-    def bit(self):
+    def bit(self, opcode, operand=0):
         """
-            BIT bit test the accumulator and set the N or Z flags
+            BIT bit test the accumulator against an operand and set the N or Z flags
         """
-        self._test(self._state.a)
-        self._state.pc += 1
+        value, size = self._read_operand(opcode, operand)
+        self._test(self._state.a & value)
+        self._state.pc += size
 
-    def cmp(self, value):
+    def cmp(self, opcode, operand=0):
         """
             CMP compare an operand to the accumulator
         """
+        value, size = self._read_operand(opcode, operand)
         self._cmp(self._state.a, value)
-        self._state.pc += 2
+        self._state.pc += size
 
-    def cpx(self, value):
+    def cpx(self, opcode, operand=0):
         """
             CPX compare an operand to the index register
         """
+        value, size = self._read_operand(opcode, operand)
         self._cmp(self._state.x, value)
-        self._state.pc += 2
+        self._state.pc += size
 
-    def tst(self, address):
+    def tst(self, opcode, operand=0):
         """
             TST test a memory location and set the N or Z flags
         """
+        address, size = self._effective_address(opcode, operand)
         value = self._memory.read(address)
         self._test(value)
-        self._state.pc += 2
+        self._state.pc += size
 
     def tsta(self):
         """
@@ -658,121 +581,85 @@ class Commands(object):
         """
             BCC branch if carry clear (C = 0)
         """
-        if self._state.ccr.get('C') == 0:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(not self._state.ccr & CCR_C, address_offset)
 
     def bcs(self, address_offset):
         """
             BCS branch if carry set (C = 1)
         """
-        if self._state.ccr.get('C') == 1:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(self._state.ccr & CCR_C, address_offset)
 
     def beq(self, address_offset):
         """
-            BEQ branch if equal (Z = 0)
+            BEQ branch if equal (Z = 1)
         """
-        if self._state.ccr.get('Z') == 0:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(self._state.ccr & CCR_Z, address_offset)
 
     def bne(self, address_offset):
         """
-            BNE branch if not equal (Z = 1)
+            BNE branch if not equal (Z = 0)
         """
-        if self._state.ccr.get('Z') == 1:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(not self._state.ccr & CCR_Z, address_offset)
 
     def bhcc(self, address_offset):
         """
             branch if half carry clear (H = 0)
         """
-        if self._state.ccr.get('H') == 0:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(not self._state.ccr & CCR_H, address_offset)
 
     def bhcs(self, address_offset):
         """
             branch if half carry set (H = 1)
         """
-        if self._state.ccr.get('H') == 1:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(self._state.ccr & CCR_H, address_offset)
 
     def bhi(self, address_offset):
         """
             branch if higher (C or Z = 0)
         """
-        c_flag = self._state.ccr.get('C')
-        z_flag = self._state.ccr.get('Z')
-
-        if c_flag == 0 or z_flag == 0:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(not self._state.ccr & (CCR_C | CCR_Z), address_offset)
 
     def bhs(self, address_offset):
         """
-            branch if half carry is set (H =1)
+            branch if higher or same (C = 0), same thing as bcc
         """
-        if self._state.ccr.get('H') == 1:
-            self._branch(address_offset)
-
-        self._state.pc += 2
+        self._branch_if(not self._state.ccr & CCR_C, address_offset)
 
     def bls(self, address_offset):
         """
             BLS branch if lower or same (C or Z = 1)
         """
-        c_flag = self._state.ccr.get('C')
-        z_flag = self._state.ccr.get('Z')
-
-        if c_flag or z_flag:
-            self._branch(address_offset)
-
-        self._state.pc += 2
+        self._branch_if(self._state.ccr & (CCR_C | CCR_Z), address_offset)
 
     def blo(self, address_offset):
         """
             BLO branch if lower (C = 1)
         """
-        if self._state.ccr.get('C') == 1:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(self._state.ccr & CCR_C, address_offset)
 
     def bmi(self, address_offset):
         """
             branch if minus (N = 1)
         """
-        if self._state.ccr.get('N') == 1:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(self._state.ccr & CCR_N, address_offset)
 
     def bpl(self, address_offset):
         """
             branch if plus (N = 0)
         """
-        if self._state.ccr.get('N') == 0:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(not self._state.ccr & CCR_N, address_offset)
 
     def bmc(self, address_offset):
         """
             BMC branch if interrupts are not masted (I = 0)
         """
-        if self._state.ccr.get('I') == 0:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(not self._state.ccr & CCR_I, address_offset)
 
     def bms(self, address_offset):
         """
             BMS branch if interrupts are masked (I = 1)
         """
-        if self._state.ccr.get('I') == 1:
-            self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(self._state.ccr & CCR_I, address_offset)
 
     # special branches
 
@@ -781,36 +668,35 @@ class Commands(object):
             branch if IRQ pin is high
         """
         #fixme implement
-        self._state.pc += 2
+        self._branch_if(False, address_offset)
 
     def bil(self, address_offset):
         """
             branch if IRQ pin is low
         """
         # fixme implement
-        self._state.pc += 2
+        self._branch_if(False, address_offset)
 
     def bra(self, address_offset):
         """
             branch always
         """
-        self._branch(address_offset)
-        self._state.pc += 2
+        self._branch_if(True, address_offset)
 
     def brn(self, address_offset):
         """
             branch never ( another nop? )
         """
         # todo - is this another nop?
-        self._state.pc += 2
+        self._branch_if(False, address_offset)
 
     def bsr(self, address_offset):
         """
             branch to subroutine and save return address on stack
         """
-        self._state.push(self._state.pc)
-        self._state._sp -= 1
-        self._state.pc += 2
+        return_address = (self._state.pc + 2) & self._address_size
+        self._state.push(return_address)
+        self._state.pc = return_address
         self._branch(address_offset)
 
 
@@ -820,7 +706,7 @@ class Commands(object):
         """
             clear the designated memory bit
         """
-        bit = (opcode & 0xE) / 2
+        bit = (opcode & 0xE) >> 1
         value = self._memory.read(address)
         mask = (1 << bit) ^ 0xFF
         value &= mask
@@ -831,86 +717,51 @@ class Commands(object):
         """
             set the designated memory bit
         """
-        bit = (opcode & 0xE) / 2
+        bit = (opcode & 0xE) >> 1
         value = self._memory.read(address)
         mask = (1 << bit)
         value |= mask
         self._memory.write(address, value)
         self._state.pc += 2
 
-    def brclr(self, opcode, value, address):
+    def brclr(self, opcode, address, address_offset):
         """
             branch if the designated memory bit is clear
         """
-        bit = (opcode & 0x0E) / 2
+        bit = (opcode & 0x0E) >> 1
         mask = (1 << bit)
-        address = self._state.pc + address if (value & mask) == 0 else self._state.pc
-        self._state.pc = address
+        value = self._memory.read(address)
+        self._branch_if((value & mask) == 0, address_offset, 3)
+        if address_offset == 0xFD and not value & mask and not self._memory.has_read_handler(address):
+            self._idle()  # BRCLR n,address,* - polling a bit only an interrupt can flip
 
-    def brset(self, opcode, value, address_offset):
+    def brset(self, opcode, address, address_offset):
         """
             branch if the designated memory bit is set
         """
-        bit = (opcode & 0x0E) / 2
-        address = self._state.pc + address_offset
+        bit = (opcode & 0x0E) >> 1
         mask = (1 << bit)
-        address = self._state.pc + address_offset if (value & mask) != 0 else self._state.pc
-        self._state.pc = address
+        value = self._memory.read(address)
+        self._branch_if((value & mask) != 0, address_offset, 3)
+        if address_offset == 0xFD and value & mask and not self._memory.has_read_handler(address):
+            self._idle()
 
     # jumps and returns
     def jmp(self, opcode, address=0x00):
         """
             JMP jumpt to specified address
         """
-
-        self._state.push(self._state.pc) # save the return address hun , its dangerous outside ;)
-
-        if opcode == 0xfc:  # indexed no offser (first bytes is 0x00 second is from the index reg)
-            self._state.pc += 1 # just the instruction , no params
-            self._state.pc = self._state.x
-
-        if opcode == 0xec:  # indexed 8bit offset (
-            self._state.pc += 2  # opcode + rel (i know it doesnt matter but i used em for ref - dont judge me :))
-            effective_address = self._state.x + address # index reg plus the following byte (both unsigned) (can access up to 0x01fe) looks legit
-            self._state.pc = effective_address
-
-        if opcode == 0xdc:  # Indexed, 16-bit offset addressing mode
-            self._state.pc += 3
-            effective_address = self._state.x + address  # this offset is 2 bytes in size not one , dont be fooled
-            self._state.pc = effective_address
-
-        if opcode == 0xcc:  # this is extended mode
-            self._state.pc += 3
-            self._state.pc = address  # 2 bytes, simply go there biach
-
-        if opcode == 0xbc:  # direct
-            self._state.pc += 2
-            self._state.pc = address
-
+        # direct and extended go straight to address, indexed modes add x (up to 0x01fe for 8bit offsets)
+        effective_address, size = self._effective_address(opcode, address)
+        self._state.pc = effective_address
 
     def jsr(self, opcode, address=0x00):
         """
             JSR jump to subroutine and save return address on stack
         """
-        self._state.push(self._state.pc) # save the return address hun , its dangerous outside ;)
-
-        if opcode == 0xfd:  # indexed no offser (first bytes is 0x00 second is from the index reg)
-            self._state.pc += 1 # just the instruction , no params
-            self._state.pc = self._state.x
-        if opcode == 0xed:  # indexed 8bit offset (
-            self._state.pc += 2  # opcode + rel (i know it doesnt matter but i used em for ref - dont judge me :))
-            effective_address = self._state.x + address # index reg plus the following byte (both unsigned) (can access up to 0x01fe) looks legit
-            self._state.pc = effective_address
-        if opcode == 0xdd:  # Indexed, 16-bit offset addressing mode
-            self._state.pc += 3
-            effective_address = self._state.x + address  # this offset is 2 bytes in size not one , dont be fooled
-            self._state.pc = effective_address
-        if opcode == 0xcd:  # this is extended mode
-            self._state.pc += 3
-            self._state.pc = address  # 2 bytes, simply go there biach
-        if opcode == 0xbd:  # direct
-            self._state.pc += 2
-            self._state.pc = address
+        effective_address, size = self._effective_address(opcode, address)
+        self._state.push(self._state.pc + size)  # save the return address hun , its dangerous outside ;)
+        self._state.pc = effective_address
 
     def rts(self):
         """
@@ -928,7 +779,7 @@ class Commands(object):
         a = self._state.pop()
         x = self._state.pop()
         pc = self._state.pop()  # fixme - PCL PCH (does it matter if its all hardware?)
-        self._state.update_flags(ccr)
+        self._state.ccr = ccr
         self._state.a = a
         self._state.x = x
         self._state.pc = pc
@@ -938,42 +789,35 @@ class Commands(object):
         """
             CLC clear the condition code register carry bit
         """
-        self._state.clear_flag('C')
+        self._state.clear_flag(CCR_C)
         self._state.pc += 1
 
     def sec(self):
         """
             SEC set the condition code register carry bit
         """
-        self._state.set_flag('C')
+        self._state.set_flag(CCR_C)
         self._state.pc += 1
 
     def cli(self):
         """
             CLI clear the condition code register interrupt mask bit
         """
-        self._state.clear_flag('I')
+        self._state.clear_flag(CCR_I)
         self._state.pc += 1
 
     def sei(self):
         """
             SEI set the condition code register interrupt mask bit
         """
-        self._state.set_flag('I')
+        self._state.set_flag(CCR_I)
         self._state.pc += 1
 
     def swi(self):
         """
             SWI software initiated interrupt
         """
-        ccr = self._state.ccr
-        a = self._state.a
-        x = self._state.x
-        pc = self._state.pc
-        self._state.push(pc) # fixme - PCL PCH (does it matter if its all hardware?)
-        self._state.push(x)
-        self._state.push(a)
-        self._state.push(ccr)
+        self.interrupt(SWI_VECTOR, self._state.pc + 1)
 
     def rsp(self):
         """
@@ -986,13 +830,42 @@ class Commands(object):
         """
             WAIT enable interrupts and halt the CPU
         """
-        # fixme - yet again - wat - hardware software watware?
+        self._halt(HALT_WAIT)
 
     def stop(self):
         """
             STOP enable interrupts and stop the oscillator
         """
-        # fixme - if i halt myself how can i stop halting? man this pic emulation is becoming philosophical
+        # the emulated clock keeps counting, so a scheduled timer interrupt still wakes it
+        self._halt(HALT_STOP)
+
+    def _halt(self, how):
+        state = self._state
+        state.clear_flag(CCR_I)
+        state.pc += 1  # an interrupt comes back to the next instruction
+        state.halted = how
+        state.interrupts.poll()
+
+    def _idle(self):
+        """
+            the instruction just branched to itself and will keep doing so until an interrupt changes something,
+            the parser can skip ahead to the next one instead of interpreting every iteration
+        """
+        self._state.halted = HALT_IDLE
+        self._state.interrupts.poll()
+
+    def interrupt(self, vector, return_address=None):
+        """
+            what the cpu does to take any interrupt: stack pc, x, a and ccr, set I and jump through vector
+            return_address - where rti comes back to, pc by default (hardware interrupts land between instructions)
+        """
+        state = self._state
+        state.push(state.pc if return_address is None else return_address)  # fixme - PCL PCH (does it matter if its all hardware?)
+        state.push(state.x)
+        state.push(state.a)
+        state.push(state.ccr)  # the packed byte, rti puts it straight back
+        state.set_flag(CCR_I)
+        state.pc = (self._memory.read(vector) << 8) | self._memory.read(vector + 1)
 
     # helper functions
 
@@ -1005,25 +878,25 @@ class Commands(object):
     def _logical_right_shift(self, value):
         result = value >> 1
         negative = 0  # doc
-        zero = 0 if value else 1
-        carry = 1 if result < value else 0
-        self._state.update_flags({'N': negative, 'Z': zero, 'C': carry})
+        zero = 0 if value else CCR_Z
+        carry = CCR_C if result < value else 0
+        self._state.update_flags(CCR_N | CCR_Z | CCR_C, negative | zero | carry)
         return result
 
     def _arithmetical_left_shift(self, value):
         result = self._left_shift(value)
-        negative = 1 if result < 0 else 0
-        zero = 0 if result else 1
-        carry = 1 if result < value else 0
-        self._state.update_flags({'N': negative, 'Z': zero, 'C': carry})
+        negative = CCR_N if result < 0 else 0
+        zero = 0 if result else CCR_Z
+        carry = CCR_C if result < value else 0
+        self._state.update_flags(CCR_N | CCR_Z | CCR_C, negative | zero | carry)
         return result
 
     def _logical_left_shift(self, value):
         result = self._left_shift(value)
         negative = 0  # doc said it , what are you looking at me for?!
-        zero = 0 if result else 1
-        carry = 1 if result < value else 0
-        self._state.update_flags({'N': negative, 'Z': zero, 'C': carry})
+        zero = 0 if result else CCR_Z
+        carry = CCR_C if result < value else 0
+        self._state.update_flags(CCR_N | CCR_Z | CCR_C, negative | zero | carry)
         return result
 
     def _rol(self, value, rotate_by):
@@ -1034,10 +907,10 @@ class Commands(object):
         max_bits = 8
         result = (value << rotate_by % max_bits) & (2 ** max_bits - 1) | \
                  ((value & (2 ** max_bits - 1)) >> (max_bits - (rotate_by % max_bits)))
-        negative = 1 if result < 0 else 0
-        zero = 0 if result else 1
-        carry = 1 if result < value else 0
-        self._state.update_flags({'N': negative, 'Z': zero, 'C': carry})
+        negative = CCR_N if result < 0 else 0
+        zero = 0 if result else CCR_Z
+        carry = CCR_C if result < value else 0
+        self._state.update_flags(CCR_N | CCR_Z | CCR_C, negative | zero | carry)
         return result
 
     def _ror(self, value, rotate_by):
@@ -1047,31 +920,177 @@ class Commands(object):
         max_bits = 8
         result = ((value & (2 ** max_bits - 1)) >> rotate_by % max_bits) | \
                  (value << (max_bits - (rotate_by % max_bits)) & (2 ** max_bits - 1))
-        negative = 1 if result < 0 else 0
-        zero = 0 if result else 1
-        carry = 1 if result < value else 0
-        self._state.update_flags({'N': negative, 'Z': zero, 'C': carry})
+        negative = CCR_N if result < 0 else 0
+        zero = 0 if result else CCR_Z
+        carry = CCR_C if result < value else 0
+        self._state.update_flags(CCR_N | CCR_Z | CCR_C, negative | zero | carry)
         return result
 
     def _test(self, value):
-        if value == 0:
-            self._state.set_flag('Z')
-        elif value < 0:
-            self._state.set_flag('N')
-        else:
-            self._state.clear_flag('Z')
-            self._state.clear_flag('N')
+        self._state.set_nz(value)
 
     def _cmp(self, register, operand):
-        result = (register - operand) % (self._state.general_register_size+1)
-        zero = 0 if result else 1
-        negative = 1 if result < 0 else 1
-        carry = 1 if result < register else 1
-        self._state.update_flags({'Z': zero, 'N': negative, 'C': carry})
+        self._state.update_flags(SUB_FLAGS, SUB_TABLE[(register << 8) | operand] >> 8)
+
+    def _branch_if(self, condition, relative_address, size=2):
+        """
+            every branch is two bytes (three for BRSET/BRCLR), taken or not
+        """
+        self._state.pc = (self._state.pc + size) & self._address_size
+        if condition:
+            if relative_address == 0xFE and size == 2:  # BRA *, BNE * and friends, the flags cant change under it
+                self._idle()
+            self._branch(relative_address)
 
     def _branch(self, relative_address):
-        self._state.pc += relative_address
+        """
+            relative_address is the raw offset byte, a signed two's complement value
+        """
+        if relative_address & 0x80:
+            relative_address -= 0x100
+        self._state.pc = (self._state.pc + relative_address) & self._address_size
 
     def _left_shift(self, value):
         value <<= 1
-        return value
\ No newline at end of file
+        return value & self._register_size  # the bit shifted out is gone, memory cells are a byte wide
+
+
+def _machine(code, address=0x0000, patches=()):
+    """
+        a parser with code at address and pc on it
+        :return: (parser, registers, memory)
+    """
+    from emulator import OpCodeParser  # the emulator imports this module
+    registers = Registers()
+    memory = Memory()
+    parser = OpCodeParser(b"", Commands(registers, memory), memory, registers)
+    for patch_address, data in [(address, bytes(code))] + list(patches):
+        memory.write_buffer_to_memory(patch_address, data)
+    registers.pc = address
+    return parser, registers, memory
+
+
+def _flags(registers):
+    return {flag for flag, value in registers.flags.items() if value and flag != 'I'}
+
+
+def _set_flags(registers, flags):
+    masks = {'C': CCR_C, 'Z': CCR_Z, 'N': CCR_N, 'H': CCR_H}
+    registers.update_flags(CCR_C | CCR_Z | CCR_N | CCR_H, sum(masks[flag] for flag in flags))
+
+
+def test_branch_offsets_are_signed_and_wrap():
+    parser, registers, memory = _machine([0x20, 0xFC], address=0x0010)  # BRA -4
+    parser.step()
+    assert(registers.pc == 0x000E)
+    parser, registers, memory = _machine([0x20, 0xFC])
+    parser.step()
+    assert(registers.pc == 0xFFFE)
+
+
+def test_conditional_branches():
+    for opcode, flags, taken in ((0x26, 'Z', False), (0x26, '', True),  # BNE
+                                 (0x27, 'Z', True), (0x27, '', False),  # BEQ
+                                 (0x22, '', True), (0x22, 'C', False), (0x22, 'Z', False),  # BHI
+                                 (0x24, '', True), (0x24, 'C', False)):  # BHS
+        parser, registers, memory = _machine([opcode, 0x10])
+        _set_flags(registers, flags)
+        parser.step()
+        assert(registers.pc == (0x0012 if taken else 0x0002))
+
+
+def test_addressing_modes():
+    operands = [(0x0080, b"\x01"), (0x0123, b"\x02"), (0x0090, b"\x03"), (0x0095, b"\x04"), (0x0140, b"\x05")]
+    for code, size, expected in (([0xA6, 0x7F], 2, 0x7F),  # LDA #$7F
+                                 ([0xB6, 0x80], 2, 0x01),  # LDA $80
+                                 ([0xC6, 0x01, 0x23], 3, 0x02),  # LDA $0123
+                                 ([0xF6], 1, 0x03),  # LDA ,X
+                                 ([0xE6, 0x05], 2, 0x04),  # LDA $05,X
+                                 ([0xD6, 0x00, 0xB0], 3, 0x05)):  # LDA $00B0,X
+        parser, registers, memory = _machine(code, address=0x0200, patches=operands)
+        registers.x = 0x90
+        parser.step()
+        assert(registers.a == expected)
+        assert(registers.pc == 0x0200 + size)
+
+    parser, registers, memory = _machine([0xD7, 0x01, 0x00, 0xBE, 0x80], address=0x0200)  # STA $0100,X / LDX $80
+    registers.a = 0x42
+    registers.x = 0x10
+    parser.step()
+    assert(memory.read(0x0110) == 0x42 and registers.a == 0x42)
+    before = bytes(memory.view())
+    parser.step()
+    assert(registers.x == memory.read(0x0080) and bytes(memory.view()) == before)
+
+
+def test_increment_and_decrement_wrap():
+    parser, registers, memory = _machine([0x4C, 0x5A])  # INCA / DECX
+    registers.a = 0xFF
+    registers.x = 0x00
+    parser.step()
+    assert(registers.a == 0x00 and 'Z' in _flags(registers))
+    parser.step()
+    assert(registers.x == 0xFF and 'N' in _flags(registers))
+
+
+def test_subroutine_calls_push_the_next_instruction():
+    # 0000 JSR $0010 / 0003 BSR +3 / 0005 JMP $0020 / 0008 RTS / 0010 RTS
+    parser, registers, memory = _machine([0xCD, 0x00, 0x10, 0xAD, 0x03, 0xCC, 0x00, 0x20, 0x81],
+                                         patches=[(0x0010, b"\x81")])
+    sp = registers._stack.sp
+    parser.step()
+    assert(registers.pc == 0x0010 and registers._stack.sp != sp)
+    parser.step()
+    assert(registers.pc == 0x0003 and registers._stack.sp == sp)
+    parser.step()
+    assert(registers.pc == 0x0008)
+    parser.step()
+    assert(registers.pc == 0x0005 and registers._stack.sp == sp)
+    parser.step()
+    assert(registers.pc == 0x0020 and registers._stack.sp == sp)
+
+
+def test_bit_set_clear_and_test():
+    # BSET 3,$80 / BRSET 3,$80,+2 / ... / BCLR 3,$80 / BRCLR 3,$80,-3
+    parser, registers, memory = _machine([0x16, 0x80, 0x06, 0x80, 0x02, 0x9D, 0x9D, 0x17, 0x80, 0x07, 0x80, 0xFD],
+                                         patches=[(0x0080, b"\x00")])
+    parser.step()
+    assert(memory.read(0x0080) == 0x08)
+    parser.step()
+    assert(registers.pc == 0x0007)
+    parser.step()
+    assert(memory.read(0x0080) == 0x00)
+    parser.step()
+    assert(registers.pc == 0x0009)
+
+
+def test_compare_and_test_flags():
+    for code, a, x, flags in (([0xA1, 0x20], 0x10, 0, {'N', 'C'}),  # CMP #$20, 0x10 - 0x20
+                              ([0xA1, 0x10], 0x10, 0, {'Z'}),
+                              ([0xA1, 0x01], 0x80, 0, set()),  # 0x7F, no borrow
+                              ([0xA3, 0x05], 0, 0x04, {'N', 'C'}),  # CPX #$05
+                              ([0x4D], 0x80, 0, {'N'}),  # TSTA
+                              ([0x4D], 0x00, 0, {'Z'})):
+        parser, registers, memory = _machine(code)
+        registers.a = a
+        registers.x = x
+        parser.step()
+        assert(_flags(registers) - {'H'} == flags)
+
+
+def test_pc_reaches_the_top_of_memory():
+    registers = Registers()
+    registers.pc = 0xFFFF
+    assert(registers.pc == 0xFFFF)
+
+
+if __name__ == "__main__":
+
+    test_branch_offsets_are_signed_and_wrap()
+    test_conditional_branches()
+    test_addressing_modes()
+    test_increment_and_decrement_wrap()
+    test_subroutine_calls_push_the_next_instruction()
+    test_bit_set_clear_and_test()
+    test_compare_and_test_flags()
+    test_pc_reaches_the_top_of_memory()
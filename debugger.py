@@ -0,0 +1,344 @@
+import collections
+
+from emulator import STOP_UNTIL_PC, RunResult
+
+
+STOP_BREAKPOINT = 'breakpoint'
+STOP_WATCHPOINT = 'watchpoint'
+
+WATCH_READ = 0x01
+WATCH_WRITE = 0x02
+WATCH_ACCESS = WATCH_READ | WATCH_WRITE
+
+_ADDRESS_SPACE = 0x10000
+_STOP_EVERYWHERE = b"\x01" * _ADDRESS_SPACE
+
+
+class Breakpoint(object):
+
+    def __init__(self, address, condition=None, ignore_count=0):
+        """
+            address - stop before the instruction there runs
+            condition - condition(registers) -> bool, only stop when it returns true
+            ignore_count - let this many hits go by before stopping, hits that fail condition dont count
+        """
+        self.address = address
+        self.condition = condition
+        self.ignore_count = ignore_count
+        self.hits = 0
+
+    def hit(self, registers):
+        if self.condition is not None and not self.condition(registers):
+            return False
+        self.hits += 1
+        return self.hits > self.ignore_count
+
+
+class Watchpoint(object):
+
+    def __init__(self, address_range, kind=WATCH_WRITE, value=None, condition=None, ignore_count=0):
+        """
+            address_range - range of addresses to watch
+            kind - WATCH_READ, WATCH_WRITE or WATCH_ACCESS
+            value - only stop when this value is read or written
+            condition - condition(registers, address, value) -> bool, only stop when it returns true
+            ignore_count - let this many hits go by before stopping
+        """
+        self.address_range = address_range
+        self.kind = kind
+        self.value = value
+        self.condition = condition
+        self.ignore_count = ignore_count
+        self.hits = 0
+
+    def hit(self, registers, kind, address, value):
+        if not self.kind & kind or address not in self.address_range:
+            return False
+        if self.value is not None and value != self.value:
+            return False
+        if self.condition is not None and not self.condition(registers, address, value):
+            return False
+        self.hits += 1
+        return self.hits > self.ignore_count
+
+
+# what stopped a run on a watchpoint, kind is WATCH_READ or WATCH_WRITE
+WatchHit = collections.namedtuple('WatchHit', ['watchpoint', 'kind', 'address', 'value'])
+
+
+class _WatchedRegion(object):
+
+    def __init__(self, region, owned):
+        """
+            a memory region the debugger hooked, owned - the debugger mapped it just for watching
+        """
+        self.region = region
+        self.owned = owned
+        self.read = region.read
+        self.write = region.write
+        self.watchpoints = []
+
+
+class Debugger(object):
+
+    def __init__(self, parser):
+        """
+            breakpoints and watchpoints for an OpCodeParser, run() and step() go through here.
+            breakpoints are a 64k map handed to parser.run() as its stop addresses, the loop checks that map
+            after every instruction anyway, so they cost nothing until pc lands on one. watchpoints hook the
+            memory region table, plain memory keeps its fast path unless it is watched.
+            with nothing set run() is parser.run()
+        """
+        self._parser = parser
+        self._state = parser.registers
+        self._memory = parser.memory
+        self._breakpoints = {}  # address -> Breakpoint
+        self._breakpoint_map = bytearray(_ADDRESS_SPACE)
+        self._stop_map = bytearray(_ADDRESS_SPACE)  # breakpoints and until_pc, what the running loop looks at
+        self._watched = []  # _WatchedRegions
+        self._watch_hit = None
+        self._instruction_sizes = bytes(1 + sum(info.argument_sizes) if info is not None else 1
+                                        for info in parser._opcode_table)
+        self.hit = None  # what stopped the last run, a Breakpoint or a WatchHit
+
+    @property
+    def breakpoints(self):
+        return list(self._breakpoints.values())
+
+    @property
+    def watchpoints(self):
+        return [watchpoint for watched in self._watched for watchpoint in watched.watchpoints]
+
+    def add_breakpoint(self, address, condition=None, ignore_count=0):
+        """
+            :return: the Breakpoint, a second one at the same address replaces the first
+        """
+        if not 0 <= address < _ADDRESS_SPACE:
+            raise ValueError("address out of range {}".format(address))
+        breakpoint = Breakpoint(address, condition, ignore_count)
+        self._breakpoints[address] = breakpoint
+        self._breakpoint_map[address] = 1
+        return breakpoint
+
+    def remove_breakpoint(self, address):
+        """
+            address - an address or a Breakpoint, quietly ignores addresses without one
+        """
+        if isinstance(address, Breakpoint):
+            address = address.address
+        if self._breakpoints.pop(address, None) is not None:
+            self._breakpoint_map[address] = 0
+
+    def add_watchpoint(self, address_range, kind=WATCH_WRITE, value=None, condition=None, ignore_count=0):
+        """
+            watch address_range (an int watches one byte), it has to lie in unmapped memory or inside one
+            region mapped by a peripheral model, whose handlers still get every access
+            :return: the Watchpoint
+        """
+        if type(address_range) == int:
+            address_range = range(address_range, address_range + 1)
+        watchpoint = Watchpoint(address_range, kind, value, condition, ignore_count)
+        watched = self._watched_region(address_range)
+        watched.watchpoints.append(watchpoint)
+        self._hook(watched)
+        return watchpoint
+
+    def remove_watchpoint(self, watchpoint):
+        for watched in self._watched:
+            if watchpoint in watched.watchpoints:
+                watched.watchpoints.remove(watchpoint)
+                self._hook(watched)
+                if not watched.watchpoints:
+                    self._watched.remove(watched)
+                    if watched.owned:
+                        self._memory.unmap_region(watched.region)
+                return
+
+    def _watched_region(self, address_range):
+        region_map = self._memory._region_map
+        indexes = set(region_map[address_range.start:address_range.stop])
+        if len(indexes) != 1:
+            raise ValueError("watch range {} straddles mapped regions".format(address_range))
+        index = indexes.pop()
+        if not index:
+            watched = _WatchedRegion(self._memory.map_region(address_range), owned=True)
+            self._watched.append(watched)
+            return watched
+        region = self._memory._regions[index]
+        for watched in self._watched:
+            if watched.region is region:
+                return watched
+        watched = _WatchedRegion(region, owned=False)
+        self._watched.append(watched)
+        return watched
+
+    def _hook(self, watched):
+        """
+            put checking handlers on the region for the kinds of access somebody watches, the original ones back
+            for the rest
+        """
+        kinds = 0
+        for watchpoint in watched.watchpoints:
+            kinds |= watchpoint.kind
+        watched.region.read = self._checked_read(watched) if kinds & WATCH_READ else watched.read
+        watched.region.write = self._checked_write(watched) if kinds & WATCH_WRITE else watched.write
+        self._memory._update_read_path()
+
+    def _checked_read(self, watched):
+        read = watched.read
+        contents = self._memory.view()
+        state = self._state
+        instruction_sizes = self._instruction_sizes
+
+        def checked_read(address):
+            value = read(address) if read is not None else contents[address]
+            pc = state._pc
+            # fetching the opcode and operands of the current instruction is not a read of the data there
+            if (address - pc) & 0xFFFF >= instruction_sizes[contents[pc]]:
+                self._check(watched, WATCH_READ, address, value)
+            return value
+        return checked_read
+
+    def _checked_write(self, watched):
+        write = watched.write
+        region = watched.region
+        memory = self._memory
+
+        def checked_write(address, value):
+            self._check(watched, WATCH_WRITE, address, value)
+            if write is not None:
+                write(address, value)
+            elif not region.read_only:
+                memory.write_buffer_to_memory(address, bytes((value,)))
+        return checked_write
+
+    def _check(self, watched, kind, address, value):
+        for watchpoint in watched.watchpoints:
+            if watchpoint.hit(self._state, kind, address, value) and self._watch_hit is None:
+                self._watch_hit = WatchHit(watchpoint, kind, address, value)
+                self._stop_map[:] = _STOP_EVERYWHERE  # the running loop stops once this instruction is done
+
+    def run(self, max_instructions=None, max_cycles=None, until_pc=None, until=None):
+        """
+            OpCodeParser.run that also stops at breakpoints and after an instruction that hit a watchpoint,
+            what did is in self.hit. breakpoints whose condition or ignore count lets them pass are run through.
+            :return: RunResult, reason is STOP_BREAKPOINT, STOP_WATCHPOINT or one of the parser's
+        """
+        self.hit = None
+        self._watch_hit = None
+        if not self._breakpoints and not self._watched:
+            return self._parser.run(max_instructions, max_cycles, until_pc, until)
+
+        stop_addresses = set([until_pc] if type(until_pc) == int else until_pc or ())
+        instructions = 0
+        cycles = 0
+        elapsed = 0.0
+        self._reset_stop_map(stop_addresses)
+        while True:
+            result = self._parser.run(max_instructions - instructions if max_instructions is not None else None,
+                                      max_cycles - cycles if max_cycles is not None else None,
+                                      self._stop_map, until)
+            instructions += result.instructions
+            cycles += result.cycles
+            elapsed += result.elapsed
+            reason = result.reason
+            if self._watch_hit is not None:
+                self.hit = self._watch_hit
+                self._watch_hit = None
+                reason = STOP_WATCHPOINT
+                self._reset_stop_map(stop_addresses)
+                break
+            if reason != STOP_UNTIL_PC:
+                break
+            breakpoint = self._breakpoints.get(result.pc)
+            if breakpoint is not None and breakpoint.hit(self._state):
+                self.hit = breakpoint
+                reason = STOP_BREAKPOINT
+                break
+            if result.pc in stop_addresses:
+                break
+        return RunResult(reason, instructions, cycles, self._state.pc, elapsed)
+
+    def _reset_stop_map(self, stop_addresses):
+        self._stop_map[:] = self._breakpoint_map
+        for address in stop_addresses:
+            self._stop_map[address] = 1
+
+    def step(self):
+        """
+            one instruction, breakpoints dont stop a single step
+            :return: the WatchHit it caused, or None
+        """
+        self._watch_hit = None
+        self._parser.step()
+        self.hit = self._watch_hit
+        self._watch_hit = None
+        if self.hit is not None:
+            self._stop_map[:] = self._breakpoint_map
+        return self.hit
+
+
+def test_breakpoint_condition_and_ignore_count():
+    from emulator import STOP_MAX_INSTRUCTIONS, create_emulator
+    parser = create_emulator(bytes([0x4C, 0x20, 0xFD]), seed=1)  # INCA, BRA -3
+    parser.registers.a = 0
+    debugger = Debugger(parser)
+    breakpoint = debugger.add_breakpoint(0x0000, condition=lambda registers: registers.a >= 3, ignore_count=1)
+    result = debugger.run(max_instructions=100)
+    assert (result.reason, debugger.hit, parser.registers.a) == (STOP_BREAKPOINT, breakpoint, 4)
+    assert breakpoint.hits == 2  # a == 1 and 2 failed the condition and never counted
+    assert result.instructions == 8
+
+    assert debugger.run(max_instructions=100).reason == STOP_BREAKPOINT  # past the ignore count, every hit stops
+    assert parser.registers.a == 5
+    debugger.remove_breakpoint(breakpoint)
+    assert debugger.run(max_instructions=100).reason == STOP_MAX_INSTRUCTIONS
+    assert debugger.breakpoints == []
+
+
+def test_watchpoints():
+    from emulator import STOP_MAX_INSTRUCTIONS, create_emulator
+    # LDA #7, STA $80, LDA $80, BRA -6
+    parser = create_emulator(bytes([0xA6, 0x07, 0xB7, 0x80, 0xB6, 0x80, 0x20, 0xFA]), seed=1)
+    debugger = Debugger(parser)
+    written = debugger.add_watchpoint(0x80)
+    read = debugger.add_watchpoint(range(0x80, 0x81), WATCH_READ, value=7)
+    result = debugger.run(max_instructions=100)
+    assert (result.reason, result.instructions, parser.registers.pc) == (STOP_WATCHPOINT, 2, 0x0004)
+    assert debugger.hit == WatchHit(written, WATCH_WRITE, 0x80, 7)
+    assert parser.memory.read(0x80) == 7  # the write went through
+
+    assert debugger.step() == WatchHit(read, WATCH_READ, 0x80, 7)
+    debugger.remove_watchpoint(written)
+    debugger.remove_watchpoint(read)
+    assert debugger.watchpoints == [] and not parser.memory._region_map[0x80]  # the region it mapped is gone
+
+    ignored = debugger.add_watchpoint(0x80, WATCH_ACCESS, ignore_count=2)
+    debugger.run(max_instructions=100)
+    assert (debugger.hit.kind, ignored.hits) == (WATCH_WRITE, 3)  # a write and a read go by, the next write stops
+
+    debugger.remove_watchpoint(ignored)
+    assert debugger.run(max_instructions=100).reason == STOP_MAX_INSTRUCTIONS
+
+
+def test_fetches_are_not_reads():
+    from emulator import STOP_MAX_INSTRUCTIONS, create_emulator
+    parser = create_emulator(bytes([0xB6, 0x05, 0x20, 0xFC, 0x9D, 0x42]), seed=1)  # LDA $05, BRA -4, NOP, 0x42
+    debugger = Debugger(parser)
+    watchpoint = debugger.add_watchpoint(range(0x00, 0x08), WATCH_READ)
+    assert debugger.run(max_instructions=100).reason == STOP_WATCHPOINT
+    assert debugger.hit == WatchHit(watchpoint, WATCH_READ, 0x05, 0x42)  # the load, not the opcode or operand fetch
+
+    debugger.remove_watchpoint(watchpoint)
+    parser.registers.pc = 0x0002
+    parser.memory.write_buffer_to_memory(0x0002, bytes([0x20, 0xFE]))  # BRA *
+    debugger.add_watchpoint(range(0x00, 0x04), WATCH_READ)
+    assert debugger.run(max_instructions=100).reason == STOP_MAX_INSTRUCTIONS
+    assert debugger.hit is None
+
+
+if __name__ == "__main__":
+
+    test_breakpoint_condition_and_ignore_count()
+    test_watchpoints()
+    test_fetches_are_not_reads()
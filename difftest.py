@@ -0,0 +1,463 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import struct
+
+from emulator import create_emulator
+from image_formats import read_image
+from opcodes import load_opcode_table
+from profiler import Profiler
+from tracer import Tracer
+
+
+MAGIC = b"G605"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sBQQ")  # magic, version, power up seed, instructions between checkpoints
+CHECKPOINT = struct.Struct("<QQBBHHB32s")  # instruction, cycles, a, x, pc, sp, ccr, sha256 of memory and stack
+
+CHECKPOINT_INTERVAL = 10000  # instructions between two state comparisons
+SEGMENT_SIZE = 1000000  # instructions per pool job, a multiple of the checkpoint interval
+
+# instruction - instructions run since the start, None once the machine raised (the run loop loses count then)
+# digest - sha256 hex of the 64k memory and the stack, stopped - None, 'halted' for good, or what it raised
+State = collections.namedtuple('State', ['instruction', 'cycles', 'a', 'x', 'pc', 'sp', 'ccr', 'digest', 'stopped'])
+
+# instruction - instructions both ran while they still agreed, pc - where the instruction that set them apart
+# starts, expected and actual - States. against a golden file, or when stepping one instruction at a time doesnt
+# reproduce it, only the checkpoint interval starting there is known and the States are the ones at its end
+Divergence = collections.namedtuple('Divergence', ['instruction', 'pc', 'expected', 'actual'])
+
+# divergence - the first Divergence or None, instructions - how far the reference got (None when it ended raising),
+# checkpoints - how many were compared
+DiffResult = collections.namedtuple('DiffResult', ['divergence', 'instructions', 'checkpoints'])
+
+# seed - the power up seed it was recorded with, interval - instructions between checkpoints, states - States
+Golden = collections.namedtuple('Golden', ['seed', 'interval', 'states'])
+
+# attach(parser) - instruments a fresh machine, None for nothing to do
+# advance(parser, instructions) -> instructions run, may run past a block end, 0 once it cant go on
+Engine = collections.namedtuple('Engine', ['attach', 'advance'])
+
+
+def _advance_run(parser, instructions):
+    return parser.run(max_instructions=instructions).instructions
+
+
+def _advance_step(parser, instructions):
+    step = parser.step
+    state = parser.registers
+    executed = 0
+    while executed < instructions:
+        done = step()
+        if not done and state.halted:  # asleep with nothing left to wake it
+            break
+        executed += done
+    return executed
+
+
+def _advance_block(parser, instructions):
+    """
+        whole blocks while they fit in what is left, single steps for the rest
+    """
+    state = parser.registers
+    executed = 0
+    while executed < instructions:
+        block_cache = parser._block_cache
+        if block_cache is not None and block_cache.lookup(state.pc).instructions > instructions - executed:
+            done = parser.step()
+        else:
+            done = parser.step_block()[0]
+        if not done and state.halted:
+            break
+        executed += done
+    return executed
+
+
+def _attach_tracer(parser):
+    parser.set_tracer(Tracer(capacity=0x1000))
+
+
+def _attach_profiler(parser):
+    parser.set_profiler(Profiler())
+
+
+ENGINES = collections.OrderedDict([
+    ('run', Engine(None, _advance_run)),
+    ('step', Engine(None, _advance_step)),
+    ('block', Engine(None, _advance_block)),
+    ('traced', Engine(_attach_tracer, _advance_run)),
+    ('profiled', Engine(_attach_profiler, _advance_run)),
+])
+
+
+class _Machine(object):
+
+    def __init__(self, engine, rom, patches=(), seed=None, setup=None):
+        """
+            one emulator driven by one of the ENGINES, counting the instructions it ran
+            setup - setup(parser) for peripheral models, called before the engine attaches
+        """
+        if engine not in ENGINES:
+            raise ValueError("unknown engine {}".format(engine))
+        self.parser = create_emulator(rom, patches, seed)
+        if setup is not None:
+            setup(self.parser)
+        attach, self._advance = ENGINES[engine]
+        if attach is not None:
+            attach(self.parser)
+        self.instructions = 0
+        self.stopped = None
+
+    def restore(self, snapshot, instructions):
+        self.parser.restore(snapshot)
+        self.instructions = instructions
+        self.stopped = None
+
+    def advance_to(self, instruction):
+        """
+            run until instruction instructions ran in total, or further when the engine cant stop there
+        """
+        while self.stopped is None and self.instructions < instruction:
+            try:
+                executed = self._advance(self.parser, instruction - self.instructions)
+            except ValueError as error:
+                self.instructions = None
+                self.stopped = str(error)
+                return
+            self.instructions += executed
+            if not executed:
+                self.stopped = 'halted'
+
+    def state(self):
+        parser = self.parser
+        registers = parser.registers
+        digest = hashlib.sha256(parser.memory.view())
+        digest.update(registers._stack.snapshot())
+        return State(self.instructions, registers.cycles if self.instructions is not None else None,
+                     registers.a, registers.x, registers.pc, registers.sp, registers.ccr, digest.hexdigest(),
+                     self.stopped)
+
+
+def _align(first, second, instruction):
+    """
+        bring both machines to instruction, or to the same count past it when one of them overshoots
+    """
+    first.advance_to(instruction)
+    second.advance_to(instruction)
+    while first.stopped is None and second.stopped is None and first.instructions != second.instructions:
+        if first.instructions < second.instructions:
+            first.advance_to(second.instructions)
+        else:
+            second.advance_to(first.instructions)
+
+
+def _locate(first, second, snapshot, since, until, checkpoint):
+    """
+        go again from snapshot, taken where both agreed after since instructions, one instruction at a time
+        checkpoint - the Divergence seen at the end of the interval, what is left when stepping doesnt show it.
+                     that happens when it only shows up at block granularity, or when the setup isnt deterministic
+        :return: Divergence of the first instruction after which they differ
+    """
+    first.restore(snapshot, since)
+    second.restore(snapshot, since)
+    while first.stopped is None and first.instructions < until:
+        instruction = first.instructions
+        pc = first.parser.registers.pc
+        _align(first, second, instruction + 1)
+        expected, actual = first.state(), second.state()
+        if expected != actual:
+            return Divergence(instruction, pc, expected, actual)
+    return checkpoint
+
+
+def _architectural(state):
+    return state[:-1]  # golden files dont record why a machine stopped, a count that falls short shows it
+
+
+# the pool worker's machines, built once per process by _init_worker
+_worker_machines = None
+_worker_reference = None
+
+
+def _init_worker(engines, rom, patches, seed, setup):
+    global _worker_machines, _worker_reference
+    load_opcode_table()  # parsed once, every machine this worker builds reuses it
+    _worker_machines = [_Machine(engine, rom, patches, seed, setup) for engine in engines]
+    _worker_reference = _Machine('run', rom, patches, seed, setup)
+
+
+def advance_segment(start, end, snapshot):
+    """
+        run the worker's reference machine from snapshot (taken after start instructions) up to end
+        :return: (instructions run by then, None when it raised, why it stopped or None, snapshot there)
+    """
+    reference = _worker_reference
+    reference.restore(snapshot, start)
+    reference.advance_to(end)
+    return reference.instructions, reference.stopped, reference.parser.snapshot()
+
+
+def compare_segment(start, end, snapshot, every, golden=None):
+    """
+        compare the worker's machines from snapshot (taken after start instructions) up to end,
+        at every multiple of every. with golden, a sequence of States, its one machine is compared against those
+        :return: (checkpoints compared, the first Divergence or None)
+    """
+    if golden is not None:
+        return _compare_to_golden(_worker_machines[0], start, snapshot, golden)
+    first, second = _worker_machines
+    first.restore(snapshot, start)
+    second.restore(snapshot, start)
+    checkpoints = 0
+    instruction = start
+    while instruction < end:
+        pc = first.parser.registers.pc
+        _align(first, second, min((instruction // every + 1) * every, end))
+        expected, actual = first.state(), second.state()
+        checkpoints += 1
+        if expected != actual:
+            checkpoint = Divergence(instruction, pc, expected, actual)
+            return checkpoints, _locate(first, second, snapshot, instruction, expected.instruction or end, checkpoint)
+        if first.stopped is not None:
+            break
+        instruction = first.instructions
+        snapshot = first.parser.snapshot()
+    return checkpoints, None
+
+
+def _compare_to_golden(machine, start, snapshot, golden):
+    machine.restore(snapshot, start)
+    checkpoints = 0
+    since, pc = start, machine.parser.registers.pc
+    for expected in golden:
+        machine.advance_to(expected.instruction)
+        if machine.stopped is None and machine.instructions > expected.instruction:
+            continue  # ran past it in one go, the next checkpoint it lands on tells
+        actual = machine.state()
+        checkpoints += 1
+        if _architectural(expected) != _architectural(actual):
+            return checkpoints, Divergence(since, pc, expected, actual)
+        since, pc = expected.instruction, actual.pc
+    return checkpoints, None
+
+
+def _run_now(function, *arguments):
+    """
+        executor.submit without a pool
+    """
+    future = concurrent.futures.Future()
+    future.set_result(function(*arguments))
+    return future
+
+
+def _compare_segments(submit, snapshot, max_instructions, segment_size, every, golden):
+    """
+        the reference job for a segment hands on the snapshot its compare job and the next reference job start
+        from, so while the reference chain moves on the compare jobs behind it run side by side
+    """
+    comparisons = collections.deque()  # futures in segment order, the earliest divergence is the first one
+    checkpoints = 0
+    instructions = 0
+    stopped = None
+    start = 0
+    try:
+        while True:
+            reference = None
+            if stopped is None and start < max_instructions:
+                end = min(start + segment_size, max_instructions)
+                states = None
+                if golden is not None:
+                    states = [state for state in golden.states
+                              if start <= state.instruction < end or state.instruction == end == max_instructions]
+                comparisons.append(submit(compare_segment, start, end, snapshot, every, states))
+                reference = submit(advance_segment, start, end, snapshot)
+            while comparisons and (reference is None or comparisons[0].done()):
+                compared, divergence = comparisons.popleft().result()
+                checkpoints += compared
+                if divergence is not None:
+                    return DiffResult(divergence, instructions, checkpoints)
+            if reference is None:
+                return DiffResult(None, instructions, checkpoints)
+            instructions, stopped, snapshot = reference.result()
+            start = end
+    finally:
+        for comparison in comparisons:
+            comparison.cancel()
+
+
+def run_difftest(rom, engines=('run', 'step'), max_instructions=100000000, every=CHECKPOINT_INTERVAL,
+                 segment_size=SEGMENT_SIZE, golden=None, patches=(), seed=None, setup=None, entry=None,
+                 max_workers=None):
+    """
+        run rom in two engines (names from ENGINES) and compare a, x, pc, sp, ccr, the cycle count and a hash
+        of memory and stack every every instructions, or run it in one engine against a Golden recording.
+        the work is cut into segments of segment_size instructions. a chain of reference jobs in the pool runs
+        the plain run loop from one segment start to the next, each snapshot it ends on starts the compare job
+        for that segment, and those run side by side on the rest of the pool. the earliest mismatch is the
+        first divergence. a mismatch between two engines is narrowed down to one instruction by stepping from
+        the last checkpoint they agreed on.
+        limits: segment n+1 can only start once the reference got there, so the wall time is at least one run
+        loop pass through max_instructions, the compare jobs are what the pool takes off it. snapshots go to
+        the workers pickled, pending interrupts with a callable handler (scheduled by setup for instance) only
+        work with max_workers=0 unless the callable pickles
+        setup - setup(parser) applied to every machine, has to pickle (a module level function) for the pool
+        entry - pc to start at, None for 0x0000
+        max_workers - pool size, defaults to the number of cpus, 0 runs everything in this process
+        :return: DiffResult
+    """
+    if golden is not None:
+        engines = engines[:1]
+        seed = golden.seed
+        every = golden.interval
+        if golden.states:
+            max_instructions = min(max_instructions, golden.states[-1].instruction)
+    elif len(engines) != 2:
+        raise ValueError("need two engines to compare, got {}".format(len(engines)))
+    segment_size = max(every, segment_size // every * every)
+
+    reference = _Machine('run', rom, patches, seed, setup)
+    if entry is not None:
+        reference.parser.registers.pc = entry
+    seed = reference.parser.registers.seed  # one was picked when not given, every machine gets the same
+    initargs = (engines, rom, patches, seed, setup)
+    snapshot = reference.parser.snapshot()
+
+    if max_workers == 0:
+        _init_worker(*initargs)
+        return _compare_segments(_run_now, snapshot, max_instructions, segment_size, every, golden)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                                initargs=initargs) as executor:
+        return _compare_segments(executor.submit, snapshot, max_instructions, segment_size, every, golden)
+
+
+def record_golden(stream, rom, max_instructions=100000000, every=CHECKPOINT_INTERVAL, engine='run', patches=(),
+                  seed=None, setup=None, entry=None):
+    """
+        run rom once in engine and write its state at every checkpoint to stream (binary), the start and the
+        point it halted at included. a machine that raises ends the recording at the checkpoint before
+        :return: the Golden that was written
+    """
+    machine = _Machine(engine, rom, patches, seed, setup)
+    if entry is not None:
+        machine.parser.registers.pc = entry
+    seed = machine.parser.registers.seed
+    stream.write(_HEADER.pack(MAGIC, FORMAT_VERSION, seed, every))
+    states = []
+    state = machine.state()
+    while True:
+        states.append(state)
+        stream.write(CHECKPOINT.pack(state.instruction, state.cycles, state.a, state.x, state.pc, state.sp,
+                                     state.ccr, bytes.fromhex(state.digest)))
+        if state.instruction >= max_instructions:
+            break
+        machine.advance_to(min((state.instruction // every + 1) * every, max_instructions))
+        if machine.instructions is None or machine.instructions == state.instruction:
+            break
+        state = machine.state()
+    return Golden(seed, every, states)
+
+
+def read_golden(stream):
+    magic, version, seed, every = _HEADER.unpack(stream.read(_HEADER.size))
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("not a version {} golden file".format(FORMAT_VERSION))
+    states = []
+    for fields in CHECKPOINT.iter_unpack(stream.read()):
+        states.append(State(*fields[:-1], digest=fields[-1].hex(), stopped=None))
+    return Golden(seed, every, states)
+
+
+def print_divergence(divergence):
+    end = divergence.expected.instruction
+    if end is not None and end > divergence.instruction + 1:
+        print("diverged between instruction {0} and {1}, the interval starts at {2:#06x}".format(
+            divergence.instruction, end, divergence.pc))
+    else:
+        print("diverged after {0} instructions, at the instruction at {1:#06x}".format(
+            divergence.instruction, divergence.pc))
+    for name, expected, actual in zip(State._fields, divergence.expected, divergence.actual):
+        if expected != actual:
+            print("  {0:<12} {1!s:>20} != {2!s}".format(name, expected, actual))
+
+
+def _advance_faulty(parser, instructions):
+    """
+        single steps with a bad INCA, 0x7F goes to 0x00
+    """
+    state = parser.registers
+    memory = parser.memory
+    executed = 0
+    while executed < instructions:
+        wrong = memory.read(state.pc) == 0x4C and state.a == 0x7F
+        executed += parser.step()
+        if wrong:
+            state.a = 0x00
+    return executed
+
+
+def test_divergence_is_located():
+    rom = bytes([0x4C, 0x20, 0xFD])  # INCA, BRA -3
+    ENGINES['faulty'] = Engine(None, _advance_faulty)
+    try:
+        result = run_difftest(rom, ('run', 'faulty'), max_instructions=5000, every=100, segment_size=200, seed=1,
+                              max_workers=0)
+    finally:
+        del ENGINES['faulty']
+    divergence = result.divergence
+    assert (divergence.instruction, divergence.pc) == (0x7F * 2, 0x0000)  # the 128th INCA, in the second segment
+    assert (divergence.expected.a, divergence.actual.a) == (0x80, 0x00)
+    assert divergence.expected.instruction == divergence.instruction + 1
+
+
+def test_pool_matches_in_process():
+    import io
+    rom = bytes([0x4C, 0x20, 0xFD])
+    golden = record_golden(io.BytesIO(), rom, max_instructions=3000, every=100, seed=1)
+    assert len(golden.states) == 31
+    tampered = golden.states[:17] + [golden.states[17]._replace(x=golden.states[17].x ^ 1)] + golden.states[18:]
+    for max_workers in (0, 2):
+        result = run_difftest(rom, ('run', 'step'), max_instructions=3000, every=100, segment_size=500, seed=1,
+                              max_workers=max_workers)
+        assert result == DiffResult(None, 3000, 30)
+        result = run_difftest(rom, ('block',), golden=Golden(golden.seed, golden.interval, tampered),
+                              segment_size=500, max_workers=max_workers)
+        assert (result.divergence.instruction, result.divergence.expected) == (1600, tampered[17])
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="run a rom in two engines, or against a golden file, "
+                                                          "and report where they first disagree")
+    argument_parser.add_argument("image", help="raw binary, intel hex or s-record file")
+    argument_parser.add_argument("-e", "--engine", action="append", choices=list(ENGINES),
+                                 help="engine to run, twice to compare two (default run and step)")
+    argument_parser.add_argument("-n", "--instructions", type=int, default=100000000)
+    argument_parser.add_argument("--every", type=int, default=CHECKPOINT_INTERVAL, help="instructions per checkpoint")
+    argument_parser.add_argument("--segment", type=int, default=SEGMENT_SIZE, help="instructions per pool job")
+    argument_parser.add_argument("-j", "--workers", type=int, help="pool size, 0 for none")
+    argument_parser.add_argument("-s", "--seed", type=int, help="power up seed")
+    argument_parser.add_argument("-g", "--golden", help="compare against this golden file")
+    argument_parser.add_argument("-r", "--record", help="write a golden file instead of comparing")
+    options = argument_parser.parse_args()
+
+    image = read_image(options.image)
+    engine_names = tuple(options.engine or ('run', 'step'))
+    if options.record:
+        with open(options.record, 'wb') as golden_file:
+            recording = record_golden(golden_file, b"", options.instructions, options.every, engine_names[0],
+                                      image.segments, options.seed, entry=image.entry)
+        print("recorded {0} checkpoints up to instruction {1}".format(len(recording.states),
+                                                                       recording.states[-1].instruction))
+    else:
+        golden_recording = None
+        if options.golden:
+            with open(options.golden, 'rb') as golden_file:
+                golden_recording = read_golden(golden_file)
+        result = run_difftest(b"", engine_names, options.instructions, options.every, options.segment,
+                              golden_recording, image.segments, options.seed, entry=image.entry,
+                              max_workers=options.workers)
+        print("{0} instructions, {1} checkpoints".format(result.instructions, result.checkpoints))
+        if result.divergence is None:
+            print("no divergence")
+        else:
+            print_divergence(result.divergence)
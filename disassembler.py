@@ -0,0 +1,266 @@
+import argparse
+import collections
+import hashlib
+
+from opcodes import load_opcode_table
+
+
+# the user vectors at the top of the 16k part (Memory._user_vectors), reset is the last one at 0x3ffe
+VECTOR_ADDRESSES = tuple(range(0x3FF4, 0x4000, 2))
+
+# mnemonics that never fall through to the next instruction
+_NO_FALL_THROUGH = frozenset(['BRA', 'JMP', 'RTS', 'RTI'])
+
+_CACHE_SIZE = 8  # listings kept, least recently used goes first
+_CACHE_MAX_INSTRUCTIONS = 0x4000  # longer listings are streamed without keeping a copy, a few MB each otherwise
+_cache = collections.OrderedDict()  # (rom sha256, walk, parameters) -> tuple of Instructions
+
+
+class Instruction(collections.namedtuple('Instruction', ['address', 'opcode', 'mnemon', 'mode', 'operands', 'size',
+                                                         'target'])):
+    """
+        address - where the opcode is, opcode - the byte, mnemon - None for a byte that isnt an opcode,
+        mode - addressing mode, operands - decoded operand values, size - bytes including the opcode,
+        target - where a branch or a direct jump/call goes, None for everything else
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        if self.mnemon is None:
+            return "{0:#06x}: FCB   ${1:02X}".format(self.address, self.opcode)
+        return "{0:#06x}: {1:<5} {2}".format(self.address, self.mnemon, self.operand_text()).rstrip()
+
+    def operand_text(self):
+        mode = self.mode
+        operands = self.operands
+        if mode == 'BTB':  # BRSET/BRCLR n,dd,rr
+            return "{0},${1:02X},${2:04X}".format((self.opcode & 0x0E) >> 1, operands[0], self.target)
+        if mode == 'BSC':  # BSET/BCLR n,dd
+            return "{0},${1:02X}".format((self.opcode & 0x0E) >> 1, operands[0])
+        if mode == 'REL':
+            return "${0:04X}".format(self.target)
+        if mode == 'IMM':
+            return "#${0:02X}".format(operands[0])
+        if mode == 'DIR':
+            return "${0:02X}".format(operands[0])
+        if mode == 'EXT':
+            return "${0:04X}".format(operands[0])
+        if mode == 'IX':
+            return ",X"
+        if mode == 'IX1':
+            return "${0:02X},X".format(operands[0])
+        if mode == 'IX2':
+            return "${0:04X},X".format(operands[0])
+        return ""
+
+    @property
+    def falls_through(self):
+        return self.mnemon is not None and self.mnemon not in _NO_FALL_THROUGH
+
+
+def decode(image, offset, base=0x0000, opcode_table=None):
+    """
+        decode one instruction out of image (bytes like) at image offset, base is the address of image[0]
+        :return: Instruction, a one byte FCB for illegal opcodes and instructions cut off by the end of the image
+    """
+    opcode_table = opcode_table or load_opcode_table()[0]
+    address = base + offset
+    opcode = image[offset]
+    info = opcode_table[opcode]
+    size = 1 + sum(info.argument_sizes) if info is not None else 1
+    if info is None or offset + size > len(image):
+        return Instruction(address, opcode, None, None, (), 1, None)
+
+    operands = []
+    position = offset + 1
+    for argument_size in info.argument_sizes:
+        operands.append(int.from_bytes(image[position:position + argument_size], 'big'))
+        position += argument_size
+
+    target = None
+    mode = info.addressing_mode
+    if mode == 'REL' or mode == 'BTB':
+        displacement = operands[-1] - 0x100 if operands[-1] & 0x80 else operands[-1]
+        target = (address + size + displacement) & 0xFFFF
+    elif info.mnemon in ('JMP', 'JSR') and mode in ('DIR', 'EXT'):
+        target = operands[0]
+    return Instruction(address, opcode, info.mnemon, mode, tuple(operands), size, target)
+
+
+def linear_sweep(image, base=0x0000, start=None, end=None):
+    """
+        decode image front to back, every byte ends up in exactly one Instruction
+        start/end - address range to cover, defaults to the whole image
+        :return: generator of Instructions, in address order
+    """
+    start = base if start is None else start
+    end = base + len(image) if end is None else end
+    return _cached(image, ('linear', base, start, end), lambda: _linear_sweep(image, base, start, end))
+
+
+def _linear_sweep(image, base, start, end):
+    opcode_table = load_opcode_table()[0]
+    offset = start - base
+    end_offset = min(end - base, len(image))
+    while offset < end_offset:
+        instruction = decode(image, offset, base, opcode_table)
+        yield instruction
+        offset += instruction.size
+
+
+def recursive_descent(image, base=0x0000, entry_points=None):
+    """
+        follow control flow from the entry points, so data mixed in with the code is never decoded as code.
+        indexed jumps and returns end a path, their targets cant be known without running the code.
+        entry_points - addresses to start from, defaults to every vector inside the image that points into it
+        :return: generator of Instructions in the order they are reached, each address at most once
+    """
+    if entry_points is None:
+        entry_points = vector_targets(image, base)
+    entry_points = tuple(entry_points)
+    return _cached(image, ('recursive', base, entry_points), lambda: _recursive_descent(image, base, entry_points))
+
+
+def _recursive_descent(image, base, entry_points):
+    opcode_table = load_opcode_table()[0]
+    visited = bytearray(len(image))
+    pending = list(reversed(entry_points))
+    while pending:
+        address = pending.pop()
+        offset = address - base
+        while 0 <= offset < len(image) and not visited[offset]:
+            instruction = decode(image, offset, base, opcode_table)
+            visited[offset] = 1
+            yield instruction
+            if instruction.target is not None:
+                pending.append(instruction.target)
+            if not instruction.falls_through:
+                break
+            offset += instruction.size
+
+
+def vector_targets(image, base=0x0000):
+    """
+        addresses the reset and interrupt vectors inside image point at, reset first
+    """
+    targets = []
+    for vector in reversed(VECTOR_ADDRESSES):
+        offset = vector - base
+        if 0 <= offset and offset + 2 <= len(image):
+            target = (image[offset] << 8) | image[offset + 1]
+            if 0 <= target - base < len(image) and target not in targets:
+                targets.append(target)
+    return targets
+
+
+def _cached(image, key, generate):
+    """
+        replay a finished listing of the same rom from the cache, otherwise stream it while keeping a copy
+    """
+    key = (hashlib.sha256(image).digest(),) + key
+    instructions = _cache.get(key)
+    if instructions is not None:
+        _cache.move_to_end(key)
+        return iter(instructions)
+    return _caching_generator(key, generate())
+
+
+def _caching_generator(key, instructions):
+    decoded = []
+    for instruction in instructions:
+        if decoded is not None:
+            decoded.append(instruction)
+            if len(decoded) > _CACHE_MAX_INSTRUCTIONS:
+                decoded = None
+        yield instruction
+    if decoded is None:
+        return
+    _cache[key] = tuple(decoded)  # only listings that were read to the end get here
+    while len(_cache) > _CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _test_image():
+    """
+        0x100 bytes at 0x3f00 with the vectors at the end: reset -> LDA #1, BSR, BRA *, irq -> RTS, then data
+    """
+    image = bytearray(0x100)
+    image[:8] = bytes([0xA6, 0x01, 0xAD, 0x02, 0x20, 0xFE, 0x81, 0x31])
+    image[0xFE:] = bytes([0x3F, 0x00])  # reset
+    image[0xFA:0xFC] = bytes([0x3F, 0x06])  # irq
+    image[0xF8:0xFA] = bytes([0x3F, 0x00])  # timer, same as reset
+    image[0xF6:0xF8] = bytes([0x80, 0x00])  # outside the image
+    return bytes(image)
+
+
+def test_walks():
+    image = _test_image()
+    assert vector_targets(image, 0x3F00) == [0x3F00, 0x3F06]
+    assert vector_targets(image) == []  # at 0x0000 the vectors arent in the image
+
+    listing = list(linear_sweep(image, 0x3F00))
+    assert [instruction.address for instruction in listing[:6]] == [0x3F00, 0x3F02, 0x3F04, 0x3F06, 0x3F07, 0x3F08]
+    assert sum(instruction.size for instruction in listing) == len(image)  # every byte exactly once
+    assert [str(instruction) for instruction in listing[:5]] == [
+        "0x3f00: LDA   #$01", "0x3f02: BSR   $3F06", "0x3f04: BRA   $3F04", "0x3f06: RTS", "0x3f07: FCB   $31"]
+    assert [instruction.address for instruction in linear_sweep(image, 0x3F00, 0x3F02, 0x3F06)] == [0x3F02, 0x3F04]
+
+    descent = list(recursive_descent(image, 0x3F00))
+    assert [instruction.address for instruction in descent] == [0x3F00, 0x3F02, 0x3F04, 0x3F06]  # no data decoded
+    assert descent[1].target == 0x3F06 and not descent[2].falls_through
+    assert [instruction.address for instruction in recursive_descent(image, 0x3F00, [0x3F06])] == [0x3F06]
+
+
+def test_cache():
+    image = _test_image()
+    _cache.clear()
+    first = linear_sweep(image, 0x3F00)
+    assert not _cache  # nothing kept before the listing is read to the end
+    listing = list(first)
+    assert len(_cache) == 1
+    again = linear_sweep(image, 0x3F00)
+    assert list(again) == listing and type(again) is not type(first)  # replayed, not decoded again
+
+    partial = linear_sweep(image, 0x3F00, 0x3F00, 0x3F80)
+    next(partial)
+    next(partial)
+    partial.close()
+    assert len(_cache) == 1  # a half read listing would replay as a short one
+
+    for end in range(0x3F01, 0x3F01 + _CACHE_SIZE):
+        list(linear_sweep(image, 0x3F00, 0x3F00, end))
+    assert len(_cache) == _CACHE_SIZE
+    assert (hashlib.sha256(image).digest(), 'linear', 0x3F00, 0x3F00, 0x4000) not in _cache  # least recent went
+    list(linear_sweep(image, 0x3F00, 0x3F00, 0x3F01))  # now the most recent
+    list(recursive_descent(image, 0x3F00))
+    assert (hashlib.sha256(image).digest(), 'linear', 0x3F00, 0x3F00, 0x3F01) in _cache
+    assert (hashlib.sha256(image).digest(), 'linear', 0x3F00, 0x3F00, 0x3F02) not in _cache
+
+    nops = bytes([0x9D]) * (_CACHE_MAX_INSTRUCTIONS + 1)
+    _cache.clear()
+    assert len(list(linear_sweep(nops))) == len(nops)
+    assert not _cache  # too long to keep
+    list(linear_sweep(nops[:-1]))
+    assert len(_cache) == 1
+    _cache.clear()
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="disassemble a 6805 rom image")
+    argument_parser.add_argument("rom", help="raw binary image")
+    argument_parser.add_argument("-b", "--base", type=lambda value: int(value, 0), default=0x0000,
+                                 help="address of the first byte of the image")
+    argument_parser.add_argument("-r", "--recursive", action="store_true",
+                                 help="follow control flow from the vectors instead of a linear sweep")
+    argument_parser.add_argument("-e", "--entry", type=lambda value: int(value, 0), action="append",
+                                 help="entry point for --recursive, instead of the vectors")
+    options = argument_parser.parse_args()
+
+    with open(options.rom, 'rb') as rom_file:
+        rom = rom_file.read()
+    if options.recursive:
+        listing = recursive_descent(rom, options.base, options.entry)
+    else:
+        listing = linear_sweep(rom, options.base)
+    for instruction in listing:
+        print(instruction)
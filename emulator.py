@@ -1,10 +1,128 @@
+import argparse
+import collections
+import functools
 import struct
+import sys
+import time
 
-import re
-
+from block_cache import BlockCache
 from commands import Commands
+from image_formats import FORMATS, read_image
 from memory import Memory
-from registers import Registers
+from opcodes import OPCODE_MAP_FILE, load_opcode_table
+from registers import CCR_I, HALT_IDLE, Registers
+from scheduler import INTERRUPT_CYCLES, NEVER
+
+
+STOP_MAX_INSTRUCTIONS = 'max_instructions'
+STOP_MAX_CYCLES = 'max_cycles'
+STOP_UNTIL_PC = 'until_pc'
+STOP_UNTIL = 'until'
+STOP_HALTED = 'halted'  # WAIT or STOP with no interrupt left that could wake the cpu
+
+BUS_FREQUENCY = 2000000  # Hz, a 4MHz crystal divided by two
+
+
+class RunResult(collections.namedtuple('RunResult', ['reason', 'instructions', 'cycles', 'pc', 'elapsed'])):
+    __slots__ = ()
+
+    @property
+    def emulated_mhz(self):
+        """
+            bus cycles emulated per wall clock second, in MHz
+        """
+        return self.cycles / self.elapsed / 1e6 if self.elapsed else 0.0
+
+    def realtime_factor(self, bus_frequency=BUS_FREQUENCY):
+        """
+            how many times faster than the real part this run went, 1.0 is real time
+        """
+        return self.emulated_mhz * 1e6 / bus_frequency
+
+
+# registers - a, x, pc, ccr, cycles and stack as bytes, memory - see Memory.snapshot, interrupts - pending, as bytes,
+# handlers - callables of pending peripheral interrupts, see InterruptScheduler.snapshot. with no handlers pending
+# everything is bytes, the snapshot can be hashed, pickled or written out as is
+Snapshot = collections.namedtuple('Snapshot', ['registers', 'memory', 'interrupts', 'handlers'])
+
+_NO_STOP_ADDRESSES = bytes(0x10000)
+
+
+# operands of an instruction at the top of memory wrap around to 0x0000 like the address bus does
+def _no_operand_handler(command, memory):
+    def handler(pc):
+        command()
+    return handler
+
+
+def _byte_operand_handler(command, memory):
+    def handler(pc):
+        command(memory.read((pc + 1) & 0xFFFF))
+    return handler
+
+
+def _word_operand_handler(command, memory):
+    def handler(pc):
+        # big endian, high byte first
+        command((memory.read((pc + 1) & 0xFFFF) << 8) | memory.read((pc + 2) & 0xFFFF))
+    return handler
+
+
+def _two_byte_operand_handler(command, memory):
+    def handler(pc):
+        command(memory.read((pc + 1) & 0xFFFF), memory.read((pc + 2) & 0xFFFF))
+    return handler
+
+
+def _any_operand_handler(argument_sizes):
+    def make_handler(command, memory):
+        def handler(pc):
+            arguments = []
+            pc += 1
+            for argument_size in argument_sizes:
+                argument = 0
+                for byte_address in range(pc, pc + argument_size):
+                    argument = (argument << 8) | memory.read(byte_address & 0xFFFF)
+                arguments.append(argument)
+                pc += argument_size
+            command(*arguments)
+        return handler
+    return make_handler
+
+
+_OPERAND_HANDLERS = {(): _no_operand_handler, (1,): _byte_operand_handler, (2,): _word_operand_handler,
+                     (1, 1): _two_byte_operand_handler}
+
+
+def _illegal_opcode_handler(opcode):
+    def handler(pc):
+        raise ValueError("illegal opcode {0:#04x} at {1:#06x}".format(opcode, pc))
+    return handler
+
+
+_dispatch_plans = {}  # (id(opcode table), commands class) -> (opcode table, plan)
+
+
+def _dispatch_plan(opcode_table, commands_class):
+    """
+        everything about the dispatch table that doesnt depend on a parser, worked out once per opcode table:
+        per opcode either the (shared) illegal opcode handler or (method name, opcode aware, handler maker)
+    """
+    key = (id(opcode_table), commands_class)
+    cached = _dispatch_plans.get(key)
+    if cached is not None and cached[0] is opcode_table:
+        return cached[1]
+    plan = []
+    for opcode, info in enumerate(opcode_table):
+        if info is None:
+            plan.append(_illegal_opcode_handler(opcode))
+        else:
+            name, opcode_aware = commands_class.handler_spec(info.mnemon)
+            make_handler = _OPERAND_HANDLERS.get(info.argument_sizes) or _any_operand_handler(info.argument_sizes)
+            plan.append((name, opcode_aware, make_handler))
+    plan = tuple(plan)
+    _dispatch_plans[key] = (opcode_table, plan)  # the table is kept alive, so its id cant be reused
+    return plan
 
 
 class OpCodeParser(object):
@@ -13,24 +131,302 @@ class OpCodeParser(object):
 
         self._commands = commands
         self._memory = memory
-        self._state = registers
-        self._opcode_map_file = "./opcode_map.csv"
-        self._opcode_map = self._init_opcodes(self._commands)
+        self._state = state
+        self._opcode_map_file = OPCODE_MAP_FILE
+        self._opcode_table, self._opcode_map = self._init_opcodes(self._commands)
+        self._plain_dispatch_table = self._build_dispatch_table()
+        self._dispatch_table = self._plain_dispatch_table
+        self._cycle_table = tuple(info.cycles if info is not None else 0 for info in self._opcode_table)
+        self._block_cache = None
+        self._tracer = None
+        self._profiler = None
+        self.skipped_instructions = 0  # idle loop iterations fast forwarded so far, they never reach until or a tracer
         self._code_buffer = code_buffer
         self._memory.write_buffer_to_memory(0x0000, self._code_buffer)
 
+    @property
+    def registers(self):
+        return self._state
+
+    @property
+    def memory(self):
+        return self._memory
+
+    def snapshot(self):
+        """
+            freeze the whole machine, cheap enough to take once after boot and restore for every run
+        """
+        registers, interrupts, handlers = self._state.snapshot()
+        return Snapshot(registers, self._memory.snapshot(), interrupts, handlers)
+
+    def restore(self, snapshot):
+        self._memory.restore(snapshot.memory)
+        self._state.restore(snapshot.registers, snapshot.interrupts, snapshot.handlers)
+        if self._tracer is not None:
+            self._tracer.cycles = self._state.cycles
+
+    def load_image(self, path, image_format=None, address=0x0000):
+        """
+            put a raw, intel hex or s-record file into memory, see image_formats.read_image
+            :return: the Image, its digest names the firmware for anything cached per rom
+        """
+        return read_image(path, image_format, address).load(self._memory)
+
+    def set_tracer(self, tracer):
+        """
+            start writing every executed instruction to tracer (a tracer.Tracer), None stops tracing.
+            the tracer gets its own copy of the dispatch table, untraced runs never look at it
+        """
+        self._tracer = tracer
+        if tracer is not None:
+            tracer.cycles = self._state.cycles
+        self._install_dispatch_table()
+
+    def set_profiler(self, profiler):
+        """
+            count executed instructions into profiler (a profiler.Profiler), None stops profiling.
+            like tracing this only swaps the dispatch table, a parser without one pays nothing
+        """
+        self._profiler = profiler
+        self._install_dispatch_table()
+
+    def _install_dispatch_table(self):
+        dispatch_table = self._plain_dispatch_table  # wrapping copies it, so with neither attached it is back as built
+        if self._profiler is not None:
+            dispatch_table = self._profiler.wrap(dispatch_table, self._state)
+        if self._tracer is not None:
+            dispatch_table = self._tracer.wrap(dispatch_table, self._opcode_table, self._state)
+        self._dispatch_table = dispatch_table
+
     def _init_opcodes(self, commands):
-        opcodes = self._get_opcodes_from_file(self._opcode_map_file)
-        return opcodes
+        return load_opcode_table(self._opcode_map_file)
+
+    def _build_dispatch_table(self):
+        """
+            build one handler per opcode byte (0x00 - 0xFF), every handler takes the address of its
+            opcode, decodes its own operands and runs the bound command, so a step is one index and one call.
+            only the binding to this parser's commands and memory happens here, see _dispatch_plan
+        """
+        commands = self._commands
+        memory = self._memory  # not memory.read, it changes once i/o regions get mapped
+        dispatch_table = []
+        for opcode, entry in enumerate(_dispatch_plan(self._opcode_table, type(commands))):
+            if callable(entry):
+                dispatch_table.append(entry)  # illegal opcode, nothing to bind
+                continue
+            name, opcode_aware, make_handler = entry
+            command = getattr(commands, name)
+            if opcode_aware:
+                command = functools.partial(command, opcode)
+            dispatch_table.append(make_handler(command, memory))
+        return dispatch_table
 
     def step(self, fake=False):
+        """
+            run one instruction, a halted cpu only looks at its interrupts
+            :return: instructions executed, iterations of an idle loop skipped on the way count as well
+        """
+        if fake:
+            self._print_instruction(self._state.pc)
+            return 0
+
+        if self._state.halted:
+            return self._service_interrupts()
+
         pc = self._state.pc
+        opcode = self._memory.read(pc)
+        self._dispatch_table[opcode](pc)
+        self._state.cycles += self._cycle_table[opcode]
+        if self._state.cycles >= self._state.interrupts.next_cycle:
+            return 1 + self._service_interrupts()
+        return 1
+
+    def _service_interrupts(self, end_cycles=NEVER, instructions_left=NEVER):
+        """
+            take the interrupt the scheduler has for now, if the I bit lets it through.
+            a cpu in WAIT, STOP or spinning on a branch to itself is first fast forwarded to the next interrupt
+            that could wake it, or to end_cycles if that comes first
+            :return: instructions skipped by the fast forward
+        """
+        state = self._state
+        skipped = self._fast_forward(end_cycles, instructions_left) if state.halted else 0
+        interrupt = state.interrupts.pop(state.cycles, state.ccr & CCR_I)
+        if interrupt is None:
+            return skipped
+        state.halted = 0
+        if interrupt.handler is not None:
+            interrupt.handler()
+        else:
+            self._commands.interrupt(interrupt.vector)
+            state.cycles += INTERRUPT_CYCLES
+            if self._tracer is not None:
+                self._tracer.cycles = state.cycles
+        return skipped
+
+    def _fast_forward(self, end_cycles, instructions_left):
+        state = self._state
+        wake = min(state.interrupts.next_wake(state.ccr & CCR_I), end_cycles)
+        if state.halted == HALT_IDLE:
+            # the loop instruction keeps running until then, skip whole iterations so the cycle count stays exact
+            state.halted = 0
+            if wake == NEVER:
+                return 0  # nothing will ever break the loop, leave it to max_instructions
+            period = self._cycle_table[self._memory.read(state.pc)]
+            iterations = max(0, min(-(-(wake - state.cycles) // period), instructions_left))
+            state.cycles += iterations * period
+            skipped = iterations
+            self.skipped_instructions += skipped
+        else:
+            if wake != NEVER:
+                state.cycles = max(state.cycles, wake)  # the clock runs on while the cpu sleeps
+            skipped = 0
+        if self._tracer is not None:
+            self._tracer.cycles = state.cycles
+        return skipped
+
+    def run(self, max_instructions=None, max_cycles=None, until_pc=None, until=None):
+        """
+            execute until one of the stop conditions hits, conditions are checked after every instruction
+            max_instructions - stop once this many instructions ran
+            max_cycles - stop once at least this many cycles were spent
+            until_pc - an address or an iterable of addresses, stop when pc lands on one of them. a 64k
+                       bytearray with non zero at those addresses is used as is, changes made while running count
+            until - until(registers) -> bool, stop when it returns true
+            registers.cycles is only brought up to date between instructions for until, interrupts, and at the end.
+            pending interrupts are looked at once the cycle count reaches the scheduler's next_cycle.
+            WAIT, STOP and branches to themselves jump straight to the next interrupt's cycle, the skipped
+            iterations of an idle loop count as instructions but never reach until or a tracer
+            :return: RunResult(reason, instructions, cycles, pc, elapsed wall clock seconds)
+        """
+        # everything the loop touches lives in locals
+        dispatch_table = self._dispatch_table
+        cycle_table = self._cycle_table
+        state = self._state
+        read = self._memory.read
+        scheduler = state.interrupts
+        instruction_limit = max_instructions if max_instructions is not None else sys.maxsize
+        stop_addresses = self._stop_address_map(until_pc)
+        start_cycles = state.cycles
+        end_cycles = start_cycles + max_cycles if max_cycles is not None else sys.maxsize
+        if self._tracer is not None:
+            self._tracer.cycles = start_cycles
+        start_time = time.perf_counter()
+
+        instructions = 0
+        if state.halted:  # still asleep from the last run
+            instructions += self._service_interrupts(end_cycles, instruction_limit)
+            if state.halted:
+                reason = STOP_HALTED if state.cycles < end_cycles else STOP_MAX_CYCLES
+                return RunResult(reason, instructions, state.cycles - start_cycles, state._pc,
+                                 time.perf_counter() - start_time)
+        cycles = state.cycles  # the running total, registers.cycles only gets it when something looks
+        reason = None
+        if until_pc is None and until is None:
+            # nothing to look at after an instruction but the limits and the scheduler
+            while instructions < instruction_limit and cycles < end_cycles:
+                pc = state._pc
+                opcode = read(pc)
+                dispatch_table[opcode](pc)
+                instructions += 1
+                cycles += cycle_table[opcode]
+                if cycles >= scheduler.next_cycle:
+                    state.cycles = cycles
+                    instructions += self._service_interrupts(end_cycles, instruction_limit - instructions)
+                    cycles = state.cycles
+                    if state.halted and cycles < end_cycles:
+                        reason = STOP_HALTED
+                        break
+            else:
+                reason = STOP_MAX_INSTRUCTIONS if instructions >= instruction_limit else STOP_MAX_CYCLES
+            state.cycles = cycles
+            return RunResult(reason, instructions, cycles - start_cycles, state._pc, time.perf_counter() - start_time)
+
+        while instructions < instruction_limit and cycles < end_cycles:
+            pc = state._pc
+            opcode = read(pc)
+            dispatch_table[opcode](pc)
+            instructions += 1
+            cycles += cycle_table[opcode]
+            if cycles >= scheduler.next_cycle:
+                state.cycles = cycles
+                instructions += self._service_interrupts(end_cycles, instruction_limit - instructions)
+                cycles = state.cycles
+                if state.halted and cycles < end_cycles:
+                    reason = STOP_HALTED
+                    break
+            if stop_addresses[state._pc]:
+                reason = STOP_UNTIL_PC
+                break
+            if until is not None:
+                state.cycles = cycles
+                if until(state):
+                    reason = STOP_UNTIL
+                    break
+        else:
+            reason = STOP_MAX_INSTRUCTIONS if instructions >= instruction_limit else STOP_MAX_CYCLES
+
+        state.cycles = cycles
+        return RunResult(reason, instructions, cycles - start_cycles, state._pc, time.perf_counter() - start_time)
+
+    def _stop_address_map(self, until_pc):
+        if until_pc is None:
+            return _NO_STOP_ADDRESSES
+        if type(until_pc) == bytearray and len(until_pc) == len(_NO_STOP_ADDRESSES):
+            return until_pc
+        stop_addresses = bytearray(len(_NO_STOP_ADDRESSES))
+        for address in ([until_pc] if type(until_pc) == int else until_pc):
+            stop_addresses[address] = 1
+        return stop_addresses
+
+    def step_block(self):
+        """
+            run the whole basic block starting at pc through the translation cache,
+            hardware interrupts are only looked at between blocks
+            :return: (instructions executed, cycles spent)
+        """
+        if self._tracer is not None or self._profiler is not None:
+            # blocks call straight into Commands, so instrumented runs go one instruction at a time
+            cycles = self._state.cycles
+            self.step()
+            return 1, self._state.cycles - cycles
+        if self._block_cache is None:
+            self._block_cache = BlockCache(self)
+        start_cycles = self._state.cycles
+        if self._state.halted:
+            self._service_interrupts()
+            return 0, self._state.cycles - start_cycles
+        instructions, cycles = self._block_cache.lookup(self._state.pc).run()
+        self._state.cycles += cycles
+        if self._state.cycles >= self._state.interrupts.next_cycle:
+            instructions += self._service_interrupts()
+        return instructions, self._state.cycles - start_cycles
+
+    def decode(self, pc):
+        """
+            decode the instruction at pc without executing it
+            :return: (opcode, OpcodeInfo or None if illegal, list of arguments, instruction size in bytes)
+        """
+        read = self._memory.read
+        opcode = read(pc)
+        info = self._opcode_table[opcode]
+        if info is None:
+            return opcode, None, [], 1
+        arguments = []
+        address = pc + 1
+        for argument_size in info.argument_sizes:
+            argument = 0
+            for byte_address in range(address, address + argument_size):
+                argument = (argument << 8) | read(byte_address & 0xFFFF)
+            arguments.append(argument)
+            address += argument_size
+        return opcode, info, arguments, address - pc
+
+    def _print_instruction(self, pc):
         opcode = self._memory.read(pc)
         opcode = self._parse_opcode(opcode) if type(opcode) != int else '{0:#04x}'.format(opcode)
         pc += 1
         mnemon = self._opcode_map.get(opcode, None).get('mnemon')
         argument_sizes = self._opcode_map.get(opcode, None).get('argument_sizes') # get amount and size of arguments for this opcode
-        arguments = []
         hex_encoded_arguments = []
         for argument_size in argument_sizes:
             argument = b''
@@ -38,17 +434,10 @@ class OpCodeParser(object):
                 argument += struct.pack('B', self._memory.read(byte_address))
             argument = self._unpack_argument(argument)
             hex_encoded_arguments.append(hex(argument))
-            arguments.append(argument)
             pc += argument_size
 
-        if fake:
-            message = "{mnemon} {arguments}".format(mnemon=mnemon, arguments=hex_encoded_arguments)
-            print(message)
-        else:
-            self._commands.execute_command(opcode, mnemon, *arguments)
-            if self._state.are_there_any_hardware_interruprs():
-                interrupt = self._state.dequeue_hardware_interrupt()
-                interrupt()
+        message = "{mnemon} {arguments}".format(mnemon=mnemon, arguments=hex_encoded_arguments)
+        print(message)
 
     def _unpack_argument(self, argument):
         argument_bytesize = len(argument)
@@ -76,37 +465,73 @@ class OpCodeParser(object):
     def parse(self):
         pass
 
-    def _get_opcodes_from_file(self, opcode_map_file):
-        opcode_map = {}
-        with open(opcode_map_file) as input_file:
-            lines = input_file.readlines()
-            for line in lines:
-                if re.match(r"^\s*\n$", line) or re.match(r"^\/\/.*$", line):
-                    continue
-                line = line.rstrip("\n")
-                line = re.sub("\s+$", "", line)
-                line = re.sub(r"\/\/.+$", "", line)  # support for comments, fuck yea!
-                mnemon, op, argument_sizes = line.split(",")
-                argument_sizes = argument_sizes.split("|")
-                argument_sizes = [int(argument_size) for argument_size in argument_sizes]
-                if len(argument_sizes) == 1 and argument_sizes[0] == 0:
-                    argument_sizes = []
-                opcode_map[op.rstrip(" ").lower()] = {'mnemon': mnemon.rstrip(" "), 'argument_sizes': argument_sizes}
-        return opcode_map
 
-
-if __name__ == "__main__":
-    buffer = ""  # insert image here?
-    registers = Registers()
+def create_emulator(code_buffer=b"", patches=(), seed=None):
+    """
+        wire up registers, memory, commands and a parser in one go
+        code_buffer - image loaded at 0x0000
+        patches - iterable of (address, bytes) written over memory afterwards
+        seed - power up state seed, see Registers
+    """
+    registers = Registers(seed)
     memory = Memory()
     commands = Commands(registers, memory)
-    rom = b"\xa9\x05"
-    opcode_parser = OpCodeParser(rom, commands, memory, registers)
-
-    print(registers)
-    opcode_parser.step(fake=False)
-    # opcode_parser.step(fake=False)
-    # opcode_parser.step(fake=False)
-    # opcode_parser.step(fake=False)
-    # opcode_parser.step(fake=False)
-    print(registers)
+    parser = OpCodeParser(code_buffer, commands, memory, registers)
+    for address, data in patches:
+        memory.write_buffer_to_memory(address, data)
+    return parser
+
+
+def test_wait_and_stop_without_interrupts_halt():
+    for opcode in (0x8F, 0x8E):  # WAIT, STOP
+        parser = create_emulator(bytes([opcode]))
+        result = parser.run(max_instructions=10)
+        assert (result.reason, result.instructions, result.pc) == (STOP_HALTED, 1, 0x0001)
+        result = parser.run(max_instructions=10)  # still asleep, nothing runs
+        assert (result.reason, result.instructions, result.cycles) == (STOP_HALTED, 0, 0)
+
+
+def test_wait_and_stop_wake_on_an_interrupt():
+    for opcode in (0x8F, 0x8E):
+        woken = []
+        parser = create_emulator(bytes([opcode, 0x4C]))  # WAIT or STOP, INCA
+        parser.registers.interrupts.schedule(500, handler=lambda: woken.append(parser.registers.cycles))
+        result = parser.run(max_instructions=2)
+        assert woken == [500] and parser.registers.halted == 0
+        assert (result.instructions, parser.registers.a, result.pc) == (2, 1, 0x0002)
+        assert result.cycles == 500 + parser._cycle_table[0x4C]
+
+
+def test_idle_fast_forward_counts_skipped_iterations():
+    period = create_emulator()._cycle_table[0x20]
+    parser = create_emulator(bytes([0x20, 0xFE]))  # BRA *
+    parser.registers.interrupts.schedule(100 * period, handler=lambda: None)
+    result = parser.run(max_instructions=1000)
+    assert result.instructions == 1000 and result.cycles == 1000 * period
+
+    # a run that starts in the middle of an idle loop (a restored snapshot) stops at max_instructions as well
+    parser = create_emulator(bytes([0x20, 0xFE]))
+    parser.registers.interrupts.schedule(1000 * period, handler=lambda: None)
+    parser.registers.halted = HALT_IDLE
+    result = parser.run(max_instructions=10)
+    assert (result.reason, result.instructions, result.cycles) == (STOP_MAX_INSTRUCTIONS, 10, 10 * period)
+    assert parser.skipped_instructions == 10
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="run a 6805 image")
+    argument_parser.add_argument("image", help="raw binary, intel hex or s-record file")
+    argument_parser.add_argument("-f", "--format", choices=FORMATS, help="image format, guessed when not given")
+    argument_parser.add_argument("-a", "--address", type=lambda value: int(value, 0), default=0x0000,
+                                 help="where a raw image goes")
+    argument_parser.add_argument("-n", "--instructions", type=int, default=1, help="instructions to run")
+    options = argument_parser.parse_args()
+
+    opcode_parser = create_emulator()
+    image = opcode_parser.load_image(options.image, options.format, options.address)
+    if image.entry is not None:
+        opcode_parser.registers.pc = image.entry
+    print("{0} image, {1} bytes, sha256 {2}".format(image.image_format, image.size, image.digest))
+    print(opcode_parser.registers)
+    print(opcode_parser.run(max_instructions=options.instructions))
+    print(opcode_parser.registers)
@@ -0,0 +1,157 @@
+import array
+import hashlib
+import os
+import sys
+
+from registers import CCR_C, CCR_H, CCR_N, CCR_Z
+
+
+# the flags each family writes, everything else in the ccr is left alone
+ADD_FLAGS = CCR_H | CCR_N | CCR_Z | CCR_C  # ADD, ADC
+SUB_FLAGS = CCR_N | CCR_Z | CCR_C  # SUB, SBC, CMP, CPX - H is undefined after a subtract on the 6805, we leave it
+
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")
+TABLE_ENTRIES = 2 << 16  # carry, a, b
+
+
+def _build_add_table():
+    """
+        entry = result | packed flags << 8 for a + b + carry
+    """
+    table = array.array('H', bytes(2 * TABLE_ENTRIES))
+    for carry in (0, 1):
+        for a in range(0x100):
+            base = (carry << 16) | (a << 8)
+            half_a = (a & 0x0F) + carry
+            for b in range(0x100):
+                total = a + b + carry
+                result = total & 0xFF
+                flags = (result & 0x80) >> 5  # N is bit 7 of the result
+                if not result:
+                    flags |= CCR_Z
+                if total > 0xFF:
+                    flags |= CCR_C
+                if half_a + (b & 0x0F) > 0x0F:
+                    flags |= CCR_H
+                table[base | b] = result | (flags << 8)
+    return table
+
+
+def _build_sub_table():
+    """
+        entry = result | packed flags << 8 for a - b - carry, C is the borrow
+    """
+    table = array.array('H', bytes(2 * TABLE_ENTRIES))
+    for carry in (0, 1):
+        for a in range(0x100):
+            base = (carry << 16) | (a << 8)
+            for b in range(0x100):
+                total = a - b - carry
+                result = total & 0xFF
+                flags = (result & 0x80) >> 5
+                if not result:
+                    flags |= CCR_Z
+                if total < 0:
+                    flags |= CCR_C
+                table[base | b] = result | (flags << 8)
+    return table
+
+
+def load_tables(cache_directory=CACHE_DIRECTORY):
+    """
+        (add table, sub table), read from disk when this file hasn't changed since they were last built.
+        building them takes about 50ms, reading them back well under one
+    """
+    with open(os.path.abspath(__file__), 'rb') as source_file:
+        digest = hashlib.sha256(source_file.read()).hexdigest()
+    tables = _read_cache(cache_directory, digest)
+    if tables is None:
+        tables = (_build_add_table(), _build_sub_table())
+        _write_cache(cache_directory, digest, tables)
+    return tables
+
+
+def _cache_path(cache_directory, digest):
+    # arrays are dumped in native byte order, a cache copied to a big endian host is simply not found there
+    return os.path.join(cache_directory, "flag_tables.{0}.{1}.bin".format(digest[:16], sys.byteorder))
+
+
+def _read_cache(cache_directory, digest):
+    if cache_directory is None:
+        return None
+    try:
+        with open(_cache_path(cache_directory, digest), 'rb') as cache_file:
+            content = cache_file.read()
+    except OSError:
+        return None
+    if len(content) != 4 * TABLE_ENTRIES:
+        return None
+    add_table, sub_table = array.array('H'), array.array('H')
+    add_table.frombytes(content[:2 * TABLE_ENTRIES])
+    sub_table.frombytes(content[2 * TABLE_ENTRIES:])
+    return add_table, sub_table
+
+
+def _write_cache(cache_directory, digest, tables):
+    if cache_directory is None:
+        return
+    path = _cache_path(cache_directory, digest)
+    temporary_path = "{0}.{1}".format(path, os.getpid())
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        with open(temporary_path, 'wb') as cache_file:
+            for table in tables:
+                table.tofile(cache_file)
+        os.replace(temporary_path, path)  # readers in other processes never see half a file
+    except OSError:
+        pass  # read only checkout, we just build again next time
+
+
+# 128k entries of two bytes each, loaded once per process. the interpreter, the block cache (through Commands)
+# and the lockstep engine all index these same arrays, so this file is the whole story on arithmetic flags.
+ADD_TABLE, SUB_TABLE = load_tables()
+
+
+def _reference_flags(a, b, result, subtract):
+    """
+        the 6805 data sheet's boolean flag equations, worked bit by bit instead of from the wide total the
+        builders use
+    """
+    bit = lambda value, number: (value >> number) & 1
+    a7, b7, r7 = bit(a, 7), bit(b, 7), bit(result, 7)
+    if subtract:
+        carry = (1 - a7) & b7 | b7 & r7 | r7 & (1 - a7)
+        half = 0
+    else:
+        carry = a7 & b7 | b7 & (1 - r7) | (1 - r7) & a7
+        a3, b3, r3 = bit(a, 3), bit(b, 3), bit(result, 3)
+        half = a3 & b3 | b3 & (1 - r3) | (1 - r3) & a3
+    return (CCR_N if r7 else 0) | (0 if result else CCR_Z) | (CCR_C if carry else 0) | (CCR_H if half else 0)
+
+
+def test_tables_match_arithmetic():
+    for carry in (0, 1):
+        for a in range(0x100):
+            for b in range(0x100):
+                index = (carry << 16) | (a << 8) | b
+                result = (a + b + carry) & 0xFF
+                assert ADD_TABLE[index] == result | (_reference_flags(a, b, result, False) << 8), (a, b, carry)
+                result = (a - b - carry) & 0xFF
+                assert SUB_TABLE[index] == result | (_reference_flags(a, b, result, True) << 8), (a, b, carry)
+
+
+def test_cache_round_trip():
+    import shutil
+    import tempfile
+    cache_directory = tempfile.mkdtemp()
+    try:
+        built = load_tables(cache_directory)
+        assert len(os.listdir(cache_directory)) == 1
+        assert load_tables(cache_directory) == built == (ADD_TABLE, SUB_TABLE)
+    finally:
+        shutil.rmtree(cache_directory)
+
+
+if __name__ == "__main__":
+    test_tables_match_arithmetic()
+    test_cache_round_trip()
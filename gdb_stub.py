@@ -0,0 +1,375 @@
+import argparse
+import asyncio
+
+from debugger import STOP_BREAKPOINT, STOP_WATCHPOINT, WATCH_ACCESS, WATCH_READ, WATCH_WRITE, Debugger
+from emulator import STOP_MAX_INSTRUCTIONS, create_emulator
+
+
+# gdb register numbers, name and size in bytes, sent big endian like the cpu stores them
+REGISTERS = (('a', 1), ('x', 1), ('pc', 2), ('sp', 2), ('ccr', 1))
+
+SIGINT = 2
+SIGILL = 4  # the cpu raised, an illegal opcode or pc running off the end of memory
+SIGTRAP = 5
+CONTINUE_SLICE = 0x10000  # instructions per run() while continuing, a ctrl-c from the client is seen in between
+INTERRUPT = b"\x03"
+
+TARGET_XML = b"""<?xml version="1.0"?>
+<!DOCTYPE target SYSTEM "gdb-target.dtd">
+<target version="1.0">
+  <feature name="org.gnu.gdb.m6805.core">
+    <reg name="a" bitsize="8" type="uint8" regnum="0"/>
+    <reg name="x" bitsize="8" type="uint8"/>
+    <reg name="pc" bitsize="16" type="code_ptr"/>
+    <reg name="sp" bitsize="16" type="data_ptr"/>
+    <reg name="ccr" bitsize="8" type="uint8"/>
+  </feature>
+</target>
+"""
+
+_WATCH_KINDS = {b'2': WATCH_WRITE, b'3': WATCH_READ, b'4': WATCH_ACCESS}
+_WATCH_STOP_NAMES = {WATCH_WRITE: b'watch', WATCH_READ: b'rwatch', WATCH_ACCESS: b'awatch'}
+
+
+def checksum(payload):
+    return b"%02x" % (sum(payload) & 0xFF)
+
+
+def _unescape(data):
+    """
+        binary data in X packets, } escapes the next byte xored with 0x20
+    """
+    result = bytearray()
+    escaped = False
+    for byte in data:
+        if escaped:
+            result.append(byte ^ 0x20)
+            escaped = False
+        elif byte == 0x7D:
+            escaped = True
+        else:
+            result.append(byte)
+    return bytes(result)
+
+
+class GdbStub(object):
+
+    def __init__(self, parser, continue_slice=CONTINUE_SLICE):
+        """
+            gdb remote serial protocol over tcp for one OpCodeParser.
+            continue runs the plain interpreter loop through a Debugger in slices of continue_slice instructions,
+            breakpoints stop it from inside the loop, the event loop only gets a look in between slices.
+            registers are a, x, pc, sp and ccr (see REGISTERS and TARGET_XML), memory reads go around
+            peripheral handlers so looking at i/o registers from gdb has no side effects
+        """
+        self._parser = parser
+        self._state = parser.registers
+        self._memory = parser.memory
+        self._debugger = Debugger(parser)
+        self._continue_slice = continue_slice
+        self._watchpoints = {}  # (type, address, length) -> Watchpoint
+        self._no_ack = False
+        self._pending = b""  # bytes read while watching for ctrl-c that belong to the next packet
+
+    async def serve(self, host="127.0.0.1", port=1234):
+        """
+            :return: the asyncio server, clients are served one packet at a time against the same machine
+        """
+        return await asyncio.start_server(self._serve_client, host, port)
+
+    async def _serve_client(self, reader, writer):
+        self._no_ack = False
+        try:
+            while True:
+                packet = await self._read_packet(reader, writer)
+                if packet is None:
+                    break
+                if packet == INTERRUPT:
+                    await self._send(writer, b"S%02x" % SIGINT)
+                    continue
+                response = await self._dispatch(packet, reader)
+                if response is None:  # kill or detach
+                    if packet[:1] == b'D':
+                        await self._send(writer, b"OK")
+                    break
+                await self._send(writer, response)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_byte(self, reader):
+        if self._pending:
+            byte, self._pending = self._pending[:1], self._pending[1:]
+            return byte
+        return await reader.read(1)
+
+    async def _read_packet(self, reader, writer):
+        """
+            :return: the payload of the next packet, INTERRUPT for a ctrl-c, None once the client is gone
+        """
+        while True:
+            byte = await self._read_byte(reader)
+            if not byte:
+                return None
+            if byte == INTERRUPT:
+                return INTERRUPT
+            if byte == b"$":
+                break
+            # + and - acks, anything else is line noise
+        payload = bytearray()
+        while True:
+            byte = await self._read_byte(reader)
+            if not byte:
+                return None
+            if byte == b"#":
+                break
+            payload += byte
+        received = await self._read_byte(reader) + await self._read_byte(reader)
+        payload = bytes(payload)
+        if not self._no_ack:
+            writer.write(b"+" if received.lower() == checksum(payload) else b"-")
+            if received.lower() != checksum(payload):
+                return await self._read_packet(reader, writer)
+        return payload
+
+    async def _send(self, writer, payload):
+        writer.write(b"$" + payload + b"#" + checksum(payload))
+        await writer.drain()
+
+    async def _dispatch(self, packet, reader):
+        """
+            :return: the response payload, b"" for packets we dont support, None to drop the connection
+        """
+        command = packet[:1]
+        arguments = packet[1:]
+        try:
+            if command == b"?":
+                return b"S%02x" % SIGTRAP
+            if command == b"g":
+                return self._read_registers()
+            if command == b"G":
+                self._write_registers(bytes.fromhex(arguments.decode()))
+                return b"OK"
+            if command == b"p":
+                return self._read_register(int(arguments, 16))
+            if command == b"P":
+                number, value = arguments.split(b"=")
+                self._write_register(int(number, 16), bytes.fromhex(value.decode()))
+                return b"OK"
+            if command == b"m":
+                address, length = (int(field, 16) for field in arguments.split(b","))
+                return self._read_memory(address, length).hex().encode()
+            if command == b"M":
+                location, data = arguments.split(b":")
+                address, length = (int(field, 16) for field in location.split(b","))
+                self._write_memory(address, bytes.fromhex(data.decode())[:length])
+                return b"OK"
+            if command == b"X":
+                location, data = arguments.split(b":", 1)
+                address, length = (int(field, 16) for field in location.split(b","))
+                self._write_memory(address, _unescape(data)[:length])
+                return b"OK"
+            if command in (b"s", b"c"):
+                if arguments:
+                    self._state.pc = int(arguments, 16)
+                try:
+                    if command == b"s":
+                        return self._stop_reply(self._debugger.step())
+                    return await self._continue(reader)
+                except (ValueError, IndexError):
+                    return b"S%02x" % SIGILL
+            if command in (b"Z", b"z"):
+                return self._breakpoint(command == b"Z", arguments)
+            if command == b"H":
+                return b"OK"
+            if command in (b"k", b"D"):
+                return None
+            if command == b"q":
+                return self._query(arguments)
+            if command == b"Q":
+                if arguments == b"StartNoAckMode":
+                    self._no_ack = True
+                    return b"OK"
+                return b""
+            return b""
+        except (ValueError, IndexError):  # malformed packets as well as bad addresses and values
+            return b"E01"
+
+    def _query(self, arguments):
+        if arguments.startswith(b"Supported"):
+            return b"PacketSize=4000;QStartNoAckMode+;qXfer:features:read+;swbreak+"
+        if arguments == b"Attached":
+            return b"1"
+        if arguments == b"C":
+            return b"QC1"
+        if arguments == b"fThreadInfo":
+            return b"m1"
+        if arguments == b"sThreadInfo":
+            return b"l"
+        if arguments.startswith(b"Xfer:features:read:target.xml:"):
+            offset, length = (int(field, 16) for field in arguments.rsplit(b":", 1)[1].split(b","))
+            chunk = TARGET_XML[offset:offset + length]
+            return (b"l" if offset + length >= len(TARGET_XML) else b"m") + chunk
+        return b""
+
+    def _read_registers(self):
+        return b"".join(self._read_register(number) for number in range(len(REGISTERS)))
+
+    def _write_registers(self, data):
+        """
+            every register is checked before any is set, a bad packet leaves them all as they were
+        """
+        if len(data) != sum(size for name, size in REGISTERS):
+            raise ValueError("{} bytes of registers".format(len(data)))
+        values = []
+        position = 0
+        for number, (name, size) in enumerate(REGISTERS):
+            values.append(self._register_value(number, data[position:position + size]))
+            position += size
+        for name, value in values:
+            self._set_register(name, value)
+
+    def _read_register(self, number):
+        if not 0 <= number < len(REGISTERS):
+            raise ValueError("no register {}".format(number))
+        name, size = REGISTERS[number]
+        return getattr(self._state, name).to_bytes(size, 'big').hex().encode()
+
+    def _write_register(self, number, data):
+        self._set_register(*self._register_value(number, data))
+
+    def _register_value(self, number, data):
+        if not 0 <= number < len(REGISTERS):
+            raise ValueError("no register {}".format(number))
+        name, size = REGISTERS[number]
+        value = int.from_bytes(data, 'big')
+        if name == 'sp' and value not in self._state.stack_range:
+            raise ValueError("sp {0:#06x} is outside the stack".format(value))
+        return name, value
+
+    def _set_register(self, name, value):
+        if name == 'sp':
+            self._state.reset_stack_pointer(value)
+        else:
+            setattr(self._state, name, value)
+
+    def _read_memory(self, address, length):
+        if address < 0 or address + length > self._memory.address_size + 1:
+            raise ValueError("{0:#x} bytes at {1:#06x} is out of memory".format(length, address))
+        return bytes(self._memory.view(address, address + length))
+
+    def _write_memory(self, address, data):
+        self._memory.write_buffer_to_memory(address, data)
+
+    def _breakpoint(self, insert, arguments):
+        kind, address, length = arguments.split(b",")[:3]
+        address = int(address, 16)
+        length = int(length, 16)
+        if kind in (b"0", b"1"):  # software and hardware breakpoints are the same thing here
+            if insert:
+                self._debugger.add_breakpoint(address)
+            else:
+                self._debugger.remove_breakpoint(address)
+            return b"OK"
+        if kind in _WATCH_KINDS:
+            key = (kind, address, length)
+            if insert:
+                self._watchpoints[key] = self._debugger.add_watchpoint(range(address, address + length),
+                                                                       _WATCH_KINDS[kind])
+            elif key in self._watchpoints:
+                self._debugger.remove_watchpoint(self._watchpoints.pop(key))
+            return b"OK"
+        return b""
+
+    def _stop_reply(self, hit, reason=None):
+        if hit is not None and reason in (None, STOP_WATCHPOINT):
+            return b"T%02x%s:%04x;" % (SIGTRAP, _WATCH_STOP_NAMES[hit.watchpoint.kind], hit.address)
+        if reason == STOP_BREAKPOINT:
+            return b"T%02xswbreak:;" % SIGTRAP
+        return b"S%02x" % SIGTRAP
+
+    async def _continue(self, reader):
+        """
+            run slice after slice until something stops it, listening for ctrl-c in the background.
+            the listener reads the socket, never _pending, so whatever it brings in comes after what is pending
+        """
+        listener = asyncio.ensure_future(reader.read(1))
+        try:
+            while True:
+                result = self._debugger.run(max_instructions=self._continue_slice)
+                if result.reason != STOP_MAX_INSTRUCTIONS:
+                    return self._stop_reply(self._debugger.hit, result.reason)
+                await asyncio.sleep(0)
+                if listener.done():
+                    byte = listener.result()
+                    if byte == INTERRUPT or not byte:
+                        return b"S%02x" % SIGINT
+                    self._pending += byte  # an early packet, keep it for later
+                    listener = asyncio.ensure_future(reader.read(1))
+        finally:
+            if not listener.done():
+                listener.cancel()
+
+
+def test_registers_continue_and_interrupt():
+    async def exchange(reader, writer, payload):
+        writer.write(b"$" + payload + b"#" + checksum(payload))
+        await writer.drain()
+        return await read_reply(reader)
+
+    async def read_reply(reader):
+        await reader.readuntil(b"$")  # skips the + ack
+        reply = await reader.readuntil(b"#")
+        assert await reader.readexactly(2) == checksum(reply[:-1])
+        return reply[:-1]
+
+    async def session():
+        stub = GdbStub(create_emulator(bytes([0xA6, 0x01, 0x4C, 0x20, 0xFD]), seed=1), continue_slice=100)
+        server = await stub.serve(port=0)  # LDA #1, INCA, BRA to the INCA
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+        registers = await exchange(reader, writer, b"g")
+        assert len(registers) == 2 * sum(size for name, size in REGISTERS)
+
+        assert await exchange(reader, writer, b"G1122000000000f") == b"E01"  # sp 0x0000
+        assert await exchange(reader, writer, b"G1122" + registers[4:-2]) == b"E01"  # no ccr
+        assert await exchange(reader, writer, b"g") == registers  # nothing was set
+        assert await exchange(reader, writer, b"G1122" + registers[4:]) == b"OK"
+        assert (await exchange(reader, writer, b"g"))[:4] == b"1122"
+
+        assert await exchange(reader, writer, b"Z0,3,1") == b"OK"
+        assert await exchange(reader, writer, b"c0") == b"T05swbreak:;"
+        assert (await exchange(reader, writer, b"p2")) == b"0003"
+        assert await exchange(reader, writer, b"z0,3,1") == b"OK"
+
+        # a packet sent while running is kept, in order, for after the ctrl-c that comes behind it
+        writer.write(b"$c#63")
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        writer.write(b"$m0,2#fb" + INTERRUPT)
+        assert await read_reply(reader) == b"S%02x" % SIGINT
+        assert await read_reply(reader) == b"a601"
+
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(session())
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="serve a 6805 rom to gdb (target remote host:port)")
+    argument_parser.add_argument("rom", help="raw binary image loaded at 0x0000")
+    argument_parser.add_argument("--host", default="127.0.0.1")
+    argument_parser.add_argument("-p", "--port", type=int, default=1234)
+    options = argument_parser.parse_args()
+
+    with open(options.rom, 'rb') as rom_file:
+        stub = GdbStub(create_emulator(rom_file.read()))
+
+    async def main():
+        server = await stub.serve(options.host, options.port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,375 @@
+# raw binary, intel hex and motorola s-record images. writers take a binary stream and an iterable of
+# (address, bytes like) segments, records are built a batch at a time and written in one call per batch.
+# readers turn a file back into segments, see read_image
+
+import collections
+import hashlib
+import mmap
+import os
+import struct
+
+
+RAW = 'raw'
+INTEL_HEX = 'ihex'
+S_RECORD = 'srec'
+FORMATS = (RAW, INTEL_HEX, S_RECORD)
+
+RECORD_SIZE = 16  # data bytes per hex / s-record line
+_BATCH_LINES = 0x1000  # lines joined before each stream.write
+MMAP_THRESHOLD = 1 << 20  # hex files from this size on are mapped, smaller ones are cheaper to just read
+_CACHE_SIZE = 8  # images kept by read_image, least recently used goes first
+
+# intel hex record types
+_IHEX_DATA = 0x00
+_IHEX_END = 0x01
+_IHEX_EXTENDED_LINEAR_ADDRESS = 0x04
+
+
+def _intel_hex_record(record_type, address, payload=b""):
+    body = bytes((len(payload), (address >> 8) & 0xFF, address & 0xFF, record_type)) + bytes(payload)
+    return b":%s%02X\n" % (body.hex().upper().encode(), -sum(body) & 0xFF)
+
+
+def _s_record(kind, address, address_size, payload=b""):
+    body = bytes((address_size + len(payload) + 1,)) + address.to_bytes(address_size, 'big') + bytes(payload)
+    return b"S%d%s%02X\n" % (kind, body.hex().upper().encode(), ~sum(body) & 0xFF)
+
+
+class _BatchedWriter(object):
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._lines = []
+
+    def add(self, line):
+        self._lines.append(line)
+        if len(self._lines) == _BATCH_LINES:
+            self.flush()
+
+    def flush(self):
+        self._stream.write(b"".join(self._lines))
+        del self._lines[:]
+
+
+def write_raw(stream, segments):
+    """
+        the segments' bytes back to back, addresses are not recorded
+    """
+    for address, data in segments:
+        stream.write(data)
+
+
+def write_intel_hex(stream, segments, record_size=RECORD_SIZE):
+    """
+        data records with extended linear address records wherever a record crosses into a new 64k page
+    """
+    writer = _BatchedWriter(stream)
+    page = 0
+    for address, data in segments:
+        data = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            record_address = address + offset
+            if record_address >> 16 != page:
+                page = record_address >> 16
+                writer.add(_intel_hex_record(_IHEX_EXTENDED_LINEAR_ADDRESS, 0, page.to_bytes(2, 'big')))
+            size = min(record_size, len(data) - offset, 0x10000 - (record_address & 0xFFFF))
+            writer.add(_intel_hex_record(_IHEX_DATA, record_address & 0xFFFF, data[offset:offset + size]))
+            offset += size
+    writer.add(_intel_hex_record(_IHEX_END, 0))
+    writer.flush()
+
+
+def write_s_record(stream, segments, record_size=RECORD_SIZE, header=b"", start_address=0x0000):
+    """
+        S0 header, S1/S2/S3 data records (the smallest address size that fits everything), an S5/S6 record
+        count and the S9/S8/S7 termination record carrying start_address
+    """
+    segments = [(address, memoryview(data)) for address, data in segments]
+    end = max([address + len(data) for address, data in segments] + [start_address + 1])
+    if end <= 0x10000:
+        data_kind, address_size = 1, 2
+    elif end <= 0x1000000:
+        data_kind, address_size = 2, 3
+    else:
+        data_kind, address_size = 3, 4
+
+    writer = _BatchedWriter(stream)
+    writer.add(_s_record(0, 0, 2, header))
+    records = 0
+    for address, data in segments:
+        for offset in range(0, len(data), record_size):
+            writer.add(_s_record(data_kind, address + offset, address_size, data[offset:offset + record_size]))
+            records += 1
+    if records <= 0xFFFF:
+        writer.add(_s_record(5, records, 2))
+    elif records <= 0xFFFFFF:
+        writer.add(_s_record(6, records, 3))
+    writer.add(_s_record(10 - data_kind, start_address, address_size))
+    writer.flush()
+
+
+WRITERS = {RAW: write_raw, INTEL_HEX: write_intel_hex, S_RECORD: write_s_record}
+
+
+# what read_image() hands out, segments - tuple of (address, bytes), digest - sha256 hex of the placed bytes,
+# entry - start address the file carries, None if it has none
+class Image(collections.namedtuple('Image', ['image_format', 'segments', 'digest', 'entry'])):
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return sum(len(data) for address, data in self.segments)
+
+    def load(self, memory):
+        """
+            place every segment with one slice assignment each
+        """
+        for address, data in self.segments:
+            memory.write_buffer_to_memory(address, data)
+        return self
+
+
+_IMAGE_EXTENSIONS = {
+    '.bin': RAW, '.rom': RAW, '.raw': RAW,
+    '.hex': INTEL_HEX, '.ihex': INTEL_HEX, '.ihx': INTEL_HEX,
+    '.s19': S_RECORD, '.s28': S_RECORD, '.s37': S_RECORD, '.srec': S_RECORD, '.mot': S_RECORD,
+}
+_loaded_images = collections.OrderedDict()  # (path, mtime, size, format, address) -> Image
+
+
+def detect_format(path, head=b""):
+    """
+        by extension, then by the first byte of the file (head) for hex formats saved under odd names
+    """
+    image_format = _IMAGE_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if image_format is not None:
+        return image_format
+    if head[:1] == b":":
+        return INTEL_HEX
+    if head[:1] == b"S" and head[1:2].isdigit():
+        return S_RECORD
+    return RAW
+
+
+def read_image(path, image_format=None, address=0x0000, mmap_threshold=MMAP_THRESHOLD):
+    """
+        parse an image file, hex files of mmap_threshold bytes and more are mapped instead of read
+        image_format - RAW, INTEL_HEX or S_RECORD, guessed with detect_format when not given
+        address - where a raw image goes, hex formats carry their own addresses
+        :return: Image, the same object again for a file that did not change since, while it is one of the
+                 last _CACHE_SIZE read
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, image_format, address)
+    image = _loaded_images.get(key)
+    if image is not None:
+        _loaded_images.move_to_end(key)
+        return image
+
+    with open(path, 'rb') as image_file:
+        image_format = image_format or detect_format(path, image_file.read(2))
+        image_file.seek(0)
+        if image_format == RAW:
+            data = image_file.read()  # straight into the bytes the segment keeps, no map and copy
+            segments, entry = [(address, data)] if data else [], None
+        elif image_format not in _READERS:
+            raise ValueError("unknown image format {}".format(image_format))
+        elif stat.st_size < mmap_threshold:
+            segments, entry = _READERS[image_format](_lines(image_file.read()))
+        else:
+            with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                segments, entry = _READERS[image_format](_lines(content))
+
+    image = Image(image_format, tuple(segments), _digest(segments), entry)
+    _loaded_images[key] = image
+    while len(_loaded_images) > _CACHE_SIZE:
+        _loaded_images.popitem(last=False)
+    return image
+
+
+def parse_image(data, image_format, address=0x0000):
+    """
+        read_image for bytes that are already in memory
+    """
+    if image_format == RAW:
+        segments, entry = [(address, bytes(data))] if data else [], None
+    elif image_format in _READERS:
+        segments, entry = _READERS[image_format](_lines(data))
+    else:
+        raise ValueError("unknown image format {}".format(image_format))
+    return Image(image_format, tuple(segments), _digest(segments), entry)
+
+
+def _lines(content):
+    """
+        lines of a bytes like or mmap without splitting the whole thing up front
+        :return: generator of (line number, stripped line)
+    """
+    position = 0
+    number = 0
+    while position < len(content):
+        end = content.find(b"\n", position)
+        end = len(content) if end == -1 else end
+        number += 1
+        line = content[position:end].strip()
+        position = end + 1
+        if line:
+            yield number, bytes(line)
+
+
+def _digest(segments):
+    digest = hashlib.sha256()
+    for address, data in segments:
+        digest.update(struct.pack(">II", address, len(data)))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class _SegmentBuilder(object):
+
+    def __init__(self):
+        """
+            joins records that follow each other into one segment
+        """
+        self.segments = []
+        self._start = None
+        self._data = bytearray()
+
+    def add(self, address, data):
+        if self._start is None or address != self._start + len(self._data):
+            self.flush()
+            self._start = address
+        self._data += data
+
+    def flush(self):
+        if self._data:
+            self.segments.append((self._start, bytes(self._data)))
+        self._start = None
+        self._data = bytearray()
+        return self.segments
+
+
+def _record_bytes(line, number, skip):
+    try:
+        record = bytes.fromhex(line[skip:].decode('ascii'))
+    except ValueError:
+        raise ValueError("line {} is not a hex record".format(number))
+    if not record:
+        raise ValueError("line {} is empty".format(number))
+    return record
+
+
+def read_intel_hex(lines):
+    """
+        lines - (line number, line) pairs
+        :return: ([(address, bytes)], start address or None)
+    """
+    builder = _SegmentBuilder()
+    base = 0
+    entry = None
+    for number, line in lines:
+        if line[:1] != b":":
+            raise ValueError("line {} is not an intel hex record".format(number))
+        record = _record_bytes(line, number, 1)
+        length, record_type = record[0], record[3]
+        if len(record) != length + 5:
+            raise ValueError("line {} has the wrong length".format(number))
+        if sum(record) & 0xFF:
+            raise ValueError("line {} has a bad checksum".format(number))
+        payload = record[4:-1]
+        if record_type == _IHEX_DATA:
+            builder.add(base + ((record[1] << 8) | record[2]), payload)
+        elif record_type == _IHEX_END:
+            break
+        elif record_type == 0x02:  # extended segment address, paragraphs
+            base = int.from_bytes(payload, 'big') << 4
+        elif record_type == _IHEX_EXTENDED_LINEAR_ADDRESS:
+            base = int.from_bytes(payload, 'big') << 16
+        elif record_type in (0x03, 0x05):  # start segment / start linear address
+            entry = int.from_bytes(payload, 'big')
+    return builder.flush(), entry
+
+
+def read_s_record(lines):
+    """
+        lines - (line number, line) pairs
+        :return: ([(address, bytes)], start address or None)
+    """
+    builder = _SegmentBuilder()
+    entry = None
+    for number, line in lines:
+        if line[:1] != b"S" or not line[1:2].isdigit():
+            raise ValueError("line {} is not an s-record".format(number))
+        kind = line[1] - ord("0")
+        record = _record_bytes(line, number, 2)
+        if len(record) != record[0] + 1:
+            raise ValueError("line {} has the wrong length".format(number))
+        if sum(record) & 0xFF != 0xFF:
+            raise ValueError("line {} has a bad checksum".format(number))
+        if kind in (1, 2, 3):
+            address_size = kind + 1
+            builder.add(int.from_bytes(record[1:1 + address_size], 'big'), record[1 + address_size:-1])
+        elif kind in (7, 8, 9):
+            entry = int.from_bytes(record[1:-1], 'big')
+    return builder.flush(), entry
+
+
+_READERS = {INTEL_HEX: read_intel_hex, S_RECORD: read_s_record}
+
+
+def test_writers_round_trip():
+    import io
+    segments = [(0x0000, bytes(range(0x100)) * 2), (0x4000, b"\x9d\x81"), (0xFFF8, bytes(range(0x10)))]  # the last crosses 64k
+    for image_format, entry in ((INTEL_HEX, None), (S_RECORD, 0x4000)):
+        stream = io.BytesIO()
+        if image_format == S_RECORD:
+            write_s_record(stream, segments, start_address=entry)
+        else:
+            write_intel_hex(stream, segments)
+        image = parse_image(stream.getvalue(), image_format)
+        assert list(image.segments) == segments, image_format
+        assert image.entry == entry and image.digest == _digest(segments)
+    stream = io.BytesIO()
+    write_raw(stream, segments[:1])
+    assert parse_image(stream.getvalue(), RAW, 0x0100).segments == ((0x0100, segments[0][1]),)
+
+
+def test_read_image_from_file():
+    import io
+    import tempfile
+    segments = [(0x0100, bytes(range(0x100)))]
+    for mmap_threshold in (MMAP_THRESHOLD, 1):  # read, then mapped
+        for image_format, suffix in ((RAW, '.bin'), (INTEL_HEX, '.hex'), (S_RECORD, '.s19')):
+            stream = io.BytesIO()
+            WRITERS[image_format](stream, segments)
+            with tempfile.NamedTemporaryFile(suffix=suffix) as image_file:
+                image_file.write(stream.getvalue())
+                image_file.flush()
+                image = read_image(image_file.name, address=0x0100, mmap_threshold=mmap_threshold)
+                assert read_image(image_file.name, address=0x0100) is image  # parsed once
+            assert image.image_format == image_format and list(image.segments) == segments, image_format
+
+
+def test_loaded_images_are_capped():
+    import tempfile
+    _loaded_images.clear()
+    with tempfile.NamedTemporaryFile(suffix='.bin') as image_file:
+        image_file.write(b"\x9d")
+        image_file.flush()
+        first = read_image(image_file.name)
+        second = read_image(image_file.name, address=1)
+        for address in range(2, _CACHE_SIZE):
+            read_image(image_file.name, address=address)
+        assert read_image(image_file.name) is first  # used last, so it stays
+        read_image(image_file.name, address=_CACHE_SIZE)
+        assert len(_loaded_images) == _CACHE_SIZE
+        assert read_image(image_file.name) is first
+        assert read_image(image_file.name, address=1) is not second  # least recently used, it went
+    _loaded_images.clear()
+
+
+if __name__ == "__main__":
+    test_writers_round_trip()
+    test_read_image_from_file()
+    test_loaded_images_are_capped()
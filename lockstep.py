@@ -0,0 +1,440 @@
+import random
+
+try:
+    import numpy
+except ImportError:  # only the lockstep engine needs it, the scalar interpreter runs without
+    numpy = None
+
+from commands import Commands
+from flag_tables import ADD_FLAGS, ADD_TABLE, SUB_FLAGS, SUB_TABLE
+from memory import Memory
+from opcodes import load_opcode_table
+from registers import CCR_C, CCR_FLAGS, CCR_H, CCR_I, CCR_N, CCR_RESET, CCR_Z, HALT_IDLE, Registers
+
+
+class _InstanceMemory(object):
+    """
+        what Commands sees of one instance when an opcode has to fall back to the scalar implementation,
+        reads and writes go straight into that instance's row of the shared memory array
+    """
+
+    address_size = 0xFFFF
+
+    def __init__(self, row):
+        self._row = row
+
+    def read(self, address):
+        return int(self._row[address])
+
+    def write(self, address, value):
+        self._row[address] = value
+
+
+class LockstepEngine(object):
+
+    def __init__(self, count, code_buffer=b"", patches=(), seed=None):
+        """
+            count copies of one rom, run side by side as numpy arrays (a struct of arrays, one slot per instance).
+            every step executes the current instruction of all running instances, instances that sit on the
+            same opcode are executed together in one vectorized operation, so as long as they follow the
+            same instruction stream a step costs about the same for a thousand of them as for one.
+
+            opcodes without a vectorized version run through Commands one instance at a time, so the
+            results always match the scalar interpreter. memory regions are not modelled here.
+            count - number of instances
+            code_buffer - loaded at 0x0000 in every instance
+            patches - (address, bytes) written into every instance, use load() to give instances different inputs
+            seed - power up state seed shared by every instance, see Registers. one is picked (and kept in .seed)
+                   when not given, so all instances still power up alike
+        """
+        if numpy is None:
+            raise ImportError("the lockstep engine needs numpy")
+        self.count = count
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        self.memory = numpy.full((count, 0x10000), Memory.fill_value, dtype=numpy.uint8)
+        self.a = numpy.zeros(count, dtype=numpy.uint8)
+        self.x = numpy.zeros(count, dtype=numpy.uint8)
+        self.pc = numpy.zeros(count, dtype=numpy.uint16)
+        self.sp = numpy.full(count, Registers().sp, dtype=numpy.uint16)  # mirrors the scalar stacks, read only
+        self.ccr = numpy.full(count, CCR_RESET, dtype=numpy.uint8)
+        self.cycles = numpy.zeros(count, dtype=numpy.int64)
+        self.instructions = numpy.zeros(count, dtype=numpy.int64)
+        self.halted = numpy.zeros(count, dtype=bool)
+        self.errors = {}  # instance -> exception that halted it
+
+        self._opcode_table = load_opcode_table()[0]
+        self._vector_table = tuple(
+            _VECTOR_HANDLERS.get(info.mnemon.lower()) if info is not None else None for info in self._opcode_table)
+        self._scalar_instances = {}  # instance -> (Registers, Commands), made the first time it needs one
+
+        self.load(0x0000, code_buffer)
+        for address, data in patches:
+            self.load(address, data)
+
+    def load(self, address, data, instances=slice(None)):
+        """
+            write data at address in the given instances (index, slice, list or bool mask), all of them by default
+        """
+        data = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+        if address < 0 or address + len(data) > self.memory.shape[1]:
+            raise ValueError("buffer of {0} bytes doesnt fit at {1:#06x}".format(len(data), address))
+        self.memory[instances, address:address + len(data)] = data
+
+    def registers(self, instance):
+        return {'a': int(self.a[instance]), 'x': int(self.x[instance]), 'pc': int(self.pc[instance]),
+                'sp': int(self.sp[instance]), 'flags': _unpack_ccr(int(self.ccr[instance])),
+                'cycles': int(self.cycles[instance])}
+
+    def step(self):
+        """
+            execute one instruction in every instance that is still running
+            :return: number of instances that executed
+        """
+        lanes = numpy.flatnonzero(~self.halted)
+        if not lanes.size:
+            return 0
+        pc = self.pc[lanes].astype(numpy.int32)
+        opcodes = self.memory[lanes, pc]
+        b1 = self.memory[lanes, (pc + 1) & 0xFFFF].astype(numpy.int32)
+        b2 = self.memory[lanes, (pc + 2) & 0xFFFF].astype(numpy.int32)
+
+        # one group per distinct opcode, usually there is just the one
+        order = numpy.argsort(opcodes, kind='stable')
+        sorted_opcodes = opcodes[order]
+        bounds = numpy.flatnonzero(numpy.diff(sorted_opcodes)) + 1
+        for group in numpy.split(order, bounds):
+            opcode = int(opcodes[group[0]])
+            handler = self._vector_table[opcode]
+            if handler is None:
+                self._step_scalar(opcode, lanes[group])
+                continue
+            group_lanes = lanes[group]
+            handler(self, opcode, group_lanes, b1[group], b2[group])
+            group_lanes = group_lanes[~self.halted[group_lanes]]
+            self.cycles[group_lanes] += self._opcode_table[opcode].cycles
+            self.instructions[group_lanes] += 1
+        return lanes.size
+
+    def run(self, max_steps, until_pc=None):
+        """
+            step until every instance halted or max_steps steps went by
+            until_pc - instances that reach this address halt there
+            :return: number of steps taken
+        """
+        steps = 0
+        while steps < max_steps:
+            if not self.step():
+                break
+            steps += 1
+            if until_pc is not None:
+                self.halted |= self.pc == until_pc
+        return steps
+
+    def _step_scalar(self, opcode, lanes):
+        info = self._opcode_table[opcode]
+        for instance in lanes.tolist():
+            registers, commands = self._scalar_instance(instance)
+            row = self.memory[instance]
+            pc = int(self.pc[instance])
+            registers.a = int(self.a[instance])
+            registers.x = int(self.x[instance])
+            registers.pc = pc
+            registers.ccr = int(self.ccr[instance])
+            try:
+                if info is None:
+                    raise ValueError("illegal opcode {0:#04x} at {1:#06x}".format(opcode, pc))
+                arguments = []
+                address = pc + 1
+                for argument_size in info.argument_sizes:
+                    argument = 0
+                    for byte_address in range(address, address + argument_size):
+                        argument = (argument << 8) | int(row[byte_address])
+                    arguments.append(argument)
+                    address += argument_size
+                commands.get_handler(opcode, info.mnemon)(*arguments)
+            except Exception as error:  # one instance going off the rails shouldnt stop the others
+                self.halted[instance] = True
+                self.errors[instance] = error
+                continue
+            if registers.halted:
+                # there are no interrupts in here, so like OpCodeParser.run a WAIT or STOP halts for good
+                # and a branch to itself just keeps running
+                self.halted[instance] = registers.halted != HALT_IDLE
+                registers.halted = 0
+            self.a[instance] = registers.a
+            self.x[instance] = registers.x
+            self.pc[instance] = registers.pc
+            self.sp[instance] = registers.sp
+            self.ccr[instance] = registers.ccr
+            self.cycles[instance] += info.cycles
+            self.instructions[instance] += 1
+
+    def _scalar_instance(self, instance):
+        scalar = self._scalar_instances.get(instance)
+        if scalar is None:
+            registers = Registers(self.seed)
+            scalar = (registers, Commands(registers, _InstanceMemory(self.memory[instance])))
+            self._scalar_instances[instance] = scalar
+        return scalar
+
+
+def _unpack_ccr(ccr):
+    return {flag: 1 if ccr & mask else 0 for flag, mask in CCR_FLAGS}
+
+
+# vectorized instructions, handler(engine, opcode, lanes, b1, b2) where lanes are the instances executing
+# and b1/b2 the two bytes after the opcode in each of them. these mirror the Commands methods of the same name.
+
+def _effective_address(engine, opcode, lanes, b1, b2):
+    mode = opcode >> 4
+    if mode == 0x3 or mode == 0xB:  # DIR dd
+        return b1, 2
+    if mode == 0xC:  # EXT hh ll
+        return (b1 << 8) | b2, 3
+    if mode == 0xD:  # IX2 ee ff
+        return (((b1 << 8) | b2) + engine.x[lanes]) & 0xFFFF, 3
+    if mode == 0x6 or mode == 0xE:  # IX1 ff
+        return b1 + engine.x[lanes], 2
+    return engine.x[lanes].astype(numpy.int32), 1  # IX
+
+
+def _read_operand(engine, opcode, lanes, b1, b2):
+    if opcode >> 4 == 0xA:  # IMM ii
+        return b1, 2
+    address, size = _effective_address(engine, opcode, lanes, b1, b2)
+    return engine.memory[lanes, address].astype(numpy.int32), size
+
+
+def _advance(engine, lanes, size):
+    pc = engine.pc[lanes].astype(numpy.int32) + size  # a uint16 would just wrap
+    overflow = pc > 0xFFFF
+    if overflow.any():  # the scalar pc setter refuses to run off the end of memory, so do we
+        for instance in lanes[overflow].tolist():
+            engine.halted[instance] = True
+            engine.errors[instance] = ValueError("pc should be 16 bit max")
+        lanes, pc = lanes[~overflow], pc[~overflow]
+    engine.pc[lanes] = pc
+
+
+def _set_nz(engine, lanes, result):
+    ccr = engine.ccr[lanes] & (0xFF ^ (CCR_N | CCR_Z))
+    engine.ccr[lanes] = ccr | ((result & 0x80) >> 5) | ((result == 0).astype(numpy.uint8) << 1)
+
+
+def _load(register):
+    def handler(engine, opcode, lanes, b1, b2):
+        value, size = _read_operand(engine, opcode, lanes, b1, b2)
+        getattr(engine, register)[lanes] = value
+        _set_nz(engine, lanes, value)
+        _advance(engine, lanes, size)
+    return handler
+
+
+def _store(register):
+    def handler(engine, opcode, lanes, b1, b2):
+        address, size = _effective_address(engine, opcode, lanes, b1, b2)
+        value = getattr(engine, register)[lanes]
+        engine.memory[lanes, address] = value
+        _set_nz(engine, lanes, value)
+        _advance(engine, lanes, size)
+    return handler
+
+
+def _modify(operation, register=None, write_back=True):
+    """
+        read-modify-write on a register (inherent, one byte) or on a memory operand, flags from the result
+    """
+    def handler(engine, opcode, lanes, b1, b2):
+        if register is None:
+            address, size = _effective_address(engine, opcode, lanes, b1, b2)
+            result = operation(engine.memory[lanes, address].astype(numpy.int32))
+            if write_back:
+                engine.memory[lanes, address] = result
+        else:
+            size = 1
+            result = operation(getattr(engine, register)[lanes].astype(numpy.int32))
+            if write_back:
+                getattr(engine, register)[lanes] = result
+        _set_nz(engine, lanes, result)
+        _advance(engine, lanes, size)
+    return handler
+
+
+def _logical(operation, write_back=True):
+    def handler(engine, opcode, lanes, b1, b2):
+        value, size = _read_operand(engine, opcode, lanes, b1, b2)
+        result = operation(engine.a[lanes].astype(numpy.int32), value)
+        if write_back:
+            engine.a[lanes] = result
+        _set_nz(engine, lanes, result)
+        _advance(engine, lanes, size)
+    return handler
+
+
+def _arithmetic(table, flags, register='a', with_carry=False, write_back=True):
+    """
+        ADD/ADC/SUB/SBC/CMP/CPX, looked up in the same flag tables Commands uses
+    """
+    def handler(engine, opcode, lanes, b1, b2):
+        value, size = _read_operand(engine, opcode, lanes, b1, b2)
+        index = (getattr(engine, register)[lanes].astype(numpy.int32) << 8) | value
+        if with_carry:
+            index |= (engine.ccr[lanes] & CCR_C).astype(numpy.int32) << 16
+        entry = numpy.frombuffer(table, dtype=numpy.uint16)[index]
+        if write_back:
+            getattr(engine, register)[lanes] = entry & 0xFF
+        engine.ccr[lanes] = (engine.ccr[lanes] & (0xFF ^ flags)) | (entry >> 8)
+        _advance(engine, lanes, size)
+    return handler
+
+
+def _transfer(source, target):
+    def handler(engine, opcode, lanes, b1, b2):
+        getattr(engine, target)[lanes] = getattr(engine, source)[lanes]
+        _advance(engine, lanes, 1)
+    return handler
+
+
+def _flag(mask, value):
+    def handler(engine, opcode, lanes, b1, b2):
+        if value:
+            engine.ccr[lanes] |= mask
+        else:
+            engine.ccr[lanes] &= 0xFF ^ mask
+        _advance(engine, lanes, 1)
+    return handler
+
+
+def _nop(engine, opcode, lanes, b1, b2):
+    _advance(engine, lanes, 1)
+
+
+def _take_branch(engine, lanes, next_pc, condition, offset):
+    """
+        divergent branches are just a select, instances that take it get the target and the rest fall through
+    """
+    offset = offset - ((offset & 0x80) << 1)  # signed two's complement byte
+    engine.pc[lanes] = numpy.where(condition, (next_pc + offset) & 0xFFFF, next_pc)
+
+
+def _branch(condition):
+    def handler(engine, opcode, lanes, b1, b2):
+        next_pc = (engine.pc[lanes].astype(numpy.int32) + 2) & 0xFFFF
+        _take_branch(engine, lanes, next_pc, condition(engine.ccr[lanes]), b1)
+    return handler
+
+
+def _bit_branch(set_bit):
+    def handler(engine, opcode, lanes, b1, b2):
+        mask = 1 << ((opcode & 0x0E) >> 1)
+        bit_set = (engine.memory[lanes, b1] & mask) != 0
+        next_pc = (engine.pc[lanes].astype(numpy.int32) + 3) & 0xFFFF
+        _take_branch(engine, lanes, next_pc, bit_set if set_bit else ~bit_set, b2)
+    return handler
+
+
+def _bset(engine, opcode, lanes, b1, b2):
+    engine.memory[lanes, b1] |= 1 << ((opcode & 0x0E) >> 1)
+    _advance(engine, lanes, 2)
+
+
+def _bclr(engine, opcode, lanes, b1, b2):
+    engine.memory[lanes, b1] &= 0xFF ^ (1 << ((opcode & 0x0E) >> 1))
+    _advance(engine, lanes, 2)
+
+
+def _jmp(engine, opcode, lanes, b1, b2):
+    engine.pc[lanes] = _effective_address(engine, opcode, lanes, b1, b2)[0]
+
+
+def _never(ccr):
+    return numpy.zeros(len(ccr), dtype=bool)
+
+
+def _always(ccr):
+    return numpy.ones(len(ccr), dtype=bool)
+
+
+_VECTOR_HANDLERS = {
+    'lda': _load('a'), 'ldx': _load('x'), 'sta': _store('a'), 'stx': _store('x'),
+    'tax': _transfer('a', 'x'), 'txa': _transfer('x', 'a'),
+    'inc': _modify(lambda value: (value + 1) & 0xFF),
+    'inca': _modify(lambda value: (value + 1) & 0xFF, 'a'),
+    'incx': _modify(lambda value: (value + 1) & 0xFF, 'x'),
+    'dec': _modify(lambda value: (value - 1) & 0xFF),
+    'deca': _modify(lambda value: (value - 1) & 0xFF, 'a'),
+    'decx': _modify(lambda value: (value - 1) & 0xFF, 'x'),
+    'clr': _modify(lambda value: value & 0),
+    'clra': _modify(lambda value: value & 0, 'a'),
+    'clrx': _modify(lambda value: value & 0, 'x'),
+    'tst': _modify(lambda value: value, write_back=False),
+    'tsta': _modify(lambda value: value, 'a', write_back=False),
+    'tstx': _modify(lambda value: value, 'x', write_back=False),
+    'and': _logical(lambda a, value: a & value),
+    'ora': _logical(lambda a, value: a | value),
+    'eor': _logical(lambda a, value: a ^ value),
+    'bit': _logical(lambda a, value: a & value, write_back=False),
+    'add': _arithmetic(ADD_TABLE, ADD_FLAGS), 'adc': _arithmetic(ADD_TABLE, ADD_FLAGS, with_carry=True),
+    'sub': _arithmetic(SUB_TABLE, SUB_FLAGS), 'sbc': _arithmetic(SUB_TABLE, SUB_FLAGS, with_carry=True),
+    'cmp': _arithmetic(SUB_TABLE, SUB_FLAGS, write_back=False),
+    'cpx': _arithmetic(SUB_TABLE, SUB_FLAGS, 'x', write_back=False),
+    'nop': _nop, 'jmp': _jmp, 'bset': _bset, 'bclr': _bclr,
+    'brset': _bit_branch(True), 'brclr': _bit_branch(False),
+    'clc': _flag(CCR_C, 0), 'sec': _flag(CCR_C, 1), 'cli': _flag(CCR_I, 0), 'sei': _flag(CCR_I, 1),
+    'bra': _branch(_always), 'brn': _branch(_never), 'bih': _branch(_never), 'bil': _branch(_never),
+    'bcc': _branch(lambda ccr: (ccr & CCR_C) == 0), 'bhs': _branch(lambda ccr: (ccr & CCR_C) == 0),
+    'bcs': _branch(lambda ccr: (ccr & CCR_C) != 0), 'blo': _branch(lambda ccr: (ccr & CCR_C) != 0),
+    'bne': _branch(lambda ccr: (ccr & CCR_Z) == 0), 'beq': _branch(lambda ccr: (ccr & CCR_Z) != 0),
+    'bhcc': _branch(lambda ccr: (ccr & CCR_H) == 0), 'bhcs': _branch(lambda ccr: (ccr & CCR_H) != 0),
+    'bpl': _branch(lambda ccr: (ccr & CCR_N) == 0), 'bmi': _branch(lambda ccr: (ccr & CCR_N) != 0),
+    'bmc': _branch(lambda ccr: (ccr & CCR_I) == 0), 'bms': _branch(lambda ccr: (ccr & CCR_I) != 0),
+    'bhi': _branch(lambda ccr: (ccr & (CCR_C | CCR_Z)) == 0), 'bls': _branch(lambda ccr: (ccr & (CCR_C | CCR_Z)) != 0),
+}
+
+
+def _assert_matches_scalar(engine, instance, parser):
+    registers = parser.registers
+    assert engine.registers(instance) == {'a': registers.a, 'x': registers.x, 'pc': registers.pc,
+                                          'sp': registers.sp, 'flags': registers.flags, 'cycles': registers.cycles}
+    assert bytes(engine.memory[instance]) == bytes(parser.memory.view())
+
+
+def test_workloads_match_scalar():
+    if numpy is None:
+        return
+    from benchmark import WORKLOADS
+    from emulator import create_emulator
+    for workload in WORKLOADS:
+        engine = LockstepEngine(4, workload.rom, workload.patches, seed=7)
+        for instance in range(4):  # a different input per instance so they take different paths
+            engine.load(0x80, bytes([instance * 37]), instance)
+        engine.run(3000)
+        assert not engine.errors, workload.name
+        for instance in range(4):
+            parser = create_emulator(workload.rom, workload.patches, seed=7)
+            parser.memory.write_buffer_to_memory(0x80, bytes([instance * 37]))
+            parser.run(max_instructions=int(engine.instructions[instance]))
+            _assert_matches_scalar(engine, instance, parser)
+
+
+def test_scalar_fallback_and_halts_match_scalar():
+    if numpy is None:
+        return
+    from emulator import create_emulator
+    for rom, steps in ((bytes([0x81]), 1),  # RTS off an empty stack, the seeded power up stack decides where to
+                       (bytes([0x4C, 0x8F, 0x4C, 0x20, 0xFE]), 100),  # INCA, WAIT, ...
+                       (bytes([0x5C, 0x8E, 0x5C, 0x20, 0xFE]), 100)):  # INCX, STOP, ...
+        for seed in (1, 2):
+            engine = LockstepEngine(3, rom, seed=seed)
+            assert engine.run(steps) <= steps
+            parser = create_emulator(rom, seed=seed)
+            parser.run(max_instructions=steps)
+            for instance in range(3):
+                _assert_matches_scalar(engine, instance, parser)
+            assert engine.halted.all() == (steps > 1)  # WAIT and STOP halt for good, there are no interrupts
+
+
+if __name__ == "__main__":
+
+    test_workloads_match_scalar()
+    test_scalar_fallback_and_halts_match_scalar()
@@ -1,10 +1,53 @@
+import array
 import inspect
+import io
 import random
+import re
 import struct
 
+from image_formats import RAW, WRITERS
+
+
+# flags kept per address in Memory._write_map, anything non zero sends a write down the slow path
+CODE_WATCHED = 0x01  # a translation cache compiled this byte
+MAPPED = 0x02  # the byte belongs to a region (i/o handler or write protected)
+
+_SET_CODE_WATCHED = bytes(value | CODE_WATCHED for value in range(0x100))
+_CLEAR_CODE_WATCHED = bytes(value & ~CODE_WATCHED for value in range(0x100))
+_SET_MAPPED = bytes(value | MAPPED for value in range(0x100))
+_CLEAR_MAPPED = bytes(value & ~MAPPED for value in range(0x100))
+
+_DUMP_BATCH = 0x1000  # dump lines per stream.write
+_WRITTEN_RUN = re.compile(b"[^\x00]+")  # a run of written addresses in Memory._written
+
+
+class MemoryRegion(object):
+
+    def __init__(self, address_range, read=None, write=None, read_only=False):
+        """
+            address_range - range of addresses the region covers
+            read - read(address) -> value, called instead of reading memory
+            write - write(address, value), called instead of writing memory
+            read_only - silently drop writes (rom), ignored if write is given
+        """
+        self.address_range = address_range
+        self.read = read
+        self.write = write
+        self.read_only = read_only
+
+
+def _region_reader(region):
+    # looks the handler up on every read, the debugger and the recorder swap region.read while mapped
+    def read(address):
+        return region.read(address)
+    return read
+
 
 class Memory(object):
 
+    fill_value = 0x9d  # what unwritten memory reads as (a NOP)
+    max_regions = 0xFF
+
     def __init__(self):
         self._io_registers = range(0x0000, 0x001F)  # 32 bytes
         self._page_zero_eprom = range(0x0020, 0x004F)  # user eprom 48 bytes
@@ -20,49 +63,253 @@ class Memory(object):
         self._software_interrupt = range(0x3FFC, 0x3FFD)
         self._external_interrupt_vector = range(0x3FA, )
         self.address_size = 0xFFFF
-        self._memory = {}
-
-        self._mem_gen = None
+        self._memory = bytearray([self.fill_value]) * (self.address_size + 1)  # dense 64k, one byte per address
+        self._code_watcher = None
+        self._write_map = bytearray(self.address_size + 1)  # CODE_WATCHED / MAPPED flags per address
+        self._region_map = bytearray(self.address_size + 1)  # index into _regions per address, 0 is plain ram
+        self._regions = [None]
+        self._written = bytearray(self.address_size + 1)  # 1 for every address something was stored at
 
     def __iter__(self):
-        return self
+        """
+            the dump() lines, one per address that was written
+        """
+        for address, data in self.ranges():
+            for offset, value in enumerate(data):
+                yield "{0:#06X}: {1:#04X}\n".format(address + offset, value)
 
     def __str__(self):
-        result = ""
-        for address, value in self._memory.items():
-            result += "{0:#06X}: {1:#04X}\n".format(address, value)
-        return str(result)
-
-    def __next__(self):
-        if self._mem_gen == None:
-            self._mem_gen = self.next()
-        try:
-            return_value = next(self._mem_gen)
-        except StopIteration as stop_iter:
-            self._mem_gen = self.next()
-            raise stop_iter
-
-        return next(self._mem_gen)
+        dump = io.StringIO()
+        self.dump(dump)
+        return dump.getvalue()
 
     def next(self):
-        for address, value in self._memory.items():
-            yield "{0:#06X}: {1:#04X}\n".format(address, value)
+        """
+            kept for old callers, same as iter(memory)
+        """
+        return iter(self)
+
+    def ranges(self, start_address=0x0000, end_address=None):
+        """
+            lazily yield (address, bytes) for every run of written addresses in [start_address, end_address),
+            a copy of memory at the time each run is reached. a stored byte counts even when it equals fill_value
+        """
+        end_address = len(self._memory) if end_address is None else end_address
+        for match in _WRITTEN_RUN.finditer(self._written, start_address, end_address):
+            yield match.start(), bytes(self._memory[match.start():match.end()])
+
+    def _populated(self):
+        """
+            (address, value) for everything that was written
+        """
+        for address, data in self.ranges():
+            for offset, value in enumerate(data):
+                yield address + offset, value
+
+    def dump(self, stream, start_address=0x0000, end_address=None):
+        """
+            write "0xADDR: 0xVV" lines for the populated addresses to text stream, a batch of lines per write
+        """
+        lines = []
+        for address, data in self.ranges(start_address, end_address):
+            for offset, value in enumerate(data):
+                lines.append("{0:#06X}: {1:#04X}\n".format(address + offset, value))
+            if len(lines) >= _DUMP_BATCH:
+                stream.write("".join(lines))
+                lines = []
+        stream.write("".join(lines))
+
+    def export(self, stream, image_format=RAW, start_address=0x0000, end_address=None, sparse=False, **options):
+        """
+            write [start_address, end_address) to binary stream as RAW, INTEL_HEX or S_RECORD
+            sparse - leave out runs of the fill value, for the hex formats
+            options - passed on to the writer, record_size and for s-records header and start_address
+        """
+        end_address = len(self._memory) if end_address is None else end_address
+        if image_format not in WRITERS:
+            raise ValueError("unknown image format {}".format(image_format))
+        if start_address < 0 or end_address > len(self._memory) or start_address > end_address:
+            raise ValueError("range {0:#x}-{1:#x} is out of memory".format(start_address, end_address))
+        if sparse:
+            segments = self.ranges(start_address, end_address)
+        else:
+            segments = [(start_address, self.view(start_address, end_address))]
+        WRITERS[image_format](stream, segments, **options)
 
     def write_buffer_to_memory(self, start_address, buffer):
+        """
+            bulk copy buffer (bytes, bytearray, memoryview, list of ints or a latin-1 str) into memory
+        """
+        if type(buffer) == str:
+            buffer = buffer.encode("latin-1")  # the cpu only ever sees ints
+        buffer = memoryview(bytes(buffer)) if type(buffer) == list else memoryview(buffer)
+        end_address = start_address + len(buffer)
+        if start_address < 0 or end_address > len(self._memory):
+            raise ValueError("buffer of {0} bytes doesnt fit at {1:#06x}".format(len(buffer), start_address))
+        self._memory[start_address:end_address] = buffer  # loading an image goes around regions, like a programmer would
+        self._written[start_address:end_address] = b"\x01" * len(buffer)
+        if self._code_watcher is not None and any(self._write_map[start_address:end_address]):
+            for address in range(start_address, end_address):
+                if self._write_map[address] & CODE_WATCHED:
+                    self._code_watcher.invalidate(address)
+
+    def read(self, address):
+        return self._memory[address]
+
+    def write(self, address, value):
+        if self._write_map[address]:
+            self._slow_write(address, value)
+        else:
+            self._memory[address] = value
+            self._written[address] = 1
+
+    def _slow_write(self, address, value):
+        flags = self._write_map[address]
+        if flags & MAPPED:
+            region = self._regions[self._region_map[address]]
+            if region.write is not None:
+                region.write(address, value)
+            elif not region.read_only:
+                self._memory[address] = value
+                self._written[address] = 1
+        else:
+            self._memory[address] = value
+            self._written[address] = 1
+        if flags & CODE_WATCHED:
+            self._code_watcher.invalidate(address)
+
+    def map_region(self, address_range, read=None, write=None, read_only=False):
+        """
+            hand address_range over to a peripheral model (read/write handlers) or write protect it.
+            accesses anywhere else never look at the region table.
+            :return: the MemoryRegion, pass it to unmap_region to give the addresses back
+        """
+        if len(self._regions) > self.max_regions:
+            raise ValueError("no more than {} regions".format(self.max_regions))
+        if address_range.start < 0 or address_range.stop > len(self._memory):
+            raise ValueError("region {} is out of the address space".format(address_range))
+        if any(self._region_map[address_range.start:address_range.stop]):
+            raise ValueError("region {} overlaps a mapped region".format(address_range))
+
+        region = MemoryRegion(address_range, read, write, read_only)
+        self._regions.append(region)
+        index = len(self._regions) - 1
+        self._region_map[address_range.start:address_range.stop] = bytes([index]) * len(address_range)
+        self._translate_write_map(address_range.start, address_range.stop, _SET_MAPPED)
+        self._update_read_path()
+        return region
+
+    def map_io(self, address_range, read=None, write=None):
+        return self.map_region(address_range, read=read, write=write)
+
+    def write_protect(self, address_range):
+        return self.map_region(address_range, read_only=True)
+
+    def write_protect_rom(self):
+        return self.write_protect(self._rom)
+
+    def unmap_region(self, region):
+        index = self._regions.index(region)
+        address_range = region.address_range
+        self._regions[index] = MemoryRegion(range(0))  # keep the other indexes stable
+        self._region_map[address_range.start:address_range.stop] = bytes(len(address_range))
+        self._translate_write_map(address_range.start, address_range.stop, _CLEAR_MAPPED)
+        self._update_read_path()
+
+    def has_read_handler(self, address):
+        """
+            reading address calls into a peripheral model, so two reads in a row may not agree
+        """
+        region = self._region_map[address]
+        return bool(region) and self._regions[region].read is not None
+
+    def _update_read_path(self):
+        """
+            with no read handler mapped read is the plain class level one. otherwise it goes through a table with
+            a reader per address, plain ram still gets the bytearray's own item lookup and never sees a region
+        """
+        regions = [region for region in self._regions if region is not None and region.read is not None]
+        if not regions:
+            self.__dict__.pop('read', None)
+            return
+        readers = [self._memory.__getitem__] * len(self._memory)
+        for region in regions:
+            readers[region.address_range.start:region.address_range.stop] = (
+                [_region_reader(region)] * len(region.address_range))
+
+        def read(address):
+            return readers[address](address)
+        self.read = read
+
+    def watch_code(self, start_address, end_address):
+        """
+            writes into [start_address, end_address) will be reported to the code watcher
+        """
+        self._translate_write_map(start_address, end_address, _SET_CODE_WATCHED)
+
+    def unwatch_code(self, start_address, end_address):
+        self._translate_write_map(start_address, end_address, _CLEAR_CODE_WATCHED)
+
+    def _translate_write_map(self, start_address, end_address, table):
+        self._write_map[start_address:end_address] = self._write_map[start_address:end_address].translate(table)
+
+    def view(self, start_address=0x0000, end_address=None):
+        """
+            zero copy, read only window over memory, end_address is exclusive
+        """
+        end_address = len(self._memory) if end_address is None else end_address
+        return memoryview(self._memory)[start_address:end_address].toreadonly()
+
+    def snapshot(self):
+        """
+            the whole 64k followed by which addresses were written, as one immutable bytes object.
+            regions are configuration and not part of it
+        """
+        return bytes(self._memory) + bytes(self._written)
+
+    def restore(self, snapshot):
+        """
+            put back a snapshot() in two copies, handlers and write protection are bypassed like
+            write_buffer_to_memory does, and anything compiled from the old contents is thrown away
+        """
+        size = len(self._memory)
+        if len(snapshot) != 2 * size:
+            raise ValueError("snapshot of {0} bytes doesnt match a {1} byte memory".format(len(snapshot), size))
+        self._memory[:] = memoryview(snapshot)[:size]
+        self._written[:] = memoryview(snapshot)[size:]
+        if self._code_watcher is not None:
+            self._code_watcher.flush()
+
+    def set_code_watcher(self, watcher):
+        """
+            register a translation cache that has to hear about writes over code it compiled,
+            watcher.invalidate(address) is called for writes that hit a watch_code range and
+            watcher.flush() when all of memory is replaced at once
+        """
+        self._code_watcher = watcher
+        self.unwatch_code(0, len(self._write_map))
+
 
-        address = start_address
-        for value in buffer:
-            self.write(address, value)
-            address += 1
+class FlexibleAddressMemory(object):
+    """
+        wraps a Memory so it still takes addresses as bytes, hex strings or ints, for callers that
+        dont deal in plain ints. costs a conversion per access, the cpu itself uses Memory directly.
+    """
+
+    def __init__(self, memory=None):
+        self._target = memory if memory is not None else Memory()
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    def __str__(self):
+        return str(self._target)
 
     def read(self, read_address):
-        address = self._convert_address(read_address)
-        value = self._memory.get(address, 0x9d)
-        return value
+        return self._target.read(self._convert_address(read_address))
 
     def write(self, write_address, value):
-        address = self._convert_address(write_address)
-        self._memory[address] = value
+        self._target.write(self._convert_address(write_address), value)
 
     def _convert_address(self, original_address):
         """
@@ -100,11 +347,12 @@ class Metalog(type):
 
 class Stack(object):
 
-    def __init__(self, size=64, start=0x00FF):
+    def __init__(self, size=64, start=0x00FF, seed=None):
         """
             defaults are from the 6800 family ref
             size - size of the stack in bytes
             start - the start address
+            seed - seeds the garbage the stack powers up with, one is picked (and kept in .seed) when not given
 
             this is our stack , its supposed to be circular , hardware controlled and it grows downwards.
         """
@@ -112,10 +360,9 @@ class Stack(object):
         self._stack_top = start
         self._stack_bottom = self._stack_top - self._stack_size + 1
         self._sp = self._stack_top - self._stack_bottom
-        self._stack = [int(random.random()*100) for _ in range(size)]
-        print("sp: {}".format(self._sp))
-        print("stack bottom: {}".format(hex(self._stack_bottom)))
-        print("stack top: {}".format(hex(self._stack_top)))
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        rng = random.Random(self.seed)
+        self._stack = [int(rng.random()*100) for _ in range(size)]
 
     @property
     def sp(self):
@@ -127,6 +374,13 @@ class Stack(object):
             raise ValueError("sp should be 16 bit max")
         self._sp = value - self._stack_bottom
 
+    @property
+    def stack_range(self):
+        """
+            the addresses sp can point at
+        """
+        return range(self._stack_bottom, self._stack_top + 1)
+
     def push(self, value):
         # fist we put the value then we check if its the last memory address, if it is we come back to the start
         self._sp -= 1
@@ -141,6 +395,18 @@ class Stack(object):
         self._sp += 1
         return value
 
+    def snapshot(self):
+        """
+            stack pointer and contents as bytes, everything on the stack is a byte or an address
+        """
+        return struct.pack("<H", self._sp) + array.array('H', self._stack).tobytes()
+
+    def restore(self, snapshot):
+        if len(snapshot) != 2 * (self._stack_size + 1):
+            raise ValueError("snapshot doesnt match a {} byte stack".format(self._stack_size))
+        self._sp = struct.unpack_from("<H", snapshot)[0]
+        self._stack = array.array('H', snapshot[2:]).tolist()
+
     def push_state(self):
         pass
 
@@ -170,7 +436,135 @@ def test_overflow():
         stack.push(num)
     assert(stack.sp == stack._stack_top - 1)
 
+
+def test_snapshot_round_trip():
+    from emulator import create_emulator
+    parser = create_emulator(bytes([0xA6, 0x42, 0xAE, 0x07, 0xAD, 0x00, 0x20, 0xFE]), seed=5)  # LDA, LDX, BSR, BRA *
+    parser.run(max_instructions=3)
+    registers = parser.registers
+    registers.enqueue_hardware_interrupt(test_underflow)
+    snapshot = parser.snapshot()
+
+    registers.a, registers.x, registers.pc, registers.ccr = 0x00, 0xFF, 0x1234, 0x0F
+    registers.push(0x55)
+    registers.pop()
+    registers.pop()
+    registers.cycles += 100
+    registers.dequeue_hardware_interrupt()
+    parser._memory.write_buffer_to_memory(0x0000, bytes(0x100))
+    assert parser.snapshot() != snapshot
+
+    parser.restore(snapshot)
+    assert parser.snapshot() == snapshot
+    assert (registers.a, registers.x, registers.pc) == (0x42, 0x07, 0x0006)
+    assert registers.pop() == 0x0006  # the BSR return address is back on the stack
+    assert registers.dequeue_hardware_interrupt() is test_underflow
+    assert parser._memory.read(0x0000) == 0xA6
+
+
+def test_snapshot_is_bytes():
+    import pickle
+    from emulator import create_emulator
+    from scheduler import IRQ_VECTOR
+    parser = create_emulator(bytes([0x9A, 0x20, 0xFE]), seed=5)  # CLI, BRA *
+    parser.registers._interrupts.schedule(50, IRQ_VECTOR)
+    snapshot = parser.snapshot()
+    assert snapshot.handlers == ()  # nothing but vectors pending, so nothing but bytes
+    assert all(isinstance(part, bytes) for part in snapshot[:3])
+    hash(snapshot)
+
+    copy = create_emulator(bytes(3), seed=6)
+    copy.restore(pickle.loads(pickle.dumps(snapshot)))
+    assert copy.snapshot() == snapshot
+    copy.run(max_instructions=30)
+    parser.run(max_instructions=30)
+    assert copy.snapshot() == parser.snapshot()  # the irq was taken at the same point in both
+
+    parser.registers.enqueue_hardware_interrupt(lambda: None)
+    try:  # a peripheral model's callable is the limit, it stays an object next to the bytes
+        pickle.dumps(parser.snapshot())
+        assert False
+    except (pickle.PicklingError, AttributeError):
+        pass
+
+
+def test_written_fill_values_are_kept():
+    memory = Memory()
+    memory.write_buffer_to_memory(0x0010, bytes([0x01, memory.fill_value, 0x02]))
+    memory.write(0x0020, memory.fill_value)  # a NOP stored by the program is data like any other byte
+    assert list(memory.ranges()) == [(0x0010, bytes([0x01, memory.fill_value, 0x02])), (0x0020, b"\x9d")]
+    assert str(memory) == "0X0010: 0X01\n0X0011: 0X9D\n0X0012: 0X02\n0X0020: 0X9D\n"
+    assert "".join(memory) == str(memory)
+    copy = Memory()
+    copy.restore(memory.snapshot())
+    assert list(copy.ranges()) == list(memory.ranges())
+
+
+def test_export_round_trip():
+    from image_formats import FORMATS, parse_image
+    memory = Memory()
+    memory.write_buffer_to_memory(0x0010, bytes(range(0x40)) + bytes([memory.fill_value]) * 3)
+    memory.write_buffer_to_memory(0xFFF0, bytes(range(0x10)))
+    for image_format in FORMATS:
+        stream = io.BytesIO()
+        memory.export(stream, image_format, sparse=image_format != RAW)
+        copy = Memory()
+        parse_image(stream.getvalue(), image_format).load(copy)
+        assert bytes(copy.view()) == bytes(memory.view()), image_format
+        if image_format != RAW:  # a raw image is dense, the sparse ones carry exactly the written runs
+            assert list(copy.ranges()) == list(memory.ranges()), image_format
+
+
+def test_io_region_handlers():
+    memory = Memory()
+    written = []
+    region = memory.map_io(range(0x0000, 0x0010), read=lambda address: address | 0x40,
+                           write=lambda address, value: written.append((address, value)))
+    memory.write(0x0080, 0x12)
+    memory.write(0x0003, 0x34)
+    assert memory.read(0x0003) == 0x43 and memory.read(0x0080) == 0x12
+    assert written == [(0x0003, 0x34)] and memory.view()[0x0003] == memory.fill_value
+    assert memory.has_read_handler(0x000F) and not memory.has_read_handler(0x0010)
+    region.read = lambda address: 0x99  # swapped while mapped, like the debugger and the recorder do
+    assert memory.read(0x0003) == 0x99
+    memory.unmap_region(region)
+    assert 'read' not in memory.__dict__  # back on the plain read
+    memory.write(0x0003, 0x34)
+    assert memory.read(0x0003) == 0x34
+
+
+def test_write_protection():
+    memory = Memory()
+    memory.write(0x3F00, 0x11)
+    region = memory.write_protect_rom()
+    memory.write(0x3F00, 0x22)
+    assert memory.read(0x3F00) == 0x11
+    memory.write_buffer_to_memory(0x3F00, b"\x33")  # loading an image goes around the protection
+    assert memory.read(0x3F00) == 0x33
+    memory.unmap_region(region)
+    memory.write(0x3F00, 0x44)
+    assert memory.read(0x3F00) == 0x44
+
+
+def test_bad_regions():
+    memory = Memory()
+    memory.map_io(range(0x0000, 0x0010), read=lambda address: 0)
+    for address_range in (range(0x0008, 0x0018), range(0xFFF0, 0x10001), range(-1, 4)):
+        try:
+            memory.map_region(address_range, read_only=True)
+        except ValueError:
+            continue
+        raise AssertionError(address_range)
+
+
 if __name__ == "__main__":
 
     test_underflow()
     test_overflow()
+    test_snapshot_round_trip()
+    test_snapshot_is_bytes()
+    test_written_fill_values_are_kept()
+    test_export_round_trip()
+    test_io_region_handlers()
+    test_write_protection()
+    test_bad_regions()
@@ -0,0 +1,117 @@
+import collections
+import hashlib
+import marshal
+import os
+
+
+OPCODE_MAP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opcode_map.csv")
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")
+CACHE_FORMAT_VERSION = 1
+
+OpcodeInfo = collections.namedtuple('OpcodeInfo', ['mnemon', 'argument_sizes', 'addressing_mode', 'cycles'])
+
+# the 6805 opcode map is laid out by addressing mode, the high nibble gives it away
+_ADDRESSING_MODE_BY_ROW = (
+    'BTB', 'BSC', 'REL', 'DIR', 'INH', 'INH', 'IX1', 'IX',  # bit test and branch, bit set/clear, relative ...
+    'INH', 'INH', 'IMM', 'DIR', 'EXT', 'IX2', 'IX1', 'IX',
+)
+
+_loaded_tables = {}  # csv digest -> (opcode table, legacy opcode map)
+_known_digests = {}  # (path, mtime, size) -> csv digest, spares rereading an unchanged csv
+
+
+def addressing_mode(opcode):
+    if opcode == 0xAD:  # BSR sits in the immediate row but branches relative
+        return 'REL'
+    return _ADDRESSING_MODE_BY_ROW[opcode >> 4]
+
+
+def load_opcode_table(opcode_map_file=OPCODE_MAP_FILE, cache_directory=CACHE_DIRECTORY):
+    """
+        the opcode map as a 256 entry tuple indexed by opcode byte, OpcodeInfo for known opcodes and None for
+        illegal ones. parsed once per process and kept on disk keyed by the csv's sha256, so this is
+        only expensive the very first time a given csv is seen.
+        :return: (opcode table, {'0x..': {'mnemon': .., 'argument_sizes': [..]}} legacy opcode map)
+    """
+    stat = os.stat(opcode_map_file)
+    file_key = (os.path.abspath(opcode_map_file), stat.st_mtime_ns, stat.st_size)
+    digest = _known_digests.get(file_key)
+    if digest is not None and digest in _loaded_tables:
+        return _loaded_tables[digest]
+
+    with open(opcode_map_file, 'rb') as input_file:
+        content = input_file.read()
+    digest = hashlib.sha256(content).hexdigest()
+    _known_digests[file_key] = digest
+
+    tables = _loaded_tables.get(digest)
+    if tables is None:
+        rows = _read_cache(cache_directory, digest)
+        if rows is None:
+            rows = parse_opcode_map(content.decode('utf-8'))
+            _write_cache(cache_directory, digest, rows)
+        tables = _build_tables(rows)
+        _loaded_tables[digest] = tables
+    return tables
+
+
+def parse_opcode_map(text):
+    """
+        parse opcode map csv lines of the form "MNEMON ,0xOP ,sizes[ ,cycles] // comment"
+        sizes is a | separated list of operand byte sizes, 0 for none
+        :return: tuple of 256 rows, (mnemon, argument_sizes, addressing_mode, cycles) or None
+    """
+    rows = [None] * 0x100
+    for line in text.splitlines():
+        line = line.split("//", 1)[0].strip()  # support for comments, fuck yea!
+        if not line:
+            continue
+        fields = [field.strip() for field in line.split(",")]
+        mnemon, op, argument_sizes = fields[:3]
+        cycles = int(fields[3]) if len(fields) > 3 else 0
+        argument_sizes = tuple(int(argument_size) for argument_size in argument_sizes.split("|"))
+        if argument_sizes == (0,):
+            argument_sizes = ()
+        opcode = int(op, 16)
+        rows[opcode] = (mnemon, argument_sizes, addressing_mode(opcode), cycles)
+    return tuple(rows)
+
+
+def _build_tables(rows):
+    table = tuple(OpcodeInfo(*row) if row is not None else None for row in rows)
+    opcode_map = {}
+    for opcode, info in enumerate(table):
+        if info is not None:
+            opcode_map['{0:#04x}'.format(opcode)] = {'mnemon': info.mnemon, 'argument_sizes': list(info.argument_sizes)}
+    return table, opcode_map
+
+
+def _cache_path(cache_directory, digest):
+    return os.path.join(cache_directory, "opcode_map.{0}.v{1}.marshal".format(digest[:16], CACHE_FORMAT_VERSION))
+
+
+def _read_cache(cache_directory, digest):
+    if cache_directory is None:
+        return None
+    try:
+        with open(_cache_path(cache_directory, digest), 'rb') as cache_file:
+            rows = marshal.load(cache_file)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if type(rows) != tuple or len(rows) != 0x100:
+        return None
+    return rows
+
+
+def _write_cache(cache_directory, digest, rows):
+    if cache_directory is None:
+        return
+    path = _cache_path(cache_directory, digest)
+    temporary_path = "{0}.{1}".format(path, os.getpid())
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        with open(temporary_path, 'wb') as cache_file:
+            marshal.dump(rows, cache_file)
+        os.replace(temporary_path, path)  # readers in other processes never see half a file
+    except OSError:
+        pass  # read only checkout, we just parse again next time
@@ -0,0 +1,261 @@
+import argparse
+import array
+import struct
+import sys
+
+from opcodes import load_opcode_table
+from registers import CCR_C, CCR_H, CCR_I, CCR_N, CCR_Z
+
+
+MAGIC = b"P605"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sB")
+
+BRANCH_OPCODES = range(0x20, 0x30)  # the relative branch family, BRA through BIH
+
+# per branch opcode (ccr mask, taken when any of it is set), the same conditions as Commands.
+# BIL and BIH never branch, there is no irq pin. a taken branch can land right after itself, so pc doesnt tell
+_BRANCH_CONDITIONS = ((0, False), (0, True), (CCR_C | CCR_Z, False), (CCR_C | CCR_Z, True), (CCR_C, False),
+                      (CCR_C, True), (CCR_Z, False), (CCR_Z, True), (CCR_H, False), (CCR_H, True), (CCR_N, False),
+                      (CCR_N, True), (CCR_I, False), (CCR_I, True), (0, True), (0, True))
+
+
+class Profiler(object):
+
+    def __init__(self):
+        """
+            execution counters, all preallocated arrays indexed by opcode byte or address.
+            attach with OpCodeParser.set_profiler(), profiles from different runs add up with merge()
+        """
+        self.opcode_counts = array.array('Q', bytes(8 * 0x100))
+        self.pc_counts = array.array('Q', bytes(8 * 0x10000))
+        self.pc_opcodes = array.array('B', bytes(0x10000))  # last opcode seen at each address, for the report
+        self.branch_taken = array.array('Q', bytes(8 * len(BRANCH_OPCODES)))  # per branch opcode
+        self.pc_taken = array.array('Q', bytes(8 * 0x10000))  # per branch address
+        self.branch_targets = array.array('H', bytes(2 * 0x10000))  # where a taken branch went, see pc_taken
+
+    def _arrays(self):
+        return (self.opcode_counts, self.pc_counts, self.pc_opcodes, self.branch_taken, self.pc_taken,
+                self.branch_targets)
+
+    def wrap(self, dispatch_table, state):
+        """
+            :return: a dispatch table whose handlers count themselves and then call the original one
+        """
+        return [self._profiled_branch(handler, opcode, state) if opcode in BRANCH_OPCODES
+                else self._profiled_handler(handler, opcode)
+                for opcode, handler in enumerate(dispatch_table)]
+
+    def _profiled_handler(self, handler, opcode):
+        opcode_counts = self.opcode_counts
+        pc_counts = self.pc_counts
+        pc_opcodes = self.pc_opcodes
+
+        def profiled(pc):
+            opcode_counts[opcode] += 1
+            pc_counts[pc] += 1
+            pc_opcodes[pc] = opcode
+            handler(pc)
+        return profiled
+
+    def _profiled_branch(self, handler, opcode, state):
+        opcode_counts = self.opcode_counts
+        pc_counts = self.pc_counts
+        pc_opcodes = self.pc_opcodes
+        branch_taken = self.branch_taken
+        pc_taken = self.pc_taken
+        branch_targets = self.branch_targets
+        branch = opcode - BRANCH_OPCODES.start
+        mask, when_set = _BRANCH_CONDITIONS[branch]
+
+        def profiled(pc):
+            opcode_counts[opcode] += 1
+            pc_counts[pc] += 1
+            pc_opcodes[pc] = opcode
+            taken = bool(state.ccr & mask) == when_set
+            handler(pc)
+            if taken:
+                branch_taken[branch] += 1
+                pc_taken[pc] += 1
+                branch_targets[pc] = state.pc
+        return profiled
+
+    def merge(self, other):
+        """
+            add other's counts to ours, for profiles of the same rom collected in parallel
+        """
+        for mine, theirs in zip(self._arrays(), other._arrays()):
+            if mine.typecode == 'Q':
+                for index, count in enumerate(theirs):
+                    if count:
+                        mine[index] += count
+        for address, taken in enumerate(other.pc_taken):
+            if taken:  # a target of 0x0000 is as good as any other
+                self.branch_targets[address] = other.branch_targets[address]
+        for address, opcode in enumerate(other.pc_opcodes):
+            if other.pc_counts[address]:
+                self.pc_opcodes[address] = opcode
+        return self
+
+    def to_bytes(self):
+        arrays = self._arrays()
+        if sys.byteorder != 'little':
+            arrays = [array.array(values.typecode, values) for values in arrays]
+            for values in arrays:
+                values.byteswap()
+        return _HEADER.pack(MAGIC, FORMAT_VERSION) + b"".join(values.tobytes() for values in arrays)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version = _HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("not a version {} profile".format(FORMAT_VERSION))
+        profiler = cls()
+        position = _HEADER.size
+        for values in profiler._arrays():
+            size = len(values) * values.itemsize
+            if position + size > len(data):
+                raise ValueError("truncated profile")
+            values[:] = array.array(values.typecode, data[position:position + size])
+            if sys.byteorder != 'little':
+                values.byteswap()
+            position += size
+        return profiler
+
+    def save(self, path):
+        with open(path, 'wb') as profile_file:
+            profile_file.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as profile_file:
+            return cls.from_bytes(profile_file.read())
+
+    def hot_addresses(self, count=20):
+        """
+            :return: [(address, times executed)] most executed first
+        """
+        hot = sorted((times, address) for address, times in enumerate(self.pc_counts) if times)
+        return [(address, times) for times, address in reversed(hot[-count:])]
+
+    def hot_opcodes(self, count=20):
+        hot = sorted((times, opcode) for opcode, times in enumerate(self.opcode_counts) if times)
+        return [(opcode, times) for times, opcode in reversed(hot[-count:])]
+
+    def branches(self):
+        """
+            :return: [(opcode, taken, not taken)] for every branch opcode that ran
+        """
+        return [(opcode, self.branch_taken[opcode - BRANCH_OPCODES.start],
+                 self.opcode_counts[opcode] - self.branch_taken[opcode - BRANCH_OPCODES.start])
+                for opcode in BRANCH_OPCODES if self.opcode_counts[opcode]]
+
+    def loops(self, count=10):
+        """
+            backward branches that were taken, each one closes a loop running from its target to the branch
+            :return: [(start, end, iterations, instructions executed inside)] busiest first, end is exclusive
+        """
+        loops = []
+        for address, taken in enumerate(self.pc_taken):
+            target = self.branch_targets[address]
+            if taken and target <= address:
+                end = address + 2
+                loops.append((target, end, taken, sum(self.pc_counts[target:end])))
+        loops.sort(key=lambda loop: loop[3], reverse=True)
+        return loops[:count]
+
+
+def print_report(profiler, count=20):
+    opcode_table = load_opcode_table()[0]
+
+    def mnemon(opcode):
+        info = opcode_table[opcode]
+        return info.mnemon if info is not None else "???"
+
+    total = sum(profiler.opcode_counts)
+    print("{0:,} instructions".format(total))
+
+    print("\nhottest addresses")
+    for address, times in profiler.hot_addresses(count):
+        print("  {0:#06x} {1:<6} {2:>14,} {3:6.2f}%".format(
+            address, mnemon(profiler.pc_opcodes[address]), times, 100.0 * times / total))
+
+    print("\nhottest opcodes")
+    for opcode, times in profiler.hot_opcodes(count):
+        print("  {0:#04x} {1:<6} {2:>14,} {3:6.2f}%".format(opcode, mnemon(opcode), times, 100.0 * times / total))
+
+    print("\nbranches            taken      not taken")
+    for opcode, taken, not_taken in profiler.branches():
+        print("  {0:<6} {1:>14,} {2:>14,}".format(mnemon(opcode), taken, not_taken))
+
+    print("\nloops")
+    for start, end, iterations, instructions in profiler.loops(count):
+        print("  {0:#06x}-{1:#06x} {2:>14,} iterations {3:>14,} instructions".format(start, end - 1, iterations, instructions))
+
+
+def _profile(code, instructions):
+    from emulator import create_emulator
+    parser = create_emulator(code, seed=1)
+    profiler = Profiler()
+    parser.set_profiler(profiler)
+    parser.run(max_instructions=instructions)
+    return profiler
+
+
+def test_branch_counts_and_targets():
+    # BRA to the next instruction, CLC, BCC back to 0x0000, twice round
+    profiler = _profile(bytes([0x20, 0x00, 0x98, 0x24, 0xFB]), 8)
+    assert list(profiler.opcode_counts[0x20:0x26]) == [3, 0, 0, 0, 2, 0]
+    assert profiler.branches() == [(0x20, 3, 0), (0x24, 2, 0)]  # an offset of 0 is still taken
+    assert (profiler.pc_taken[0], profiler.pc_taken[3]) == (3, 2)
+    assert profiler.branch_targets[3] == 0x0000
+    assert profiler.loops() == [(0x0000, 0x0005, 2, 8)]
+
+    # not taken, BCS with the carry clear
+    profiler = _profile(bytes([0x98, 0x25, 0x10, 0x20, 0xFE]), 3)
+    assert profiler.branches() == [(0x20, 1, 0), (0x25, 0, 1)]
+
+
+def test_merge_and_report():
+    import contextlib
+    import io
+    first = _profile(bytes([0x20, 0x00, 0x98, 0x24, 0xFB]), 8)
+    merged = Profiler.from_bytes(Profiler().to_bytes())
+    merged.merge(first).merge(first)
+    assert merged.branch_targets[3] == 0x0000  # taken to 0x0000 and still known after the merge
+    assert merged.branches() == [(0x20, 6, 0), (0x24, 4, 0)]
+    assert merged.loops() == [(0x0000, 0x0005, 4, 16)]
+
+    report = io.StringIO()
+    with contextlib.redirect_stdout(report):
+        print_report(merged, count=2)
+    lines = report.getvalue().splitlines()
+    assert lines[0] == "16 instructions"
+    assert lines[lines.index("hottest addresses") + 1].split() == ["0x0002", "CLC", "6", "37.50%"]
+    assert lines[lines.index("branches            taken      not taken") + 1].split() == ["BRA", "6", "0"]
+    assert lines[lines.index("loops") + 1].split() == ["0x0000-0x0004", "4", "iterations", "16", "instructions"]
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="hot spot report from one or more saved profiles")
+    argument_parser.add_argument("profiles", nargs="*", help="profiles written by Profiler.save, merged together")
+    argument_parser.add_argument("--run", metavar="ROM", help="profile this rom (loaded at 0x0000) as well")
+    argument_parser.add_argument("-i", "--instructions", type=int, default=1000000, help="instructions to run with --run")
+    argument_parser.add_argument("-n", "--top", type=int, default=20, help="entries per section")
+    argument_parser.add_argument("--save", help="write the merged profile here")
+    options = argument_parser.parse_args()
+
+    merged = Profiler()
+    for path in options.profiles:
+        merged.merge(Profiler.load(path))
+    if options.run:
+        from emulator import create_emulator
+        with open(options.run, 'rb') as rom_file:
+            parser = create_emulator(rom_file.read())
+        run_profiler = Profiler()
+        parser.set_profiler(run_profiler)
+        parser.run(max_instructions=options.instructions)
+        merged.merge(run_profiler)
+    if options.save:
+        merged.save(options.save)
+    print_report(merged, options.top)
@@ -1,45 +1,96 @@
+import struct
+
 from memory import Stack
+from scheduler import NEVER, InterruptScheduler
+
+
+# condition code register bits, the ccr is kept packed exactly like the cpu pushes it
+CCR_C = 0x01  # carry / borrow
+CCR_Z = 0x02  # zero
+CCR_N = 0x04  # negative
+CCR_I = 0x08  # interrupt mask
+CCR_H = 0x10  # half carry
+CCR_RESET = 0xE0  # bits 5-7 are not used and always read as one
+CCR_FLAGS = (('C', CCR_C), ('Z', CCR_Z), ('N', CCR_N), ('I', CCR_I), ('H', CCR_H))
+
+# what registers.halted holds, 0 while the cpu runs
+HALT_WAIT = 1  # WAIT, sleeping until an interrupt
+HALT_STOP = 2  # STOP, same but with the oscillator off
+HALT_IDLE = 3  # spinning on a branch to itself, nothing changes until an interrupt comes in
+
+_SNAPSHOT_FORMAT = struct.Struct("<BBHBBQ")  # a, x, pc, ccr, halted, cycles, the stack follows
 
 
 class Registers(object):
 
-    def __init__(self):
-        self._address_size = 0xFFFF
-        self._general_register_size = 0xFF
+    __slots__ = ('_a', '_x', '_pc', '_ccr', '_stack', '_interrupts', 'halted', 'cycles')
+
+    _address_size = 0xFFFF
+    _general_register_size = 0xFF
+
+    def __init__(self, seed=None):
+        """
+            seed - passed on to the Stack, two register files with the same seed power up the same
+        """
         self._a = 0x0
         self._x = 0x0
         self._pc = 0x0
-        self._CCR = {'C': 0, 'Z': 0, 'N': 0, 'I': 0, 'H': 0, 5: 1, 6: 1, 7: 1}
-        self._stack = Stack(size=64, start=0x00FF)  # fixme find out real specs of stack
-        self._sp = self._stack.sp
-        self._hardware_interrupt_queue = []
+        self._ccr = CCR_RESET
+        self._stack = Stack(size=64, start=0x00FF, seed=seed)  # fixme find out real specs of stack
+        self._interrupts = InterruptScheduler()
+        self.halted = 0  # one of the HALT_ states
+        self.cycles = 0  # bus cycles spent since reset
+
+    @property
+    def interrupts(self):
+        """
+            the InterruptScheduler, schedule vectored interrupts at a cycle with it
+        """
+        return self._interrupts
 
     def enqueue_hardware_interrupt(self, interrupt):
-        self._hardware_interrupt_queue.push(interrupt)
+        """
+            raise callable interrupt now, it is taken after the next instruction unless the I bit is set
+        """
+        self._interrupts.schedule(self.cycles, handler=interrupt)
 
     def dequeue_hardware_interrupt(self):
-        interrupt = self._hardware_interrupt_queue.pop(0)
-        return interrupt
+        """
+            take the next pending interrupt whatever its cycle and the I bit, for the old step-and-call loops
+        """
+        return self._interrupts.pop(NEVER, False).handler
 
     def are_there_any_hardware_interruprs(self):
-        return len(self._hardware_interrupt_queue) > 0
+        return len(self._interrupts) > 0
+
+    def snapshot(self):
+        """
+            a, x, pc, ccr, halted, cycles and the stack as bytes
+            :return: (bytes, pending interrupts as bytes, their handler callables) - see InterruptScheduler.snapshot
+        """
+        registers = _SNAPSHOT_FORMAT.pack(self._a, self._x, self._pc, self._ccr, self.halted, self.cycles)
+        return (registers + self._stack.snapshot(),) + self._interrupts.snapshot()
+
+    def restore(self, snapshot, interrupts=b"", handlers=()):
+        self._a, self._x, self._pc, self._ccr, self.halted, self.cycles = _SNAPSHOT_FORMAT.unpack_from(snapshot)
+        self._stack.restore(snapshot[_SNAPSHOT_FORMAT.size:])
+        self._interrupts.restore(interrupts, handlers)
 
     def __str__(self):
-        flags = {'C': self._CCR['C'], 'Z': self._CCR['Z'], 'N': self._CCR['N'], 'I': self._CCR['I'], 'H': self._CCR['H']}
         string_representation = """
             a: {a:#0{register_hex_length}x}, x: {x:#0{register_hex_length}x}
             flags: {flags}
             pc: {pc:#0{address_hex_length}x}, sp: {sp:#0{address_hex_length}x}
-        """.format(a=self._a, x=self._x, flags=flags, pc=self._pc, sp=self._sp, address_hex_length=6, register_hex_length=4)
+        """.format(a=self._a, x=self._x, flags=self.flags, pc=self._pc, sp=self.sp, address_hex_length=6, register_hex_length=4)
         return string_representation
 
     def is_valid_general_register_value(self, value):
-        if value not in range(0x0, self.general_register_size+1):
+        if not 0x0 <= value <= self._general_register_size:
             raise ValueError("value exceeding register size {}".format(hex(value)))
         return True
 
     def _is_valid_address(self, address):
-        if address not in range(0x0, self._address_size+1):
+        if not 0x0 <= address <= self._address_size:
             raise ValueError("address out of range {}".format(address))
         return True
 
@@ -53,8 +104,9 @@ class Registers(object):
 
     @a.setter
     def a(self, value):
-        if self.is_valid_general_register_value(value):
-            self._a = value
+        if not 0x0 <= value <= 0xFF:
+            raise ValueError("value exceeding register size {}".format(hex(value)))
+        self._a = value
 
     @property
     def x(self):
@@ -62,8 +114,9 @@ class Registers(object):
 
     @x.setter
     def x(self, value):
-        if self.is_valid_general_register_value(value):
-            self._x = value
+        if not 0x0 <= value <= 0xFF:
+            raise ValueError("value exceeding register size {}".format(hex(value)))
+        self._x = value
 
     @property
     def pc(self):
@@ -71,41 +124,75 @@ class Registers(object):
 
     @pc.setter
     def pc(self, value):
-        if value not in  range(0x0, 0xFFFF):
+        if not 0x0 <= value <= 0xFFFF:
             raise ValueError("pc should be 16 bit max")
         self._pc = value
 
+    @property
+    def sp(self):
+        return self._stack.sp
+
+    @property
+    def stack_range(self):
+        return self._stack.stack_range
+
+    @property
+    def seed(self):
+        return self._stack.seed
+
     @property
     def ccr(self):
-        return self._CCR
+        """
+            the condition code register as one byte, test flags with the CCR_ masks
+        """
+        return self._ccr
+
+    @ccr.setter
+    def ccr(self, value):
+        self._ccr = (value & 0xFF) | CCR_RESET
+
+    @property
+    def flags(self):
+        """
+            {'C': 0/1, ...} for printing, the cpu itself never builds this
+        """
+        return {flag: 1 if self._ccr & mask else 0 for flag, mask in CCR_FLAGS}
 
     def toggle_half_carry(self):
-        self.toggle_flag('H')
+        self.toggle_flag(CCR_H)
 
     def toggle_interrupt_mask(self):
-        self.toggle_flag('I')
+        self.toggle_flag(CCR_I)
 
     def toggle_negative_flag(self):
-        self.toggle_flag('N')
+        self.toggle_flag(CCR_N)
 
     def toggle_zero_flag(self):
-        self.toggle_flag('Z')
+        self.toggle_flag(CCR_Z)
 
     def toggle_carry_flag(self):
-        self.toggle_flag('C')
+        self.toggle_flag(CCR_C)
+
+    def toggle_flag(self, mask):
+        self._ccr ^= mask
 
-    def toggle_flag(self, flag):
-        self._CCR[flag] ^= 0x1
+    def set_flag(self, mask):
+        self._ccr |= mask
 
-    def set_flag(self, flag):
-        self._CCR[flag] = 0x1
+    def clear_flag(self, mask):
+        self._ccr &= ~mask
 
-    def clear_flag(self, flag):
-        self._CCR[flag] = 0x0
+    def update_flags(self, mask, flags):
+        """
+            replace the flags in mask with the matching bits of flags, the rest stay as they are
+        """
+        self._ccr = (self._ccr & ~mask) | (flags & mask)
 
-    def update_flags(self, flag_dictionary):
-        for flag, value in flag_dictionary.items():
-            self._CCR[flag] = value
+    def set_nz(self, result):
+        """
+            N and Z from an 8 bit result, what most instructions leave behind
+        """
+        self._ccr = (self._ccr & 0xF9) | ((result & 0x80) >> 5) | (0 if result else CCR_Z)
 
     def push(self, value):
         self._stack.push(value)
@@ -0,0 +1,298 @@
+import collections
+import struct
+
+from emulator import STOP_HALTED, STOP_MAX_INSTRUCTIONS, RunResult
+
+
+MAGIC = b"R605"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sBQ")  # magic, version, power up seed
+
+# an event is one tag byte followed by its payload
+EVENT_INTERRUPT = 0x01  # varint instructions since the previous interrupt, varint cycles since it, source byte
+EVENT_IO_READ = 0x02  # address (2 bytes little endian) and the value the peripheral returned
+_IO_READ = struct.Struct("<HB")
+
+# instruction - instructions completed before it was raised, cycles - registers.cycles at that point
+InterruptEvent = collections.namedtuple('InterruptEvent', ['instruction', 'cycles', 'source'])
+
+
+def _write_varint(buffer, value):
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+class EventLog(object):
+
+    def __init__(self, seed, interrupts, io_reads):
+        """
+            a parsed recording
+            seed - the power up seed the recorded machine was built with
+            interrupts - list of InterruptEvent in the order they were raised
+            io_reads - list of (address, value) in the order the program read them
+        """
+        self.seed = seed
+        self.interrupts = interrupts
+        self.io_reads = io_reads
+
+    @classmethod
+    def parse(cls, data):
+        magic, version, seed = _HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("not a version {} event log".format(FORMAT_VERSION))
+        interrupts = []
+        io_reads = []
+        instruction = 0
+        cycles = 0
+        position = _HEADER.size
+        while position < len(data):
+            tag = data[position]
+            position += 1
+            if tag == EVENT_INTERRUPT:
+                delta, position = _read_varint(data, position)
+                instruction += delta
+                delta, position = _read_varint(data, position)
+                cycles += delta
+                interrupts.append(InterruptEvent(instruction, cycles, data[position]))
+                position += 1
+            elif tag == EVENT_IO_READ:
+                io_reads.append(_IO_READ.unpack_from(data, position))
+                position += _IO_READ.size
+            else:
+                raise ValueError("unknown event {0:#04x} at offset {1}".format(tag, position - 1))
+        return cls(seed, interrupts, io_reads)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as log_file:
+            return cls.parse(log_file.read())
+
+
+class Recorder(object):
+
+    def __init__(self, parser, stream, interrupts=None, buffer_size=0x10000):
+        """
+            log everything that can make two runs of the same rom differ: the power up seed, interrupts and
+            values read from peripheral models (regions with a read handler, map them before recording starts)
+            parser - a machine fresh from create_emulator, or restored from a snapshot taken at the same point
+            stream - binary file object the log is written to
+            interrupts - {source number (0-255): handler}, raise them with interrupt(source)
+            buffer_size - events are kept in memory and written out in chunks of about this many bytes
+
+            run() and step() have to go through the recorder so it can count instructions, that count is what
+            interrupts are keyed by. recording costs a callback per instruction, replay does not.
+        """
+        self._parser = parser
+        self._state = parser.registers
+        self._stream = stream
+        self._interrupts = interrupts or {}
+        self._buffer_size = buffer_size
+        self._buffer = bytearray(_HEADER.pack(MAGIC, FORMAT_VERSION, self._state.seed))
+        self._instructions = 0  # counted by the until hook, the parser's skipped_instructions make up the rest
+        self._skipped = parser.skipped_instructions
+        self._last_instruction = 0
+        self._last_cycles = self._state.cycles
+        self._wrapped_regions = []
+        for region in parser.memory._regions:
+            if region is not None and region.read is not None:
+                self._wrapped_regions.append((region, region.read))
+                region.read = self._recording_read(region.read)
+
+    def _recording_read(self, read):
+        buffer = self._buffer
+
+        def recording_read(address):
+            value = read(address)
+            buffer.append(EVENT_IO_READ)
+            buffer.extend(_IO_READ.pack(address, value))
+            return value
+        return recording_read
+
+    def interrupt(self, source):
+        """
+            raise interrupt source now, it is delivered after the next instruction like any hardware interrupt
+        """
+        handler = self._interrupts[source]
+        cycles = self._state.cycles
+        instruction = self._instructions + self._parser.skipped_instructions - self._skipped
+        self._buffer.append(EVENT_INTERRUPT)
+        _write_varint(self._buffer, instruction - self._last_instruction)
+        _write_varint(self._buffer, cycles - self._last_cycles)
+        self._buffer.append(source)
+        self._last_instruction = instruction
+        self._last_cycles = cycles
+        self._state.enqueue_hardware_interrupt(handler)
+
+    def run(self, max_instructions=None, max_cycles=None, until_pc=None, until=None):
+        """
+            OpCodeParser.run, with the instruction count kept exact for interrupt() calls made while it runs
+        """
+        start = self._instructions
+
+        def count(state):
+            self._instructions += 1
+            return until is not None and until(state)
+
+        result = self._parser.run(max_instructions, max_cycles, until_pc, count)
+        self._instructions = start + result.instructions  # count misses the instruction a stop address ends on
+        self._skipped = self._parser.skipped_instructions  # and result.instructions has the idle iterations
+        self._flush_if_full()
+        return result
+
+    def step(self):
+        self._instructions += self._parser.step()
+        self._skipped = self._parser.skipped_instructions
+        self._flush_if_full()
+
+    def _flush_if_full(self):
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        self._stream.write(self._buffer)
+        del self._buffer[:]  # in place, the read wrappers hold on to this bytearray
+
+    def close(self):
+        """
+            write out what is left and give the peripheral models their own read handlers back
+        """
+        self.flush()
+        for region, read in self._wrapped_regions:
+            region.read = read
+        self._wrapped_regions = []
+
+
+class Replayer(object):
+
+    def __init__(self, parser, log, interrupts=None):
+        """
+            feed a recording back into a machine built the same way as the recorded one, with
+            create_emulator(..., seed=log.seed). peripheral reads are answered from the log and interrupts are
+            delivered at the instruction they were raised at, between runs of the plain interpreter loop.
+            log - EventLog, or the raw bytes of one
+            interrupts - {source number: handler}, the same mapping the recorder was given
+        """
+        if not isinstance(log, EventLog):
+            log = EventLog.parse(log)
+        if parser.registers.seed != log.seed:
+            raise ValueError("machine seed {0} doesnt match the recorded {1}".format(parser.registers.seed, log.seed))
+        self._parser = parser
+        self._state = parser.registers
+        self._log = log
+        self._interrupts = interrupts or {}
+        self._next_interrupt = 0
+        self._io_reads = iter(log.io_reads)
+        self._instructions = 0
+        for region in parser.memory._regions:
+            if region is not None and region.read is not None:
+                region.read = self._replayed_read
+
+    def _replayed_read(self, address):
+        recorded_address, value = next(self._io_reads, (None, None))
+        if recorded_address != address:
+            raise ValueError("replay diverged, read {0:#06x} where the log has {1}".format(
+                address, "nothing left" if recorded_address is None else "{:#06x}".format(recorded_address)))
+        return value
+
+    def _deliver_due_interrupts(self):
+        interrupts = self._log.interrupts
+        while self._next_interrupt < len(interrupts) and interrupts[self._next_interrupt].instruction == self._instructions:
+            event = interrupts[self._next_interrupt]
+            if event.cycles != self._state.cycles:
+                raise ValueError("replay diverged, interrupt {0} at cycle {1} was recorded at cycle {2}".format(
+                    event.source, self._state.cycles, event.cycles))
+            self._state.enqueue_hardware_interrupt(self._interrupts[event.source])
+            self._next_interrupt += 1
+
+    def run(self, max_instructions=None, max_cycles=None, until_pc=None, until=None):
+        """
+            OpCodeParser.run split at the recorded interrupts, between them it is the plain interpreter loop
+        """
+        interrupts = self._log.interrupts
+        instructions = 0
+        cycles = 0
+        elapsed = 0.0
+        while True:
+            self._deliver_due_interrupts()
+            limit = max_instructions - instructions if max_instructions is not None else None
+            if self._next_interrupt < len(interrupts):
+                gap = interrupts[self._next_interrupt].instruction - self._instructions
+                limit = gap if limit is None else min(limit, gap)
+            cycle_limit = max_cycles - cycles if max_cycles is not None else None
+            result = self._parser.run(limit, cycle_limit, until_pc, until)
+            instructions += result.instructions
+            cycles += result.cycles
+            elapsed += result.elapsed
+            self._instructions += result.instructions
+            if result.reason == STOP_HALTED and self._next_interrupt < len(interrupts):
+                # asleep in WAIT, the next recorded interrupt is what woke it
+                if interrupts[self._next_interrupt].instruction != self._instructions:
+                    raise ValueError("replay diverged, cpu halted at instruction {0} but the next interrupt was "
+                                     "recorded at {1}".format(self._instructions, interrupts[self._next_interrupt].instruction))
+                continue
+            if result.reason != STOP_MAX_INSTRUCTIONS or instructions == max_instructions:
+                self._deliver_due_interrupts()
+                return RunResult(result.reason, instructions, cycles, result.pc, elapsed)
+
+    @property
+    def finished(self):
+        """
+            every recorded interrupt was delivered
+        """
+        return self._next_interrupt == len(self._log.interrupts)
+
+
+def test_record_and_replay():
+    import io
+    import random
+    from emulator import STOP_MAX_CYCLES, create_emulator
+    # LDA $10 (a sensor), STA $80, INC $81, BRA to the start
+    rom = bytes([0xB6, 0x10, 0xB7, 0x80, 0x3C, 0x81, 0x20, 0xF8])
+
+    def handlers(parser):
+        def count():  # a peripheral model, its interrupt bumps a counter in ram
+            parser.memory.write(0x90, (parser.memory.read(0x90) + 1) & 0xFF)
+        return {1: count}
+
+    sensor_values = random.Random(3)
+    recorded = create_emulator(rom, patches=[(0x90, b"\x00")], seed=11)
+    recorded.memory.map_io(range(0x10, 0x11), read=lambda address: sensor_values.randrange(0x100))
+    stream = io.BytesIO()
+    recorder = Recorder(recorded, stream, handlers(recorded), buffer_size=16)
+    for instructions in (5, 17, 1, 40):
+        recorder.run(max_instructions=instructions)
+        recorder.interrupt(1)
+    recorder.run(max_instructions=30)
+    recorder.close()
+    assert recorded.memory.read(0x90) == 4
+
+    log = EventLog.parse(stream.getvalue())
+    assert log.seed == 11 and len(log.interrupts) == 4
+    assert [event.instruction for event in log.interrupts] == [5, 22, 23, 63]
+    assert len(log.io_reads) == sum(1 for address, value in log.io_reads if address == 0x10) > 20
+
+    replayed = create_emulator(rom, patches=[(0x90, b"\x00")], seed=log.seed)
+    replayed.memory.map_io(range(0x10, 0x11), read=lambda address: 1 // 0)  # the log answers, not the model
+    replayer = Replayer(replayed, log, handlers(replayed))
+    result = replayer.run(max_cycles=recorded.registers.cycles)
+    assert result.reason == STOP_MAX_CYCLES and replayer.finished
+    assert replayed.snapshot() == recorded.snapshot()  # registers, cycles, stack and every byte of memory
+
+
+if __name__ == "__main__":
+
+    test_record_and_replay()
@@ -0,0 +1,194 @@
+import collections
+import heapq
+import struct
+import sys
+
+
+# the vector table, Memory._user_vectors, each vector holds a big endian handler address
+RESET_VECTOR = 0x3FFE
+SWI_VECTOR = 0x3FFC
+IRQ_VECTOR = 0x3FFA
+TIMER_VECTOR = 0x3FF8
+VECTORS = range(0x3FF4, 0x4000, 2)
+
+INTERRUPT_CYCLES = 10  # stacking the registers and fetching the vector, same as SWI
+NEVER = sys.maxsize
+
+# cycle - when it is raised, priority - lower goes first, sequence - keeps equal ones in the order they were scheduled
+# vector - address of the vector to jump through, or None when handler is a callable that models the interrupt itself
+Interrupt = collections.namedtuple('Interrupt', ['cycle', 'priority', 'sequence', 'vector', 'handler', 'maskable'])
+
+# one packed pending interrupt in a snapshot - cycle, priority, sequence, vector (0 for a callable),
+# maskable and the callable's index in the handlers that go with the snapshot
+_SNAPSHOT_FORMAT = struct.Struct("<qqqHBH")
+
+
+class InterruptScheduler(object):
+
+    def __init__(self):
+        """
+            pending interrupts as a heap keyed by the cycle they are raised at and their priority.
+            the run loop only compares its cycle count against next_cycle, service happens when it is reached,
+            so nothing pending costs one integer comparison per instruction
+        """
+        self._events = []  # heap of Interrupts not raised yet
+        self._due = []  # heap of (priority, sequence, Interrupt) raised and waiting, the I bit holds them back
+        self._sequence = 0
+        self.next_cycle = NEVER  # cycle count at which pop() has something to look at
+
+    def __len__(self):
+        return len(self._events) + len(self._due)
+
+    def schedule(self, cycle, vector=None, handler=None, priority=None, maskable=None):
+        """
+            raise an interrupt once registers.cycles reaches cycle
+            vector - one of VECTORS, the cpu stacks pc, x, a and ccr, sets I and jumps through it
+            handler - callable, called instead when the interrupt is taken, for peripheral models
+            priority - lower goes first when several are pending, defaults to the vector's place in the table
+                       (reset highest), callables come after every vector
+            maskable - held back while the I bit is set, defaults to everything but reset
+            :return: the Interrupt, pass it to cancel()
+        """
+        if (vector is None) == (handler is None):
+            raise ValueError("interrupt needs either a vector or a handler")
+        if vector is not None and vector not in VECTORS:
+            raise ValueError("{0:#06x} is not in the vector table".format(vector))
+        if priority is None:
+            priority = RESET_VECTOR - vector if vector is not None else len(VECTORS) * 2
+        if maskable is None:
+            maskable = vector != RESET_VECTOR
+        interrupt = Interrupt(cycle, priority, self._sequence, vector, handler, maskable)
+        self._sequence += 1
+        heapq.heappush(self._events, interrupt)
+        if cycle < self.next_cycle:
+            self.next_cycle = cycle
+        return interrupt
+
+    def cancel(self, interrupt):
+        """
+            drop a pending interrupt, quietly ignores ones already taken
+        """
+        if interrupt in self._events:
+            self._events.remove(interrupt)
+            heapq.heapify(self._events)
+        else:
+            self._due = [entry for entry in self._due if entry[2] != interrupt]
+            heapq.heapify(self._due)
+        self._update_next_cycle(0)  # anything still due is looked at again right away
+
+    def poll(self):
+        """
+            make the run loop call in after the current instruction, whatever is pending
+        """
+        self.next_cycle = 0
+
+    def next_wake(self, masked):
+        """
+            the earliest cycle a pending interrupt could be taken at, NEVER if there is none
+            masked - the I bit is set, only non maskable interrupts count
+        """
+        pending = self._events + [entry[2] for entry in self._due]
+        return min([interrupt.cycle for interrupt in pending if not masked or not interrupt.maskable], default=NEVER)
+
+    def pop(self, cycle, masked):
+        """
+            the interrupt to take now, None if nothing raised by cycle may go
+            masked - the I bit is set, only non maskable interrupts get through
+        """
+        events = self._events
+        due = self._due
+        while events and events[0].cycle <= cycle:
+            interrupt = heapq.heappop(events)
+            heapq.heappush(due, (interrupt.priority, interrupt.sequence, interrupt))
+
+        taken = None
+        if due:
+            if not masked or not due[0][2].maskable:
+                taken = heapq.heappop(due)[2]
+            else:
+                unmaskable = [entry for entry in due if not entry[2].maskable]
+                if unmaskable:
+                    entry = min(unmaskable)
+                    due.remove(entry)
+                    heapq.heapify(due)
+                    taken = entry[2]
+        self._update_next_cycle(cycle)
+        return taken
+
+    def _update_next_cycle(self, cycle):
+        if self._due:
+            self.next_cycle = cycle  # held back by the I bit, look again after the next instruction
+        elif self._events:
+            self.next_cycle = self._events[0].cycle
+        else:
+            self.next_cycle = NEVER
+
+    def snapshot(self):
+        """
+            every pending interrupt packed into bytes, raised and not yet raised alike.
+            a callable can't be packed, those interrupts keep an index into the handlers tuple instead,
+            so the bytes alone only stand for the whole state when handlers comes back empty
+            :return: (bytes, tuple of handler callables)
+        """
+        pending = sorted(self._events + [entry[2] for entry in self._due])
+        handlers = tuple(interrupt.handler for interrupt in pending if interrupt.handler is not None)
+        packed = []
+        for interrupt in pending:
+            index = handlers.index(interrupt.handler) if interrupt.handler is not None else 0
+            packed.append(_SNAPSHOT_FORMAT.pack(interrupt.cycle, interrupt.priority, interrupt.sequence,
+                                                interrupt.vector or 0, interrupt.maskable, index))
+        return b"".join(packed), handlers
+
+    def restore(self, interrupts=b"", handlers=()):
+        """
+            interrupts, handlers - as returned by snapshot()
+        """
+        self._events = []
+        for cycle, priority, sequence, vector, maskable, index in _SNAPSHOT_FORMAT.iter_unpack(interrupts):
+            handler = handlers[index] if not vector else None
+            self._events.append(Interrupt(cycle, priority, sequence, vector or None, handler, bool(maskable)))
+        heapq.heapify(self._events)
+        self._due = []
+        self._sequence = max([interrupt.sequence for interrupt in self._events] + [self._sequence - 1]) + 1
+        self._update_next_cycle(NEVER)
+
+def test_cancel_keeps_masked_interrupts():
+    scheduler = InterruptScheduler()
+    first = scheduler.schedule(5, IRQ_VECTOR)
+    second = scheduler.schedule(5, TIMER_VECTOR)
+    assert(scheduler.pop(10, masked=True) is None)  # both due, held back by the I bit
+    scheduler.cancel(first)
+    assert(scheduler.next_cycle <= 10)  # the run loop still calls in once the I bit is cleared
+    assert(scheduler.pop(10, masked=False) == second)
+    assert(scheduler.next_cycle == NEVER)
+
+
+def test_snapshot_round_trip():
+    def peripheral():
+        pass
+
+    scheduler = InterruptScheduler()
+    scheduler.schedule(5, IRQ_VECTOR)
+    scheduler.schedule(NEVER, RESET_VECTOR)
+    interrupts, handlers = scheduler.snapshot()
+    assert(isinstance(interrupts, bytes) and handlers == ())  # vectors only, the bytes are the whole state
+
+    scheduler.schedule(7, handler=peripheral)
+    assert(scheduler.pop(6, masked=True) is None)  # the IRQ is due but held back, it is saved all the same
+    interrupts, handlers = scheduler.snapshot()
+    assert(handlers == (peripheral,))  # a callable can't go into bytes, it travels next to them
+
+    restored = InterruptScheduler()
+    restored.restore(interrupts, handlers)
+    assert(restored.next_cycle == 5)
+    assert(restored.pop(6, masked=False).vector == IRQ_VECTOR)
+    assert(restored.pop(7, masked=False).handler is peripheral)
+    assert(restored.pop(NEVER, masked=True).vector == RESET_VECTOR)  # not maskable
+    assert(len(restored) == 0)
+    assert(restored.schedule(1, TIMER_VECTOR).sequence == 3)  # new ones keep sorting after the restored ones
+
+
+if __name__ == "__main__":
+
+    test_cancel_keeps_masked_interrupts()
+    test_snapshot_round_trip()
@@ -0,0 +1,354 @@
+import argparse
+import asyncio
+import base64
+import collections
+import itertools
+import json
+
+from emulator import STOP_MAX_CYCLES, RunResult, create_emulator
+
+
+SLICE_CYCLES = 100000  # cycles a session runs before the next one gets a turn, about 50ms of interpreter time
+MAX_SNAPSHOTS = 32  # kept per session, the oldest goes when another is taken, each holds the whole 128kB of memory
+
+# json-rpc 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+EMULATION_ERROR = -32000
+
+
+class RpcError(Exception):
+
+    def __init__(self, code, message):
+        super(RpcError, self).__init__(message)
+        self.code = code
+
+
+class Session(object):
+
+    def __init__(self, session_id, parser):
+        """
+            one emulated device, runs when the service gives it a slice
+        """
+        self.id = session_id
+        self.parser = parser
+        self.snapshots = collections.OrderedDict()  # number -> Snapshot, oldest first
+        self.snapshot_ids = itertools.count()
+        self.error = None  # what the last run died of
+        self.result = None  # RunResult of the last finished run
+        self._run = None  # (max_instructions, max_cycles, until_pc, future) of the run in progress
+        self._totals = None
+
+    @property
+    def running(self):
+        return self._run is not None
+
+    def start(self, max_instructions, max_cycles, until_pc, future):
+        if self._run is not None:
+            raise RpcError(EMULATION_ERROR, "session {} is already running".format(self.id))
+        self.error = None
+        self._run = (max_instructions, max_cycles, until_pc, future)
+        self._totals = [0, 0, 0.0]  # instructions, cycles, elapsed
+
+    def run_slice(self, slice_cycles):
+        """
+            run up to slice_cycles of the run in progress
+        """
+        max_instructions, max_cycles, until_pc, future = self._run
+        instructions, cycles, elapsed = self._totals
+        cycle_budget = slice_cycles if max_cycles is None else min(slice_cycles, max_cycles - cycles)
+        try:
+            result = self.parser.run(max_instructions - instructions if max_instructions is not None else None,
+                                     cycle_budget, until_pc)
+        except Exception as error:  # whatever the rom did, it ends this run and nobody else's
+            self._finish(future, error=error)
+            return
+        self._totals = [instructions + result.instructions, cycles + result.cycles, elapsed + result.elapsed]
+        done = result.reason != STOP_MAX_CYCLES or (max_cycles is not None and self._totals[1] >= max_cycles)
+        if done:
+            self._finish(future, RunResult(result.reason, self._totals[0], self._totals[1], result.pc,
+                                           self._totals[2]))
+
+    def stop(self):
+        """
+            end the run in progress where it is, the result says it ran out of cycles
+        """
+        if self._run is not None:
+            instructions, cycles, elapsed = self._totals
+            self._finish(self._run[3], RunResult(STOP_MAX_CYCLES, instructions, cycles, self.parser.registers.pc,
+                                                 elapsed))
+
+    def _finish(self, future, result=None, error=None):
+        self._run = None
+        self.result = result
+        self.error = error
+        if not future.done():
+            if error is not None:
+                message = str(error) if isinstance(error, ValueError) else "{0}: {1}".format(type(error).__name__, error)
+                future.set_exception(RpcError(EMULATION_ERROR, message))
+            else:
+                future.set_result(result)
+
+
+class EmulatorService(object):
+
+    def __init__(self, slice_cycles=SLICE_CYCLES):
+        """
+            many emulated devices in one process, run round robin in slices of slice_cycles on the event loop.
+            every session gets the same number of cycles per turn and the loop serves requests between every
+            two slices, so one busy rom only ever holds it up for one slice.
+            requests are json-rpc 2.0, one json object per line, see the methods named rpc_*
+        """
+        self._slice_cycles = slice_cycles
+        self._sessions = {}
+        self._session_ids = itertools.count(1)
+        self._runnable = collections.deque()
+        self._wakeup = None
+        self._scheduler = None
+
+    async def serve(self, path):
+        """
+            :return: the asyncio server listening on unix socket path, the scheduler runs as long as the loop does
+        """
+        self._start_scheduler()
+        return await asyncio.start_unix_server(self._serve_client, path)
+
+    def _start_scheduler(self):
+        if self._scheduler is None:
+            self._wakeup = asyncio.Event()
+            self._scheduler = asyncio.ensure_future(self._schedule())
+
+    async def _schedule(self):
+        runnable = self._runnable
+        while True:
+            if not runnable:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            session = runnable.popleft()
+            if not session.running:  # stopped or closed while waiting for its turn
+                continue
+            try:
+                session.run_slice(self._slice_cycles)
+            except Exception as error:  # never let one session take the scheduler down with it
+                if session.running:
+                    session._finish(session._run[3], error=error)
+            if session.running:
+                runnable.append(session)
+            await asyncio.sleep(0)  # requests and other clients go between every two slices
+
+    async def _serve_client(self, reader, writer):
+        """
+            every request is answered by a task of its own, so a client waiting on a run can still stop it.
+            responses go out as they are ready, the id says which request they answer
+        """
+        requests = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:  # the client is done sending, not necessarily done listening
+                    await asyncio.gather(*requests)
+                    break
+                request = asyncio.ensure_future(self._answer(line, writer))
+                requests.add(request)
+                request.add_done_callback(requests.discard)
+        except ConnectionError:
+            pass
+        finally:
+            for request in requests:
+                request.cancel()
+            writer.close()
+
+    async def _answer(self, line, writer):
+        response = await self.handle(line)
+        if response is not None:
+            writer.write(json.dumps(response).encode() + b"\n")
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def handle(self, line):
+        """
+            answer one json-rpc request line, :return: the response object, None for notifications
+        """
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": PARSE_ERROR, "message": "parse error"}}
+        request_id = request.get("id") if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+                raise RpcError(INVALID_REQUEST, "invalid request")
+            method = getattr(self, "rpc_" + request["method"], None)
+            if method is None:
+                raise RpcError(METHOD_NOT_FOUND, "no method {}".format(request["method"]))
+            params = request.get("params", {})
+            try:
+                result = method(*params) if isinstance(params, list) else method(**params)
+            except TypeError as error:
+                raise RpcError(INVALID_PARAMS, str(error))
+            if asyncio.iscoroutine(result):
+                result = await result
+        except RpcError as error:
+            response = {"jsonrpc": "2.0", "id": request_id, "error": {"code": error.code, "message": str(error)}}
+        except ValueError as error:
+            response = {"jsonrpc": "2.0", "id": request_id, "error": {"code": EMULATION_ERROR, "message": str(error)}}
+        else:
+            response = {"jsonrpc": "2.0", "id": request_id, "result": result}
+        if isinstance(request, dict) and "id" not in request:
+            return None  # a notification
+        return response
+
+    def _session(self, session):
+        try:
+            return self._sessions[session]
+        except KeyError:
+            raise RpcError(INVALID_PARAMS, "no session {}".format(session))
+
+    # the api, every rpc_ method is callable by its name without the prefix
+
+    def rpc_create(self, rom=None, seed=None):
+        """
+            rom - base64 image loaded at 0x0000
+            :return: the new session's id
+        """
+        parser = create_emulator(base64.b64decode(rom) if rom else b"", seed=seed)
+        session = Session(next(self._session_ids), parser)
+        self._sessions[session.id] = session
+        return session.id
+
+    def rpc_close(self, session):
+        session = self._sessions.pop(self._session(session).id)
+        session.stop()
+        return True
+
+    def rpc_sessions(self):
+        return [{"session": session.id, "running": session.running} for session in self._sessions.values()]
+
+    def rpc_load(self, session, data, address=0x0000):
+        """
+            write base64 data into memory at address
+        """
+        image = base64.b64decode(data)
+        self._session(session).parser.memory.write_buffer_to_memory(address, image)
+        return len(image)
+
+    async def rpc_run(self, session, max_cycles=None, max_instructions=None, until_pc=None, wait=True):
+        """
+            run until a limit or until_pc, without a limit it runs until stop
+            wait - answer once the run is over with its result, otherwise right away with null
+        """
+        session = self._session(session)
+        self._start_scheduler()
+        future = asyncio.get_event_loop().create_future()
+        session.start(max_instructions, max_cycles, until_pc, future)
+        self._runnable.append(session)
+        self._wakeup.set()
+        if not wait:
+            return None
+        return self._result(await future)
+
+    def rpc_stop(self, session):
+        session = self._session(session)
+        session.stop()
+        return self._result(session.result)
+
+    def rpc_inspect(self, session):
+        session = self._session(session)
+        registers = session.parser.registers
+        return {
+            "a": registers.a, "x": registers.x, "pc": registers.pc, "sp": registers.sp, "ccr": registers.ccr,
+            "cycles": registers.cycles, "halted": registers.halted, "running": session.running,
+            "result": self._result(session.result), "error": str(session.error) if session.error else None,
+        }
+
+    def rpc_read_memory(self, session, address, length):
+        """
+            :return: base64 of length bytes at address, peripheral handlers are not called
+        """
+        return base64.b64encode(self._session(session).parser.memory.view(address, address + length)).decode()
+
+    def rpc_snapshot(self, session):
+        """
+            :return: a number to restore it by, snapshots stay in the service, the last MAX_SNAPSHOTS of them
+        """
+        session = self._session(session)
+        number = next(session.snapshot_ids)
+        session.snapshots[number] = session.parser.snapshot()
+        if len(session.snapshots) > MAX_SNAPSHOTS:
+            session.snapshots.popitem(last=False)
+        return number
+
+    def rpc_restore(self, session, snapshot):
+        session = self._session(session)
+        if session.running:
+            raise RpcError(EMULATION_ERROR, "session {} is running".format(session.id))
+        if snapshot not in session.snapshots:
+            raise RpcError(INVALID_PARAMS, "no snapshot {}".format(snapshot))
+        session.parser.restore(session.snapshots[snapshot])
+        return True
+
+    @staticmethod
+    def _result(result):
+        return result._asdict() if result is not None else None
+
+
+def test_stop_while_waiting_and_snapshot_limit():
+    import os
+    import tempfile
+
+    async def session():
+        path = os.path.join(tempfile.mkdtemp(), "service.sock")
+        server = await EmulatorService(1000).serve(path)
+        reader, writer = await asyncio.open_unix_connection(path)
+
+        async def call(request_id, method, **params):
+            writer.write(json.dumps({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}).encode()
+                         + b"\n")
+            await writer.drain()
+
+        async def responses(count):
+            lines = [json.loads(await asyncio.wait_for(reader.readline(), 5)) for _ in range(count)]
+            return {response["id"]: response for response in lines}
+
+        await call(1, "create", rom=base64.b64encode(bytes([0x20, 0xFE])).decode())  # BRA *
+        number = (await responses(1))[1]["result"]
+        await call(2, "run", session=number)  # no limit, only stop ends it
+        await asyncio.sleep(0.05)
+        await call(3, "stop", session=number)
+        answered = await responses(2)
+        assert answered[2]["result"]["reason"] == STOP_MAX_CYCLES
+        assert answered[2]["result"] == answered[3]["result"]
+        assert answered[2]["result"]["cycles"] > 1000  # it got several slices before the stop
+
+        for request_id in range(MAX_SNAPSHOTS + 1):
+            await call(request_id, "snapshot", session=number)
+        assert sorted(response["result"] for response in (await responses(MAX_SNAPSHOTS + 1)).values()) == \
+            list(range(MAX_SNAPSHOTS + 1))
+        await call(1, "restore", session=number, snapshot=0)  # the oldest one is gone
+        await call(2, "restore", session=number, snapshot=MAX_SNAPSHOTS)
+        answered = await responses(2)
+        assert answered[1]["error"]["code"] == INVALID_PARAMS and answered[2]["result"] is True
+
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(session())
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="serve emulator sessions over json-rpc on a unix socket")
+    argument_parser.add_argument("socket", help="path of the unix socket")
+    argument_parser.add_argument("-s", "--slice", type=int, default=SLICE_CYCLES, help="cycles per time slice")
+    options = argument_parser.parse_args()
+
+    async def main():
+        server = await EmulatorService(options.slice).serve(options.socket)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
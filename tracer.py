@@ -0,0 +1,166 @@
+import argparse
+import collections
+import struct
+
+from opcodes import load_opcode_table
+
+
+MAGIC = b"T605"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sBB")  # magic, version, record size
+RECORD = struct.Struct("<HBBBHBQ")  # pc, opcode, a, x, sp, ccr, cycles before the instruction - 16 bytes
+
+TraceRecord = collections.namedtuple('TraceRecord', ['pc', 'opcode', 'a', 'x', 'sp', 'ccr', 'cycles'])
+
+
+class Tracer(object):
+
+    def __init__(self, capacity=0x100000, stream=None):
+        """
+            fixed width binary execution trace, one RECORD per instruction written into a preallocated buffer.
+            capacity - records the buffer holds
+            stream - binary file object, when given the buffer is written out in one piece every time it fills
+                     up and the trace is complete. without one it is a ring that keeps the last capacity records,
+                     write them out with dump() (after a crash for instance).
+
+            attach with OpCodeParser.set_tracer(), that swaps in traced dispatch handlers, so a parser without a
+            tracer runs exactly the code it always did.
+        """
+        self._buffer = bytearray(capacity * RECORD.size)
+        self._stream = stream
+        self._offset = 0
+        self._wrapped = False
+        self.records = 0
+        self.cycles = 0  # cycle count of the next instruction, the parser keeps it in line with registers.cycles
+        self._cycle_table = (0,) * 0x100
+
+        if stream is not None:
+            stream.write(_HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size))
+
+    def wrap(self, dispatch_table, opcode_table, state):
+        """
+            :return: a dispatch table whose handlers write a record and then call the original one
+        """
+        self._cycle_table = tuple(info.cycles if info is not None else 0 for info in opcode_table)
+        return [self._traced_handler(handler, opcode, state) for opcode, handler in enumerate(dispatch_table)]
+
+    def _traced_handler(self, handler, opcode, state):
+        write = self.write
+
+        def traced(pc):
+            write(pc, opcode, state.a, state.x, state.sp, state.ccr)
+            handler(pc)
+        return traced
+
+    def write(self, pc, opcode, a, x, sp, ccr):
+        offset = self._offset
+        RECORD.pack_into(self._buffer, offset, pc, opcode, a, x, sp, ccr, self.cycles)
+        self.cycles += self._cycle_table[opcode]
+        self.records += 1
+        offset += RECORD.size
+        if offset == len(self._buffer):
+            offset = 0
+            self._wrapped = True
+            if self._stream is not None:
+                self._stream.write(self._buffer)
+        self._offset = offset
+
+    def last(self):
+        """
+            the buffered records, oldest first, as one bytes object
+        """
+        if self._wrapped and self._stream is None:
+            return bytes(self._buffer[self._offset:]) + bytes(self._buffer[:self._offset])
+        return bytes(self._buffer[:self._offset])
+
+    def dump(self, stream):
+        """
+            write the ring (header included) to stream, the last capacity instructions in execution order
+        """
+        stream.write(_HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size))
+        stream.write(self.last())
+
+    def close(self):
+        """
+            write out the partly filled buffer when tracing to a stream
+        """
+        if self._stream is not None:
+            self._stream.write(memoryview(self._buffer)[:self._offset])
+            self._offset = 0
+
+
+def read_trace(stream):
+    """
+        yield TraceRecords from a trace file written by a Tracer stream or by dump()
+    """
+    magic, version, record_size = _HEADER.unpack(stream.read(_HEADER.size))
+    if magic != MAGIC or version != FORMAT_VERSION or record_size != RECORD.size:
+        raise ValueError("not a version {} trace".format(FORMAT_VERSION))
+    while True:
+        chunk = stream.read(RECORD.size * 0x1000)
+        if not chunk:
+            return
+        for fields in RECORD.iter_unpack(chunk):
+            yield TraceRecord(*fields)
+
+
+def test_trace_stream():
+    import io
+    from emulator import create_emulator
+    parser = create_emulator(bytes([0xA6, 0x05, 0x4C, 0x5C, 0x20, 0xFC]), seed=1)  # LDA #5, INCA, INCX, BRA -4
+    plain = parser._dispatch_table
+    cycle_table = parser._cycle_table
+    tracer = Tracer(capacity=4)
+    parser.set_tracer(tracer)
+    assert parser._dispatch_table is not plain
+    parser.run(max_instructions=7)
+
+    records = list(read_trace(io.BytesIO(_HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size) + tracer.last())))
+    assert tracer.records == 7 and len(records) == 4  # the ring kept the last four
+    assert [(record.pc, record.opcode) for record in records] == [(0x0004, 0x20), (0x0002, 0x4C), (0x0003, 0x5C),
+                                                                  (0x0004, 0x20)]
+    cycles = [cycle_table[opcode] for opcode in (0xA6, 0x4C, 0x5C, 0x20, 0x4C, 0x5C, 0x20)]
+    assert [record.cycles for record in records] == [sum(cycles[:index]) for index in range(3, 7)]
+    assert (records[1].a, records[2].a) == (0x06, 0x07)  # registers as they were before each instruction
+    assert tracer.cycles == parser.registers.cycles
+
+    dumped = io.BytesIO()
+    tracer.dump(dumped)
+    dumped.seek(0)
+    assert list(read_trace(dumped)) == records
+
+    parser.set_tracer(None)
+    assert parser._dispatch_table is plain
+
+
+def test_trace_to_stream():
+    import io
+    from emulator import create_emulator
+    parser = create_emulator(bytes([0x4C, 0x20, 0xFD]), seed=1)  # INCA, BRA -3
+    stream = io.BytesIO()
+    tracer = Tracer(capacity=3, stream=stream)
+    parser.set_tracer(tracer)
+    parser.run(max_instructions=8)
+    tracer.close()
+    stream.seek(0)
+    records = list(read_trace(stream))
+    assert [record.pc for record in records] == [0x0000, 0x0001] * 4  # every one of them, not just the last three
+    assert [record.a for record in records[::2]] == [0x00, 0x01, 0x02, 0x03]
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="print a binary execution trace")
+    argument_parser.add_argument("trace", help="file written by a Tracer")
+    argument_parser.add_argument("-n", "--last", type=int, help="only the last n records")
+    options = argument_parser.parse_args()
+
+    opcode_table = load_opcode_table()[0]
+    with open(options.trace, 'rb') as trace_file:
+        records = read_trace(trace_file)
+        if options.last:
+            records = collections.deque(records, maxlen=options.last)
+        for record in records:
+            info = opcode_table[record.opcode]
+            print("{0:>12} {1:#06x}: {2:#04x} {3:<6} a={4:#04x} x={5:#04x} sp={6:#06x} ccr={7:#04x}".format(
+                record.cycles, record.pc, record.opcode, info.mnemon if info is not None else "???",
+                record.a, record.x, record.sp, record.ccr))